@@ -1,8 +1,10 @@
+import time
+
 from django_statsd.clients import statsd
 
 from tastypie.authentication import Authentication
 
-from models import APIApp
+from models import get_active_app
 
 
 class AppAuthentication(Authentication):
@@ -13,9 +15,10 @@ class AppAuthentication(Authentication):
         app_key = request.GET.get('app_key', '')
         app_name = request.GET.get('app_name', '')
 
-        try:
-            app = APIApp.objects.get(name__iexact=app_name, key=app_key, is_active=True)
-        except APIApp.DoesNotExist:
+        start = time.time()
+        app = get_active_app(app_name, app_key)
+        statsd.timing('api.auth.time', int((time.time() - start) * 1000))
+        if not app:
             statsd.incr('api.auth.failed')
             return False
 
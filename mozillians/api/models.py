@@ -1,9 +1,20 @@
 import hmac
+import threading
+import time
 import uuid
-from hashlib import sha1
+from collections import OrderedDict
+from hashlib import md5, sha1
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models
+from django.db.models import signals as dbsignals
+from django.dispatch import receiver
+
+from mozillians.api.resources import invalidate_response_cache
+from mozillians.groups.models import Group, GroupMembership, Skill
+from mozillians.users.models import ExternalAccount, Language, UserProfile
 
 
 class APIApp(models.Model):
@@ -34,3 +45,129 @@ class APIApp(models.Model):
         """Return a key."""
         new_uuid = uuid.uuid4()
         return hmac.new(str(new_uuid), digestmod=sha1).hexdigest()
+
+
+class AppLRUCache(object):
+    """Small in-process least recently used cache with expiring entries."""
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[0] < time.time():
+                return None
+            self._items[key] = item
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.timeout, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+API_APP_CACHE_KEY = 'api-app-%s'
+_local_app_cache = AppLRUCache(100, settings.API_APP_LOCAL_CACHE_TIMEOUT)
+
+
+def _get_app_cache_key(name, key):
+    signature = u'%s:%s' % (name.lower(), key)
+    return API_APP_CACHE_KEY % md5(signature.encode('utf-8')).hexdigest()
+
+
+def get_active_app(name, key):
+    """Return the active APIApp with the given name and key, or None.
+
+    Apps are cached in memcached and, for a few seconds, in process
+    memory, so that authenticating an API request doesn't need a
+    database query. Unknown apps are not cached.
+    """
+    cache_key = _get_app_cache_key(name, key)
+    app = _local_app_cache.get(cache_key)
+    if app is None:
+        app = cache.get(cache_key)
+        if app is None:
+            try:
+                app = APIApp.objects.get(name__iexact=name, key=key, is_active=True)
+            except APIApp.DoesNotExist:
+                return None
+            cache.set(cache_key, app, settings.API_APP_CACHE_TIMEOUT)
+        _local_app_cache.set(cache_key, app)
+    return app
+
+
+@receiver(dbsignals.pre_save, sender=APIApp,
+          dispatch_uid='api_app_invalidate_previous_sig')
+def invalidate_previous_app_cache(sender, instance, raw, **kwargs):
+    if raw or not instance.pk:
+        return
+    for name, key in APIApp.objects.filter(pk=instance.pk).values_list('name', 'key'):
+        cache_key = _get_app_cache_key(name, key)
+        cache.delete(cache_key)
+        _local_app_cache.delete(cache_key)
+
+
+@receiver(dbsignals.post_delete, sender=APIApp,
+          dispatch_uid='api_app_invalidate_delete_sig')
+@receiver(dbsignals.post_save, sender=APIApp,
+          dispatch_uid='api_app_invalidate_save_sig')
+def invalidate_app_cache(sender, instance, **kwargs):
+    cache_key = _get_app_cache_key(instance.name, instance.key)
+    cache.delete(cache_key)
+    _local_app_cache.delete(cache_key)
+
+
+@receiver(dbsignals.post_delete, sender=UserProfile,
+          dispatch_uid='api_invalidate_profile_delete_sig')
+@receiver(dbsignals.post_save, sender=UserProfile,
+          dispatch_uid='api_invalidate_profile_save_sig')
+def invalidate_profile_responses(sender, instance, **kwargs):
+    invalidate_response_cache('users', 'groups', 'skills')
+
+
+@receiver(dbsignals.post_delete, sender=ExternalAccount,
+          dispatch_uid='api_invalidate_account_delete_sig')
+@receiver(dbsignals.post_save, sender=ExternalAccount,
+          dispatch_uid='api_invalidate_account_save_sig')
+@receiver(dbsignals.post_delete, sender=Language,
+          dispatch_uid='api_invalidate_language_delete_sig')
+@receiver(dbsignals.post_save, sender=Language,
+          dispatch_uid='api_invalidate_language_save_sig')
+def invalidate_profile_detail_responses(sender, instance, **kwargs):
+    invalidate_response_cache('users')
+
+
+@receiver(dbsignals.post_delete, sender=Group,
+          dispatch_uid='api_invalidate_group_delete_sig')
+@receiver(dbsignals.post_save, sender=Group,
+          dispatch_uid='api_invalidate_group_save_sig')
+@receiver(dbsignals.post_delete, sender=GroupMembership,
+          dispatch_uid='api_invalidate_membership_delete_sig')
+@receiver(dbsignals.post_save, sender=GroupMembership,
+          dispatch_uid='api_invalidate_membership_save_sig')
+def invalidate_group_responses(sender, instance, **kwargs):
+    invalidate_response_cache('users', 'groups')
+
+
+@receiver(dbsignals.post_delete, sender=Skill,
+          dispatch_uid='api_invalidate_skill_delete_sig')
+@receiver(dbsignals.post_save, sender=Skill,
+          dispatch_uid='api_invalidate_skill_save_sig')
+@receiver(dbsignals.m2m_changed, sender=UserProfile.skills.through,
+          dispatch_uid='api_invalidate_profile_skills_sig')
+def invalidate_skill_responses(sender, instance, **kwargs):
+    invalidate_response_cache('users', 'skills')
@@ -1,9 +1,23 @@
+from urllib import urlencode
+
 from django.conf import settings
 from tastypie import paginator
+from tastypie.exceptions import BadRequest
 
 
 class Paginator(paginator.Paginator):
-    """Paginator with a hard limit on results per page."""
+    """Paginator with a hard limit on results per page.
+
+    Supports cursor pagination through the 'after' parameter.
+    """
+
+    def __init__(self, request_data, *args, **kwargs):
+        # Pages are cached and shared between apps, the 'previous' and
+        # 'next' links must not carry the credentials of the caller.
+        request_data = request_data.copy()
+        for key in ['app_name', 'app_key']:
+            request_data.pop(key, None)
+        super(Paginator, self).__init__(request_data, *args, **kwargs)
 
     def get_limit(self):
         """Determines the proper maximum number of results to return.
@@ -28,3 +42,61 @@ class Paginator(paginator.Paginator):
         Elastic Search crashes and timeouts.
         """
         return min(super(Paginator, self).get_offset(), self.get_count())
+
+    def get_after(self):
+        """Return the id given in the 'after' parameter or None.
+
+        Raises BadRequest if it isn't a non-negative integer.
+        """
+        after = self.request_data.get('after')
+        if after is None:
+            return None
+
+        try:
+            after = int(after)
+        except ValueError:
+            raise BadRequest('Invalid after provided. Please provide a positive integer.')
+
+        if after < 0:
+            raise BadRequest('Invalid after provided. Please provide a positive integer.')
+        return after
+
+    def _generate_after_uri(self, limit, after):
+        if self.resource_uri is None:
+            return None
+
+        request_params = {}
+        for key, value in self.request_data.items():
+            if key in ['limit', 'offset', 'after']:
+                continue
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            request_params[key] = value
+        request_params.update({'limit': limit, 'after': after})
+        return '%s?%s' % (self.resource_uri, urlencode(request_params))
+
+    def page(self):
+        """Return a page of results.
+
+        When an 'after' id is given, objects are sought by id instead
+        of offset and the total count is skipped, so that walking
+        through all the results takes linear time. The 'next' link
+        carries the id of the last object of the page.
+        """
+        after = self.get_after()
+        if after is None:
+            return super(Paginator, self).page()
+
+        limit = self.get_limit()
+        objects = self.objects.filter(pk__gt=after).order_by('pk')
+        if limit:
+            objects = objects[:limit]
+        objects = list(objects)
+
+        meta = {'limit': limit,
+                'after': after,
+                'next': None}
+        if limit and len(objects) == limit:
+            meta['next'] = self._generate_after_uri(limit, objects[-1].pk)
+
+        return {'objects': objects, 'meta': meta}
@@ -1,8 +1,27 @@
+import calendar
+import time
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
 from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
 
 from django_statsd.clients import statsd
 
 
+API_CACHE_GENERATION_KEY = 'api-generation-%s'
+API_RESPONSE_CACHE_KEY = 'api-response-%s'
+
+
+def invalidate_response_cache(*resource_names):
+    """Expire the cached list responses of the given resources."""
+    now = time.time()
+    cache.set_many(dict((API_CACHE_GENERATION_KEY % name, now)
+                        for name in resource_names))
+
+
 class ClientCacheResourceMixIn(object):
     """
     Mixin class which sets Cache-Control headers on API responses
@@ -25,16 +44,85 @@ class ClientCacheResourceMixIn(object):
         return response
 
 
+class ResponseCacheResourceMixIn(object):
+    """
+    Mixin class which caches list responses on the server and answers
+    conditional GET requests.
+
+    Responses are cached per resource, query parameters and format,
+    until invalidate_response_cache() is called for the resource. They
+    carry an ETag and a Last-Modified header, taken from the newest
+    last_updated of the listed objects when they have one.
+    """
+
+    def _get_cache_generation(self):
+        key = API_CACHE_GENERATION_KEY % self._meta.resource_name
+        generation = cache.get(key)
+        if generation is None:
+            cache.add(key, time.time())
+            generation = cache.get(key) or time.time()
+        return generation
+
+    def _get_response_cache_key(self, request, generation):
+        params = sorted((key, sorted(values)) for key, values in request.GET.lists()
+                        if key not in ['app_name', 'app_key'])
+        signature = repr((self._meta.resource_name, generation,
+                          self.determine_format(request), params))
+        return API_RESPONSE_CACHE_KEY % md5(signature).hexdigest()
+
+    def alter_list_data_to_serialize(self, request, data):
+        data = (super(ResponseCacheResourceMixIn, self)
+                .alter_list_data_to_serialize(request, data))
+        last_updated = [bundle.obj.last_updated for bundle in data['objects']
+                        if getattr(bundle.obj, 'last_updated', None)]
+        if last_updated:
+            request._api_last_modified = calendar.timegm(max(last_updated).utctimetuple())
+        return data
+
+    def get_list(self, request, **kwargs):
+        generation = self._get_cache_generation()
+        key = self._get_response_cache_key(request, generation)
+        cached = cache.get(key)
+
+        if cached is None:
+            response = (super(ResponseCacheResourceMixIn, self)
+                        .get_list(request, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            cached = {'content': response.content,
+                      'content_type': response['Content-Type'],
+                      'etag': '"%s"' % md5(response.content).hexdigest(),
+                      'last_modified': getattr(request, '_api_last_modified', generation)}
+            cache.set(key, cached, settings.API_RESPONSE_CACHE_TIMEOUT)
+
+        if cached['etag'] in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(cached['content'], content_type=cached['content_type'])
+        response['ETag'] = cached['etag']
+        response['Last-Modified'] = http_date(cached['last_modified'])
+        if hasattr(self.Meta, 'cache_control'):
+            patch_cache_control(response, **self.Meta.cache_control)
+        return response
+
+
 class AdvancedSortingResourceMixIn(object):
     """
     MixIn to allow sorting on multiple values in the same query.
+
+    An optional ``ordering_aliases`` dictionary in the resource's Meta
+    class maps ordering values to the model fields to sort on.
     """
 
     def apply_sorting(self, obj_list, options=None):
         """Allow sorting on multiple values. """
-        sort_list = [order_value for order_value
-                     in options.get('order_by', '').split(',')
-                     if order_value.strip('-') in self.Meta.ordering]
+        aliases = getattr(self.Meta, 'ordering_aliases', {})
+        sort_list = []
+        for order_value in options.get('order_by', '').split(','):
+            name = order_value.strip('-')
+            if name in self.Meta.ordering:
+                sort_list.append(order_value.replace(name, aliases.get(name, name)))
 
         if not sort_list:
             sort_list = self.Meta.default_order
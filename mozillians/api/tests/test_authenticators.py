@@ -1,5 +1,6 @@
 from django.test.client import RequestFactory
 
+from mock import patch
 from nose.tools import eq_, ok_
 from test_utils import TestCase
 
@@ -64,3 +65,40 @@ class AppAuthenticationTests(TestCase):
         authentication = AppAuthentication()
         authentication.is_authenticated(request)
         eq_(request.GET.get('restricted'), True)
+
+    def test_cached_app(self):
+        app = APIAppFactory.create()
+        request = RequestFactory()
+        request.GET = {'app_key': app.key, 'app_name': app.name}
+        authentication = AppAuthentication()
+        ok_(authentication.is_authenticated(request))
+        with self.assertNumQueries(0):
+            ok_(authentication.is_authenticated(request))
+
+    def test_deactivated_app(self):
+        app = APIAppFactory.create()
+        request = RequestFactory()
+        request.GET = {'app_key': app.key, 'app_name': app.name}
+        authentication = AppAuthentication()
+        ok_(authentication.is_authenticated(request))
+        app.is_active = False
+        app.save()
+        eq_(authentication.is_authenticated(request), False)
+
+    def test_app_key_changed(self):
+        app = APIAppFactory.create()
+        request = RequestFactory()
+        request.GET = {'app_key': app.key, 'app_name': app.name}
+        authentication = AppAuthentication()
+        ok_(authentication.is_authenticated(request))
+        app.key = 'changed'
+        app.save()
+        eq_(authentication.is_authenticated(request), False)
+
+    @patch('mozillians.api.authenticators.statsd.timing')
+    def test_auth_timing(self, timing_mock):
+        request = RequestFactory()
+        request.GET = {'app_key': 'invalid', 'app_name': 'invalid'}
+        AppAuthentication().is_authenticated(request)
+        ok_(timing_mock.called)
+        eq_(timing_mock.call_args[0][0], 'api.auth.time')
@@ -1,7 +1,14 @@
+import json
+
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+
 from mock import MagicMock, patch
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from mozillians.api.resources import GraphiteMixIn
+from mozillians.api.paginator import Paginator
+from mozillians.api.resources import (GraphiteMixIn, ResponseCacheResourceMixIn,
+                                      invalidate_response_cache)
 from mozillians.common.tests import TestCase
 
 
@@ -27,3 +34,66 @@ class GraphiteMixInTests(TestCase):
         eq_(return_value, real_wrapper.return_value)
         real_wrapper.assert_called_with('request', 1, second=2)
         incr_mock.assert_called_with('api.resources.foo.bar')
+
+
+class ResponseCacheResourceMixInTests(TestCase):
+    def setUp(self):
+        self.get_list = MagicMock()
+        self.get_list.return_value = HttpResponse('foo', content_type='application/json')
+
+        class Bar(object):
+            get_list = self.get_list
+
+            def determine_format(self, request):
+                return 'application/json'
+
+        class Foo(ResponseCacheResourceMixIn, Bar):
+            class Meta:
+                cache_control = {'max-age': 0}
+
+            _meta = MagicMock(resource_name='foo')
+
+        self.resource = Foo()
+        invalidate_response_cache('foo')
+
+    def test_cached(self):
+        def get_list(request, **kwargs):
+            page = Paginator(request.GET, range(10), resource_uri='/api/').page()
+            return HttpResponse(json.dumps(page['meta']), content_type='application/json')
+        self.get_list.side_effect = get_list
+
+        request = RequestFactory().get('/', {'app_name': 'a', 'app_key': 'a', 'limit': 5})
+        response = self.resource.get_list(request)
+        ok_(json.loads(response.content)['next'])
+        ok_(response['ETag'])
+        ok_(response['Last-Modified'])
+
+        request = RequestFactory().get('/', {'app_name': 'b', 'app_key': 'b', 'limit': 5})
+        content = self.resource.get_list(request).content
+        eq_(content, response.content)
+        eq_(self.get_list.call_count, 1)
+        ok_('app_key' not in content)
+        ok_('app_name' not in content)
+
+    def test_different_params(self):
+        self.resource.get_list(RequestFactory().get('/', {'limit': 5}))
+        self.resource.get_list(RequestFactory().get('/', {'limit': 6}))
+        eq_(self.get_list.call_count, 2)
+
+    def test_not_modified(self):
+        response = self.resource.get_list(RequestFactory().get('/'))
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+        response = self.resource.get_list(request)
+        eq_(response.status_code, 304)
+
+    def test_invalidate(self):
+        self.resource.get_list(RequestFactory().get('/'))
+        invalidate_response_cache('foo')
+        self.resource.get_list(RequestFactory().get('/'))
+        eq_(self.get_list.call_count, 2)
+
+    def test_errors_not_cached(self):
+        self.get_list.return_value = HttpResponse(status=400)
+        self.resource.get_list(RequestFactory().get('/'))
+        self.resource.get_list(RequestFactory().get('/'))
+        eq_(self.get_list.call_count, 2)
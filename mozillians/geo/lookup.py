@@ -1,8 +1,17 @@
 import logging
+import math
+import threading
+import time
+import uuid
+from collections import defaultdict
+
 import requests
 from requests import ConnectionError, HTTPError
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals as dbsignals
+from django.dispatch import receiver
 
 from product_details import product_details
 
@@ -11,6 +20,20 @@ from mozillians.geo.models import Country, Region, City
 
 logger = logging.getLogger(__name__)
 
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Results are cached per cell of 0.01 degrees, about a kilometre.
+GEOCODE_CACHE_KEY = 'geocode-%d-%d'
+GEOCODE_CELLS_PER_DEGREE = 100
+# Known cities this many lookup radii away must agree on the region
+# and country for a local lookup to be trusted.
+LOCAL_LOOKUP_NEIGHBOURHOOD = 3
+# Changes whenever a Country, Region or City is changed or deleted.
+GEO_CACHE_VERSION_KEY = 'geo-cache-version'
+# Country codes by English country name, as Mapbox names them.
+COUNTRY_CODES = dict((name, code) for code, name
+                     in product_details.get_regions('en-US').iteritems())
+
 # Example data from mapbox:
 # {
 #     u'query': [-79.083798999999999, 35.918596000000001],
@@ -46,15 +69,302 @@ class GeoLookupException(Exception):
     pass
 
 
+def distance(lat1, lng1, lat2, lng2):
+    """Return the great-circle distance between two points in kilometres."""
+    lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class CityIndex(object):
+    """
+    In-memory grid of the known cities, for nearest city lookups.
+
+    The map is cut into cells of cell_size degrees and every city is
+    kept in the cell its coordinates fall in, so a lookup only looks
+    at the cities of the few cells around the point. The grid is built
+    from the City table on first use and rebuilt once it is older than
+    timeout seconds or after clear().
+    """
+
+    def __init__(self, cell_size, timeout=None):
+        self.cell_size = cell_size
+        self.timeout = timeout
+        self.columns = int(round(360 / cell_size))
+        self._cells = None
+        self._built = 0
+        self._lock = threading.Lock()
+
+    def _cell(self, lat, lng):
+        row = int(math.floor(lat / self.cell_size))
+        column = int(math.floor(lng / self.cell_size))
+        return row, self._wrap(column)
+
+    def _wrap(self, column):
+        # Columns past the antimeridian continue on the other side.
+        half = self.columns // 2
+        return (column + half) % self.columns - half
+
+    def _get_cells(self):
+        with self._lock:
+            expired = self.timeout and time.time() - self._built > self.timeout
+            if self._cells is None or expired:
+                cells = defaultdict(list)
+                for point in City.objects.values_list('id', 'lat', 'lng').iterator():
+                    cells[self._cell(point[1], point[2])].append(point)
+                self._cells, self._built = cells, time.time()
+            return self._cells
+
+    def add(self, city_id, lat, lng):
+        """Add a new city to the grid, if it's already built."""
+        with self._lock:
+            if self._cells is not None:
+                self._cells[self._cell(lat, lng)].append((city_id, lat, lng))
+
+    def clear(self):
+        """Drop the grid, it is built again on the next lookup."""
+        with self._lock:
+            self._cells = None
+
+    def nearest(self, lat, lng, radius):
+        """
+        Return the (id, lat, lng) of the city nearest to lat and lng
+        within radius kilometres, or None.
+        """
+        points = self.within(lat, lng, radius)
+        return points[0] if points else None
+
+    def within(self, lat, lng, radius):
+        """
+        Return the (id, lat, lng) of the cities within radius
+        kilometres of lat and lng, nearest first.
+        """
+        cells = self._get_cells()
+        rows = int(math.ceil(radius / (KM_PER_DEGREE * self.cell_size)))
+        # A degree of longitude gets shorter away from the equator, all
+        # the columns are searched if the circle reaches a pole.
+        edge_lat = abs(lat) + (rows + 1) * self.cell_size
+        columns = self.columns // 2
+        if edge_lat < 90:
+            lng_km = KM_PER_DEGREE * math.cos(math.radians(edge_lat))
+            columns = min(int(math.ceil(radius / (lng_km * self.cell_size))), columns)
+
+        row, column = self._cell(lat, lng)
+        found = []
+        for i in range(row - rows, row + rows + 1):
+            for j in range(column - columns, column + columns + 1):
+                for point in cells.get((i, self._wrap(j)), []):
+                    point_distance = distance(lat, lng, point[1], point[2])
+                    if point_distance <= radius:
+                        found.append((point_distance, point))
+        found.sort()
+        return [item[1] for item in found]
+
+
+city_index = CityIndex(cell_size=0.1, timeout=getattr(settings, 'GEO_INDEX_TIMEOUT', None))
+
+
+@receiver(dbsignals.post_save, sender=City, dispatch_uid='update_city_index_sig')
+def update_city_index(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        city_index.add(instance.id, instance.lat, instance.lng)
+    else:
+        city_index.clear()
+
+
+@receiver(dbsignals.post_delete, sender=City, dispatch_uid='clear_city_index_sig')
+def clear_city_index(sender, instance, **kwargs):
+    city_index.clear()
+
+
+class GeoEntityCache(object):
+    """
+    In-process cache of Country, Region and City objects, by primary
+    key and by mapbox_id.
+
+    All countries and regions are loaded on first use, cities are
+    added as they are looked up. Changed or deleted objects are
+    dropped from the cache and everything is reloaded once older
+    than timeout seconds.
+
+    Other processes learn about changes through a version stored
+    under GEO_CACHE_VERSION_KEY in the shared cache, everything is
+    reloaded when it differs from the version seen at the last load.
+    """
+    RELATED = {Country: [], Region: ['country'], City: ['region__country', 'country']}
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._objects = None
+        self._built = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _get_objects(self):
+        version = cache.get(GEO_CACHE_VERSION_KEY)
+        expired = self.timeout and time.time() - self._built > self.timeout
+        if self._objects is None or expired or version != self._version:
+            self._objects = {}
+            self._built = time.time()
+            self._version = version
+            for model in [Country, Region]:
+                for obj in model.objects.select_related(*self.RELATED[model]):
+                    self._add(obj)
+        return self._objects
+
+    def _add(self, obj):
+        self._objects[(type(obj), 'pk', obj.pk)] = obj
+        self._objects[(type(obj), 'mapbox_id', obj.mapbox_id)] = obj
+
+    def get(self, model, **kwargs):
+        """
+        Return the object of model with the given pk or mapbox_id, or
+        None if there's no such object.
+        """
+        (field, value), = kwargs.items()
+        with self._lock:
+            obj = self._get_objects().get((model, field, value))
+        if obj is None:
+            try:
+                obj = model.objects.select_related(*self.RELATED[model]).get(**kwargs)
+            except model.DoesNotExist:
+                return None
+            with self._lock:
+                self._add(obj)
+        return obj
+
+    def discard(self, obj):
+        """Drop obj from the cache."""
+        with self._lock:
+            if self._objects is None:
+                return
+            model = type(obj)
+            cached = self._objects.pop((model, 'pk', obj.pk), None)
+            for instance in [obj, cached]:
+                if instance is not None:
+                    self._objects.pop((model, 'mapbox_id', instance.mapbox_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._objects = None
+
+
+geo_cache = GeoEntityCache(timeout=getattr(settings, 'GEO_INDEX_TIMEOUT', None))
+
+
+@receiver(dbsignals.post_delete, sender=Country, dispatch_uid='geo_cache_country_delete_sig')
+@receiver(dbsignals.post_save, sender=Country, dispatch_uid='geo_cache_country_save_sig')
+@receiver(dbsignals.post_delete, sender=Region, dispatch_uid='geo_cache_region_delete_sig')
+@receiver(dbsignals.post_save, sender=Region, dispatch_uid='geo_cache_region_save_sig')
+@receiver(dbsignals.post_delete, sender=City, dispatch_uid='geo_cache_city_delete_sig')
+@receiver(dbsignals.post_save, sender=City, dispatch_uid='geo_cache_city_save_sig')
+def update_geo_cache(sender, instance, **kwargs):
+    if not kwargs.get('created'):
+        # New objects are looked up in the database when missing,
+        # only changes and deletions are announced.
+        cache.set(GEO_CACHE_VERSION_KEY, uuid.uuid4().hex)
+    if sender is City or kwargs.get('created'):
+        geo_cache.discard(instance)
+    else:
+        # Cached regions and cities hold copies of their country and region.
+        geo_cache.clear()
+
+
+def local_reverse_geocode(lat, lng):
+    """
+    Return the known City nearest to lat and lng, within
+    GEO_LOCAL_LOOKUP_RADIUS kilometres, or None.
+
+    None is also returned when another known city within
+    LOCAL_LOOKUP_NEIGHBOURHOOD times the radius is in a different
+    region or country, the point may be across the border.
+    """
+    radius = getattr(settings, 'GEO_LOCAL_LOOKUP_RADIUS', 0)
+    if not radius:
+        return None
+
+    points = city_index.within(lat, lng, radius * LOCAL_LOOKUP_NEIGHBOURHOOD)
+    if not points or distance(lat, lng, points[0][1], points[0][2]) > radius:
+        return None
+    cities = []
+    for city_id, city_lat, city_lng in points:
+        city = geo_cache.get(City, pk=city_id)
+        if not city or (city.lat, city.lng) != (city_lat, city_lng):
+            # The grid is out of date.
+            city_index.clear()
+            return None
+        cities.append(city)
+    nearest = cities[0]
+    for city in cities[1:]:
+        if (city.country_id, city.region_id) != (nearest.country_id, nearest.region_id):
+            return None
+    return nearest
+
+
+def geocode_cell(lat, lng):
+    """Return the (row, column) of the cache cell lat and lng fall in."""
+    return (int(math.floor(lat * GEOCODE_CELLS_PER_DEGREE)),
+            int(math.floor(lng * GEOCODE_CELLS_PER_DEGREE)))
+
+
+def _geocode_cache_key(lat, lng):
+    return GEOCODE_CACHE_KEY % geocode_cell(lat, lng)
+
+
+def get_cached_location(lat, lng):
+    """
+    Return the Country, Region, City 3-tuple of lat and lng if it is
+    known without calling Mapbox, from a city nearby or an earlier
+    result for the same cell. Otherwise return None.
+    """
+    city = local_reverse_geocode(lat, lng)
+    if city:
+        return city.country, city.region, city
+
+    ids = cache.get(_geocode_cache_key(lat, lng))
+    if ids is None:
+        return None
+    location = []
+    for model, pk in zip([Country, Region, City], ids):
+        obj = None
+        if pk is not None:
+            obj = geo_cache.get(model, pk=pk)
+            if obj is None:
+                return None
+        location.append(obj)
+    return tuple(location)
+
+
 def reverse_geocode(lat, lng):
     """
     Given a lat and lng (floats), return a 3-tuple of
     Country, Region, and City objects.
 
+    Known cities close enough to the point and cached results are
+    used first, Mapbox is only called for the rest.
+
     Raises exception if there's any error calling mapbox.
     """
+    location = get_cached_location(lat, lng)
+    if location:
+        return location
+
+    result = fetch_geocode_result(lat, lng)
+    return cache_geocode_result(lat, lng, result)
+
+
+def fetch_geocode_result(lat, lng):
+    """
+    Call Mapbox for lat and lng and return its first result.
+
+    Only talks HTTP, without touching the database, so it can be
+    called from worker threads.
+
+    Raises GeoLookupException if there's any error calling mapbox.
+    """
     try:
-        result = get_first_mapbox_geocode_result('%s,%s' % (lng, lat))
+        return get_first_mapbox_geocode_result('%s,%s' % (lng, lat))
     except HTTPError:
         logger.exception('HTTP status error when calling Mapbox.')
         raise GeoLookupException
@@ -62,10 +372,20 @@ def reverse_geocode(lat, lng):
         logger.exception('Cannot open connection to Mapbox.')
         raise GeoLookupException
 
+
+def cache_geocode_result(lat, lng, result):
+    """
+    Turn a Mapbox `result` for lat and lng into a 3-tuple of Country,
+    Region and City objects and cache it for the cell of the point.
+    """
     if result:
-        return result_to_country_region_city(result)
+        location = result_to_country_region_city(result)
     else:
-        return None, None, None
+        location = None, None, None
+    cache.set(_geocode_cache_key(lat, lng),
+              [getattr(obj, 'pk', None) for obj in location],
+              settings.GEOCODE_CACHE_TIMEOUT)
+    return location
 
 
 def get_first_mapbox_geocode_result(query):
@@ -79,7 +399,7 @@ def get_first_mapbox_geocode_result(query):
     If no results are returned, returns an empty dictionary.
     """
     map_id = settings.MAPBOX_MAP_ID
-    url = 'http://api.tiles.mapbox.com/v3/%s/geocode/%s.json' % (map_id, query)
+    url = settings.MAPBOX_GEOCODE_URL % (map_id, query)
 
     r = requests.get(url)
     r.raise_for_status()
@@ -116,20 +436,19 @@ def result_to_country(result):
     if 'country' in result:
 
         mapbox_country = result['country']
-        codes = dict((v, k) for k, v in product_details.get_regions('en-US').iteritems())
-        code = codes.get(mapbox_country['name'], '')
-        country, created = Country.objects.get_or_create(
-            mapbox_id=mapbox_country['id'],
-            defaults=dict(
-                name=mapbox_country['name'],
-                code=code,
+        country = geo_cache.get(Country, mapbox_id=mapbox_country['id'])
+        if country is None:
+            country, created = Country.objects.get_or_create(
+                mapbox_id=mapbox_country['id'],
+                defaults=dict(
+                    name=mapbox_country['name'],
+                    code=COUNTRY_CODES.get(mapbox_country['name'], ''),
+                )
             )
-        )
-        if not created:
-            # Update name if it's changed in mapbox
-            if country.name != mapbox_country['name']:
-                country.name = mapbox_country['name']
-                country.save()
+        # Update name if it's changed in mapbox
+        if country.name != mapbox_country['name']:
+            country.name = mapbox_country['name']
+            country.save()
         return country
 
 
@@ -140,18 +459,19 @@ def result_to_region(result, country):
     """
     if 'province' in result:
         mapbox_region = result['province']
-        region, created = Region.objects.get_or_create(
-            mapbox_id=mapbox_region['id'],
-            defaults=dict(
-                name=mapbox_region['name'],
-                country=country,
+        region = geo_cache.get(Region, mapbox_id=mapbox_region['id'])
+        if region is None:
+            region, created = Region.objects.get_or_create(
+                mapbox_id=mapbox_region['id'],
+                defaults=dict(
+                    name=mapbox_region['name'],
+                    country=country,
+                )
             )
-        )
-        if not created:
-            # Update name if it's changed in mapbox
-            if region.name != mapbox_region['name']:
-                region.name = mapbox_region['name']
-                region.save()
+        # Update name if it's changed in mapbox
+        if region.name != mapbox_region['name']:
+            region.name = mapbox_region['name']
+            region.save()
         return region
 
 
@@ -175,9 +495,8 @@ def result_to_city(result, country, region):
             lng=mapbox_city['lon'],
         )
 
-        try:
-            city = City.objects.get(mapbox_id=mapbox_city['id'])
-        except City.DoesNotExist:
+        city = geo_cache.get(City, mapbox_id=mapbox_city['id'])
+        if city is None:
             # Mapbox sometimes returns multiple cities with the same
             # name but different ids. So we need to check for existing
             # (name, region, country) groups to avoid filling the
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Country.slug'
+        db.add_column(u'geo_country', 'slug',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=120, db_index=True),
+                      keep_default=False)
+
+        # Adding field 'Region.slug'
+        db.add_column(u'geo_region', 'slug',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=120, db_index=True),
+                      keep_default=False)
+
+        # Adding field 'City.slug'
+        db.add_column(u'geo_city', 'slug',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=120, db_index=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'Country.slug'
+        db.delete_column(u'geo_country', 'slug')
+
+        # Deleting field 'Region.slug'
+        db.delete_column(u'geo_region', 'slug')
+
+        # Deleting field 'City.slug'
+        db.delete_column(u'geo_city', 'slug')
+
+
+    models = {
+        u'geo.city': {
+            'Meta': {'unique_together': "(('name', 'region', 'country'),)", 'object_name': 'City'},
+            'country': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['geo.Country']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lat': ('django.db.models.fields.FloatField', [], {}),
+            'lng': ('django.db.models.fields.FloatField', [], {}),
+            'mapbox_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '120'}),
+            'region': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['geo.Region']", 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '120', 'db_index': 'True'})
+        },
+        u'geo.country': {
+            'Meta': {'object_name': 'Country'},
+            'code': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'mapbox_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '120'}),
+            'slug': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '120', 'db_index': 'True'})
+        },
+        u'geo.region': {
+            'Meta': {'unique_together': "(('name', 'country'),)", 'object_name': 'Region'},
+            'country': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['geo.Country']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'mapbox_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '120'}),
+            'slug': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '120', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['geo']
\ No newline at end of file
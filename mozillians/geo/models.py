@@ -1,7 +1,30 @@
+import re
+
 from django.db import models
+from django.utils.encoding import force_unicode
+
+
+def location_slug(name):
+    """Return `name` lowercased, with runs of whitespace and punctuation
+    replaced by a dash, for case insensitive indexed lookups.
+
+    """
+    return re.sub(r'[\W_]+', '-', force_unicode(name), flags=re.UNICODE).strip('-').lower()
+
+
+class LocationBase(models.Model):
+    slug = models.CharField(max_length=120, db_index=True, editable=False, default='',
+                            help_text='name normalised with location_slug')
+
+    class Meta(object):
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.slug = location_slug(self.name)
+        super(LocationBase, self).save(*args, **kwargs)
 
 
-class Country(models.Model):
+class Country(LocationBase):
     #  {u'type': u'country', u'id': u'country.4150104525', u'name': u'United States'}
     name = models.CharField(
         max_length=120, unique=True,
@@ -22,7 +45,7 @@ class Country(models.Model):
         return self.name
 
 
-class Region(models.Model):
+class Region(LocationBase):
     # {u'type': u'province', u'id': u'province.2516948401', u'name': u'North Carolina'}
     name = models.CharField(
         max_length=120,
@@ -43,7 +66,7 @@ class Region(models.Model):
         return u'%s, %s' % (self.name, self.country.name)
 
 
-class City(models.Model):
+class City(LocationBase):
     # {u'name': u'Carrboro', u'lon': -79.083798999999999, u'lat': 35.918596000000001,
     # u'bounds': [-79.100728852067547, 35.889960723848048,
     #             -79.063862048216336, 35.947221266002018],
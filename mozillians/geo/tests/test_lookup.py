@@ -1,3 +1,4 @@
+from django.core.cache import cache
 from django.test.utils import override_settings
 
 from mock import patch
@@ -6,7 +7,10 @@ from requests import ConnectionError, HTTPError
 
 from mozillians.common.tests import TestCase
 from mozillians.geo.models import Country, Region, City
-from mozillians.geo.lookup import (GeoLookupException, get_first_mapbox_geocode_result,
+from mozillians.geo.lookup import (GEO_CACHE_VERSION_KEY, CityIndex, GeoLookupException,
+                                   city_index, distance,
+                                   geo_cache, get_first_mapbox_geocode_result,
+                                   local_reverse_geocode,
                                    result_to_city, result_to_country_region_city,
                                    result_to_country, result_to_region, reverse_geocode)
 from mozillians.geo.tests import CountryFactory, RegionFactory, CityFactory
@@ -34,6 +38,11 @@ class TestCallingGeocode(TestCase):
 @patch('mozillians.geo.lookup.result_to_country_region_city')
 @patch('mozillians.geo.lookup.get_first_mapbox_geocode_result')
 class TestReverseGeocode(TestCase):
+    def setUp(self):
+        cache.clear()
+        city_index.clear()
+        geo_cache.clear()
+
     def test_empty(self, mock_get_result, mock_result_to_country):
         # If get result returns nothing, reverse_geocode returns Nones
         mock_get_result.return_value = {}
@@ -47,6 +56,188 @@ class TestReverseGeocode(TestCase):
         eq_((1, 2, 3), reverse_geocode(0.0, 0.0))
         mock_result_to_country.assert_called_with(mock_get_result.return_value)
 
+    def test_cached(self, mock_get_result, mock_result_to_country):
+        city = CityFactory.create(lat=35.918596, lng=-79.083799)
+        mock_get_result.return_value = {'foo': 1}
+        mock_result_to_country.return_value = (city.country, None, city)
+        with override_settings(GEO_LOCAL_LOOKUP_RADIUS=0):
+            eq_((city.country, None, city), reverse_geocode(10.001, 20.001))
+            eq_((city.country, None, city), reverse_geocode(10.009, 20.009))
+            eq_(mock_get_result.call_count, 1)
+            reverse_geocode(10.011, 20.001)
+            eq_(mock_get_result.call_count, 2)
+
+    def test_cached_empty(self, mock_get_result, mock_result_to_country):
+        mock_get_result.return_value = {}
+        eq_((None, None, None), reverse_geocode(10.001, 20.001))
+        eq_((None, None, None), reverse_geocode(10.002, 20.002))
+        eq_(mock_get_result.call_count, 1)
+
+    def test_error_not_cached(self, mock_get_result, mock_result_to_country):
+        mock_get_result.side_effect = HTTPError
+        with self.assertRaises(GeoLookupException):
+            reverse_geocode(10.001, 20.001)
+        mock_get_result.side_effect = None
+        mock_get_result.return_value = {}
+        eq_((None, None, None), reverse_geocode(10.001, 20.001))
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=10)
+    def test_local_city(self, mock_get_result, mock_result_to_country):
+        city = CityFactory.create(lat=35.918596, lng=-79.083799)
+        eq_((city.country, city.region, city), reverse_geocode(35.9, -79.1))
+        ok_(not mock_get_result.called)
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=10)
+    def test_local_city_too_far(self, mock_get_result, mock_result_to_country):
+        CityFactory.create(lat=35.918596, lng=-79.083799)
+        mock_get_result.return_value = {'foo': 1}
+        mock_result_to_country.return_value = (1, 2, 3)
+        eq_((1, 2, 3), reverse_geocode(36.1, -79.1))
+        ok_(mock_get_result.called)
+
+
+class TestLocalReverseGeocode(TestCase):
+    def setUp(self):
+        city_index.clear()
+        geo_cache.clear()
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=10)
+    def test_nearest_city(self):
+        region = RegionFactory.create()
+        CityFactory.create(lat=35.918596, lng=-79.083799, region=region)
+        city = CityFactory.create(lat=35.913200, lng=-79.055845, region=region)
+        eq_(local_reverse_geocode(35.91, -79.06), city)
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=2)
+    def test_cross_border(self):
+        strasbourg = CityFactory.create(lat=48.5734, lng=7.7521)
+        kehl = CityFactory.create(lat=48.5728, lng=7.8150)
+        # Closest to Strasbourg, but Kehl is just across the Rhine.
+        eq_(local_reverse_geocode(48.5734, 7.7700), None)
+        kehl.delete()
+        eq_(local_reverse_geocode(48.5734, 7.7700), strasbourg)
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=2)
+    def test_neighbouring_town(self):
+        CityFactory.create(lat=35.913200, lng=-79.055845)
+        # Carrboro is not known yet, it must not become Chapel Hill.
+        eq_(local_reverse_geocode(35.918596, -79.083799), None)
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=0)
+    def test_disabled(self):
+        CityFactory.create(lat=35.918596, lng=-79.083799)
+        eq_(local_reverse_geocode(35.918596, -79.083799), None)
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=10)
+    def test_city_moved(self):
+        city = CityFactory.create(lat=35.918596, lng=-79.083799)
+        eq_(local_reverse_geocode(35.918596, -79.083799), city)
+        city.lat, city.lng = 10.0, 10.0
+        city.save()
+        eq_(local_reverse_geocode(35.918596, -79.083799), None)
+        eq_(local_reverse_geocode(10.0, 10.0), city)
+
+    @override_settings(GEO_LOCAL_LOOKUP_RADIUS=10)
+    def test_city_deleted(self):
+        city = CityFactory.create(lat=35.918596, lng=-79.083799)
+        eq_(local_reverse_geocode(35.918596, -79.083799), city)
+        city.delete()
+        eq_(local_reverse_geocode(35.918596, -79.083799), None)
+
+
+class TestCityIndex(TestCase):
+    def test_nearest(self):
+        city_1 = CityFactory.create(lat=10.0, lng=10.0)
+        city_2 = CityFactory.create(lat=10.05, lng=10.05)
+        index = CityIndex(cell_size=0.1)
+        eq_(index.nearest(10.01, 10.01, 10)[0], city_1.id)
+        eq_(index.nearest(10.04, 10.04, 10)[0], city_2.id)
+        eq_(index.nearest(11.0, 11.0, 10), None)
+
+    def test_add(self):
+        index = CityIndex(cell_size=0.1)
+        eq_(index.nearest(10.0, 10.0, 10), None)
+        index.add(1, 10.0, 10.0)
+        eq_(index.nearest(10.0, 10.0, 10), (1, 10.0, 10.0))
+
+    def test_antimeridian(self):
+        city = CityFactory.create(lat=0.0, lng=179.99)
+        index = CityIndex(cell_size=0.1)
+        eq_(index.nearest(0.0, -179.99, 10)[0], city.id)
+
+    def test_pole(self):
+        city = CityFactory.create(lat=89.95, lng=10.0)
+        index = CityIndex(cell_size=0.1)
+        eq_(index.nearest(89.99, -170.0, 10)[0], city.id)
+
+    def test_distance(self):
+        eq_(round(distance(0, 0, 0, 1)), 111)
+        eq_(distance(10, 10, 10, 10), 0)
+
+
+class TestGeoEntityCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        geo_cache.clear()
+
+    def test_get(self):
+        city = CityFactory.create()
+        eq_(geo_cache.get(Country, mapbox_id=city.country.mapbox_id), city.country)
+        eq_(geo_cache.get(City, pk=city.pk), city)
+        with self.assertNumQueries(0):
+            eq_(geo_cache.get(Country, pk=city.country.pk), city.country)
+            eq_(geo_cache.get(Region, mapbox_id=city.region.mapbox_id), city.region)
+            cached_city = geo_cache.get(City, mapbox_id=city.mapbox_id)
+            eq_(cached_city, city)
+            eq_(cached_city.region.country, city.country)
+
+    def test_get_missing(self):
+        eq_(geo_cache.get(Country, mapbox_id='foo'), None)
+        country = CountryFactory.create(mapbox_id='foo')
+        eq_(geo_cache.get(Country, mapbox_id='foo'), country)
+
+    def test_invalidation(self):
+        city = CityFactory.create()
+        geo_cache.get(City, pk=city.pk)
+        country = city.country
+        country.name = 'New name'
+        country.save()
+        eq_(geo_cache.get(City, pk=city.pk).country.name, 'New name')
+
+        city.name = 'New city name'
+        city.save()
+        eq_(geo_cache.get(City, pk=city.pk).name, 'New city name')
+
+        city.delete()
+        eq_(geo_cache.get(City, pk=city.pk), None)
+
+    def test_changed_in_other_process(self):
+        city = CityFactory.create()
+        eq_(geo_cache.get(City, pk=city.pk), city)
+        # Changes made elsewhere don't send signals here, only the
+        # version in the shared cache changes.
+        City.objects.filter(pk=city.pk).update(name='New city name')
+        cache.set(GEO_CACHE_VERSION_KEY, 'other')
+        eq_(geo_cache.get(City, pk=city.pk).name, 'New city name')
+
+        City.objects.filter(pk=city.pk).update(name='Newer city name')
+        eq_(geo_cache.get(City, pk=city.pk).name, 'New city name')
+        # Saving any geo object announces a change.
+        city.region.save()
+        eq_(geo_cache.get(City, pk=city.pk).name, 'Newer city name')
+
+    def test_result_to_country_region_city_cached(self):
+        city = CityFactory.create()
+        result = {
+            'country': {'id': city.country.mapbox_id, 'name': city.country.name},
+            'province': {'id': city.region.mapbox_id, 'name': city.region.name},
+            'city': {'id': city.mapbox_id, 'name': city.name,
+                     'lat': city.lat, 'lon': city.lng},
+        }
+        eq_(result_to_country_region_city(result), (city.country, city.region, city))
+        with self.assertNumQueries(0):
+            eq_(result_to_country_region_city(result), (city.country, city.region, city))
+
 
 class TestResultToCountryRegionCity(TestCase):
     @patch('mozillians.geo.lookup.result_to_country')
@@ -76,6 +267,9 @@ class TestResultToCountryRegionCity(TestCase):
 
 
 class TestResultToCountry(TestCase):
+    def setUp(self):
+        geo_cache.clear()
+
     def test_no_country(self):
         eq_(None, result_to_country({'foo': 1}))
 
@@ -106,6 +300,9 @@ class TestResultToCountry(TestCase):
 
 
 class TestResultToRegion(TestCase):
+    def setUp(self):
+        geo_cache.clear()
+
     def test_no_region(self):
         country = CountryFactory.create()
         eq_(None, result_to_region({}, country))
@@ -140,6 +337,9 @@ class TestResultToRegion(TestCase):
 
 
 class TestResultToCity(TestCase):
+    def setUp(self):
+        geo_cache.clear()
+
     def test_no_city(self):
         eq_(None, result_to_city({}, None, None))
 
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from nose.tools import eq_
+
+from mozillians.common.tests import TestCase
+from mozillians.geo.models import location_slug
+from mozillians.geo.tests import CityFactory, CountryFactory
+
+
+class TestLocationSlug(TestCase):
+    def test_location_slug(self):
+        eq_(location_slug('United States'), 'united-states')
+        eq_(location_slug(' St. Louis '), 'st-louis')
+        eq_(location_slug(u'São Paulo'), u'são-paulo')
+        eq_(location_slug(u'東京'), u'東京')
+
+    def test_slug_saved(self):
+        country = CountryFactory.create(name='Foo Bar')
+        eq_(country.slug, 'foo-bar')
+        country.name = 'Bar'
+        country.save()
+        eq_(country.slug, 'bar')
+        city = CityFactory.create(name='Foo_City')
+        eq_(city.slug, 'foo-city')
+        eq_(city.region.slug, location_slug(city.region.name))
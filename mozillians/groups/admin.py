@@ -2,7 +2,6 @@ from django import forms
 from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
 from django.contrib.admin.widgets import FilteredSelectMultiple
-from django.db.models import Count
 
 import autocomplete_light
 from import_export.admin import ExportMixin
@@ -25,10 +24,9 @@ class EmptyGroupFilter(SimpleListFilter):
         if self.value() is None:
             return queryset
         value = self.value() == 'True'
-        queryset = (queryset.annotate(no_profiles=Count('members')))
         if value:
-            return queryset.filter(no_profiles__gt=0)
-        return queryset.filter(no_profiles=0)
+            return queryset.filter(member_count__gt=0)
+        return queryset.filter(member_count=0)
 
 
 class CuratedGroupFilter(SimpleListFilter):
@@ -125,11 +123,8 @@ class GroupBaseAdmin(ExportMixin, admin.ModelAdmin):
         return super(GroupBaseAdmin, self).get_form(request, obj, **defaults)
 
     def total_member_count(self, obj):
-        """Return total number of members in group.
-
-        Do not use annonated value member_count directly (bug 908053).
-        """
-        return obj.members.count()
+        """Return total number of members in group."""
+        return obj.member_count
     total_member_count.admin_order_field = 'member_count'
 
     class Media:
@@ -1,5 +1,4 @@
 from django.core.urlresolvers import reverse
-from django.db.models import Count, Sum
 
 from funfactory import utils
 from tastypie import fields
@@ -10,15 +9,15 @@ from tastypie.serializers import Serializer
 from mozillians.api.authenticators import AppAuthentication
 from mozillians.api.resources import (AdvancedSortingResourceMixIn,
                                       ClientCacheResourceMixIn,
-                                      GraphiteMixIn)
+                                      GraphiteMixIn,
+                                      ResponseCacheResourceMixIn)
 from mozillians.api.paginator import Paginator
 from mozillians.groups.models import Group, Skill
 
 
-class GroupBaseResource(AdvancedSortingResourceMixIn, ClientCacheResourceMixIn,
-                        GraphiteMixIn, ModelResource):
-    number_of_members = fields.IntegerField(attribute='number_of_members',
-                                            readonly=True)
+class GroupBaseResource(ResponseCacheResourceMixIn, AdvancedSortingResourceMixIn,
+                        ClientCacheResourceMixIn, GraphiteMixIn, ModelResource):
+    number_of_members = fields.IntegerField(readonly=True)
 
     class Meta:
         authentication = AppAuthentication()
@@ -32,17 +31,17 @@ class GroupBaseResource(AdvancedSortingResourceMixIn, ClientCacheResourceMixIn,
         ordering = ['id', 'name', 'number_of_members']
         default_order = ['id']
 
+    def dehydrate_number_of_members(self, bundle):
+        return getattr(bundle.obj, self.Meta.ordering_aliases['number_of_members'])
+
 
 class GroupResource(GroupBaseResource):
     url = fields.CharField()
 
     class Meta(GroupBaseResource.Meta):
         resource_name = 'groups'
-        # This Sum hack counts the number of 1's in database, only
-        # works with MySQL because it stores booleans as 0s and 1s
-        queryset = (Group.objects
-                    .annotate(number_of_members=Count('members'))
-                    .filter(number_of_members__gt=0))
+        queryset = Group.objects.filter(member_count__gt=0)
+        ordering_aliases = {'number_of_members': 'member_count'}
 
     def dehydrate_url(self, bundle):
         url = reverse('groups:show_group', args=[bundle.obj.url])
@@ -53,6 +52,5 @@ class SkillResource(GroupBaseResource):
 
     class Meta(GroupBaseResource.Meta):
         resource_name = 'skills'
-        queryset = (Skill.objects
-                    .annotate(number_of_members=Sum('members__is_vouched'))
-                    .filter(number_of_members__gt=0))
+        queryset = Skill.objects.filter(vouched_member_count__gt=0)
+        ordering_aliases = {'number_of_members': 'vouched_member_count'}
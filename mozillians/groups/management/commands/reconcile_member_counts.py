@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from mozillians.groups.models import Group, Skill
+from mozillians.users.models import LocationCount
+
+
+class Command(BaseCommand):
+    help = 'Recount the members of all groups, skills and locations and fix stored counts.'
+
+    def handle(self, *args, **options):
+        for model in [Group, Skill]:
+            updated = model.update_member_counts()
+            msg = "%d %s member counts fixed.\n" % (updated, model._meta.verbose_name)
+            self.stdout.write(msg)
+        updated = LocationCount.update_counts()
+        self.stdout.write("%d location counts fixed.\n" % updated)
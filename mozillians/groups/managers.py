@@ -1,4 +1,4 @@
-from django.db.models import Count, Manager
+from django.db.models import Manager
 from django.db.models.query import QuerySet
 
 
@@ -7,9 +7,7 @@ class GroupBaseManager(Manager):
     queryset_class = QuerySet
 
     def get_query_set(self):
-        qs = self.queryset_class(self.model, using=self._db)
-        qs = qs.annotate(member_count=Count('members'))
-        return qs
+        return self.queryset_class(self.model, using=self._db)
 
     def __getattr__(self, name):
         return getattr(self.get_query_set(), name)
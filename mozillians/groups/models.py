@@ -1,5 +1,10 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Count
 from django.utils.timezone import now
 
 from autoslug.fields import AutoSlugField
@@ -14,10 +19,22 @@ from mozillians.groups.tasks import email_membership_change, member_removed_emai
 from mozillians.users.tasks import update_basket_task
 
 
+COMMON_SKILLS_CACHE_KEY = 'group-common-skills-%s'
+
+
+def clear_common_skills_cache(group_ids):
+    """Forget the common skills of the groups with the given ids."""
+    cache.delete_many([COMMON_SKILLS_CACHE_KEY % group_id for group_id in group_ids])
+
+
 class GroupBase(models.Model):
     name = models.CharField(db_index=True, max_length=50,
                             unique=True, verbose_name=_lazy(u'Name'))
     url = models.SlugField(blank=True)
+    # Denormalized counts of members, kept up to date by the signals in
+    # mozillians.users.models. Pending members are counted too.
+    member_count = models.PositiveIntegerField(default=0, db_index=True)
+    vouched_member_count = models.PositiveIntegerField(default=0, db_index=True)
 
     objects = GroupBaseManager()
 
@@ -25,6 +42,74 @@ class GroupBase(models.Model):
         abstract = True
         ordering = ['name']
 
+    @classmethod
+    def update_member_counts(cls, pks=None):
+        """Recount the members of the groups with the given pks, or of
+        all groups, and store the counts that are out of date.
+
+        Returns the number of groups updated.
+        """
+        queryset = cls.objects.all()
+        if pks is not None:
+            queryset = queryset.filter(pk__in=pks)
+
+        vouched_counts = dict(queryset.filter(members__is_vouched=True)
+                              .annotate(count=Count('members'))
+                              .values_list('pk', 'count'))
+        counts = (queryset.annotate(count=Count('members'))
+                  .values_list('pk', 'member_count', 'vouched_member_count', 'count'))
+
+        updated = 0
+        for pk, member_count, vouched_member_count, count in counts:
+            vouched_count = vouched_counts.get(pk, 0)
+            if (member_count, vouched_member_count) != (count, vouched_count):
+                cls.objects.filter(pk=pk).update(member_count=count,
+                                                 vouched_member_count=vouched_count)
+                updated += 1
+        return updated
+
+    @classmethod
+    def get_or_create_by_names(cls, names):
+        """Return the groups matching the given names or aliases, in the
+        same order, creating the ones that don't exist yet.
+
+        Aliases are resolved in a single query and the missing groups
+        and their aliases are created with bulk_create, which bypasses
+        save() and the post_save signals.
+        """
+        names = list(OrderedDict.fromkeys(name.lower() for name in names))
+        aliases = cls.ALIAS_MODEL.objects.filter(name__in=names).select_related('alias')
+        groups = dict((alias.name, alias.alias) for alias in aliases)
+
+        missing = [name for name in names if name not in groups]
+        if missing:
+            new_groups = []
+            slugs = set()
+            for name in missing:
+                slug = base_slug = slugify(name) or cls._meta.module_name
+                index = 1
+                while slug in slugs:
+                    index += 1
+                    slug = '%s-%d' % (base_slug, index)
+                slugs.add(slug)
+                new_groups.append(cls(name=name, url=slug))
+            cls.objects.bulk_create(new_groups)
+
+            # bulk_create doesn't set primary keys, fetch the new rows.
+            new_aliases = [cls.ALIAS_MODEL(name=group.name, alias=group, url=group.url)
+                           for group in cls.objects.filter(name__in=missing)]
+            cls.ALIAS_MODEL.objects.bulk_create(new_aliases)
+            for alias in new_aliases:
+                group = alias.alias
+                # The alias slug is made unique on insert, keep the
+                # group url in sync with it.
+                if alias.url != group.url:
+                    group.url = alias.url
+                    cls.objects.filter(pk=group.pk).update(url=group.url)
+                groups[alias.name] = group
+
+        return [groups[name] for name in names]
+
     def clean(self):
         """Verify that name is unique in ALIAS_MODEL.
 
@@ -312,6 +397,30 @@ class Group(GroupBase):
         return self.groupmembership_set.filter(userprofile=userprofile,
                                                status=GroupMembership.PENDING).exists()
 
+    def get_common_skills(self):
+        """
+        Return the skills shared by more than one member of this
+        group, most popular first.
+
+        The skill ids are cached until the memberships of the group or
+        the skills of its members change.
+        """
+        key = COMMON_SKILLS_CACHE_KEY % self.pk
+        skill_ids = cache.get(key)
+        if skill_ids is None:
+            counts = (Skill.objects
+                      .filter(members__groupmembership__group=self,
+                              members__groupmembership__status=GroupMembership.MEMBER)
+                      .annotate(count=Count('members'))
+                      .filter(count__gt=1)
+                      .order_by('-count', 'name')
+                      .values_list('id', 'count'))
+            skill_ids = [skill_id for skill_id, count in counts]
+            cache.set(key, skill_ids, settings.COMMON_SKILLS_CACHE_TIMEOUT)
+
+        skills = Skill.objects.in_bulk(skill_ids) if skill_ids else {}
+        return [skills[skill_id] for skill_id in skill_ids if skill_id in skills]
+
 
 class SkillAlias(GroupAliasBase):
     alias = models.ForeignKey('Skill', related_name='aliases')
@@ -5,7 +5,7 @@ from django.core.urlresolvers import reverse
 from nose.tools import eq_, ok_
 
 from mozillians.common.tests import TestCase
-from mozillians.groups.models import Group, GroupAlias, GroupMembership
+from mozillians.groups.models import Group, GroupAlias, GroupMembership, Skill
 from mozillians.groups.tests import (GroupAliasFactory, GroupFactory,
                                      SkillFactory)
 from mozillians.users.tests import UserFactory
@@ -194,6 +194,39 @@ class GroupBaseTests(TestCase):
         group_2 = GroupFactory.build(name='bar')
         self.assertRaises(ValidationError, group_2.clean)
 
+    def test_skill_member_counts(self):
+        skill = SkillFactory.create()
+        vouched = UserFactory.create()
+        unvouched = UserFactory.create(vouched=False)
+        skill.add_member(vouched.userprofile)
+        unvouched.userprofile.skills.add(skill)
+        skill = Skill.objects.get(pk=skill.pk)
+        eq_(skill.member_count, 2)
+        eq_(skill.vouched_member_count, 1)
+
+        vouched.userprofile.skills.clear()
+        skill.remove_member(unvouched.userprofile)
+        skill = Skill.objects.get(pk=skill.pk)
+        eq_(skill.member_count, 0)
+        eq_(skill.vouched_member_count, 0)
+
+    def test_skill_member_counts_profile_deleted(self):
+        skill = SkillFactory.create()
+        user = UserFactory.create()
+        skill.add_member(user.userprofile)
+        user.userprofile.delete()
+        eq_(Skill.objects.get(pk=skill.pk).member_count, 0)
+
+    def test_update_member_counts(self):
+        skill = SkillFactory.create()
+        skill.add_member(UserFactory.create().userprofile)
+        Skill.objects.filter(pk=skill.pk).update(member_count=5, vouched_member_count=5)
+        eq_(Skill.update_member_counts(), 1)
+        skill = Skill.objects.get(pk=skill.pk)
+        eq_(skill.member_count, 1)
+        eq_(skill.vouched_member_count, 1)
+        eq_(Skill.update_member_counts(), 0)
+
 
 class GroupTests(TestCase):
     def test_visible(self):
@@ -260,6 +293,49 @@ class GroupTests(TestCase):
         group.remove_member(user.userprofile)
         ok_(not group.has_member(user.userprofile))
 
+    def test_get_common_skills(self):
+        group = GroupFactory.create()
+        user_1 = UserFactory.create()
+        user_2 = UserFactory.create()
+        user_3 = UserFactory.create()
+        for user in [user_1, user_2, user_3]:
+            group.add_member(user.userprofile)
+        pending = UserFactory.create()
+        group.add_member(pending.userprofile, GroupMembership.PENDING)
+
+        skill_1 = SkillFactory.create(name='aaa')
+        skill_2 = SkillFactory.create(name='bbb')
+        skill_3 = SkillFactory.create(name='ccc')
+        skill_4 = SkillFactory.create(name='ddd')
+        user_1.userprofile.skills.add(skill_1, skill_2, skill_3, skill_4)
+        user_2.userprofile.skills.add(skill_2, skill_3)
+        user_3.userprofile.skills.add(skill_3)
+        pending.userprofile.skills.add(skill_4)
+
+        eq_(group.get_common_skills(), [skill_3, skill_2])
+
+    def test_get_common_skills_invalidation(self):
+        group = GroupFactory.create()
+        user_1 = UserFactory.create()
+        user_2 = UserFactory.create()
+        group.add_member(user_1.userprofile)
+        skill = SkillFactory.create()
+        user_1.userprofile.skills.add(skill)
+        user_2.userprofile.skills.add(skill)
+        eq_(group.get_common_skills(), [])
+
+        group.add_member(user_2.userprofile)
+        eq_(group.get_common_skills(), [skill])
+
+        user_2.userprofile.skills.remove(skill)
+        eq_(group.get_common_skills(), [])
+
+        skill.members.add(user_2.userprofile)
+        eq_(group.get_common_skills(), [skill])
+
+        group.remove_member(user_1.userprofile)
+        eq_(group.get_common_skills(), [])
+
 
 class GroupAliasBaseTests(TestCase):
     def test_auto_slug_field(self):
@@ -282,3 +358,56 @@ class GroupAliasBaseTests(TestCase):
         # throwing it away
         group = GroupFactory.create(name=u'A (ñâme)-with_ελλάδα "s0me" \'screwy\' chars')
         eq_(u'a-name-with_ellada-s0me-screwy-chars', group.url)
+
+
+class GroupMemberCountTests(TestCase):
+    def test_add_and_remove_member(self):
+        group = GroupFactory.create()
+        vouched = UserFactory.create()
+        unvouched = UserFactory.create(vouched=False)
+        group.add_member(vouched.userprofile)
+        group.add_member(unvouched.userprofile, status=GroupMembership.PENDING)
+        group = Group.objects.get(pk=group.pk)
+        eq_(group.member_count, 2)
+        eq_(group.vouched_member_count, 1)
+
+        group.remove_member(vouched.userprofile)
+        group = Group.objects.get(pk=group.pk)
+        eq_(group.member_count, 1)
+        eq_(group.vouched_member_count, 0)
+
+    def test_remove_member_drifted_count(self):
+        group = GroupFactory.create()
+        user_1 = UserFactory.create()
+        user_2 = UserFactory.create()
+        group.add_member(user_1.userprofile)
+        group.add_member(user_2.userprofile)
+        Group.objects.filter(pk=group.pk).update(vouched_member_count=0)
+
+        group.remove_member(user_1.userprofile)
+        group = Group.objects.get(pk=group.pk)
+        eq_(group.member_count, 1)
+        eq_(group.vouched_member_count, 1)
+
+    def test_vouching_member(self):
+        group = GroupFactory.create()
+        skill = SkillFactory.create()
+        user = UserFactory.create(vouched=False)
+        group.add_member(user.userprofile)
+        skill.add_member(user.userprofile)
+        eq_(Group.objects.get(pk=group.pk).vouched_member_count, 0)
+
+        user.userprofile.vouch(None)
+        eq_(Group.objects.get(pk=group.pk).vouched_member_count, 1)
+        eq_(Skill.objects.get(pk=skill.pk).vouched_member_count, 1)
+
+        user.userprofile.vouches_received.all().delete()
+        eq_(Group.objects.get(pk=group.pk).vouched_member_count, 0)
+        eq_(Skill.objects.get(pk=skill.pk).vouched_member_count, 0)
+
+    def test_member_deleted(self):
+        group = GroupFactory.create()
+        user = UserFactory.create()
+        group.add_member(user.userprofile)
+        user.userprofile.delete()
+        eq_(Group.objects.get(pk=group.pk).member_count, 0)
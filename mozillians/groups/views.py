@@ -1,7 +1,5 @@
 import json
 
-from collections import defaultdict
-
 from django.conf import settings
 from django.contrib import messages
 from django.core.paginator import EmptyPage, Paginator, PageNotAnInteger
@@ -61,7 +59,7 @@ def index_groups(request):
 
 def index_skills(request):
     """Lists all public skills (in use) on Mozillians."""
-    query = Skill.objects.filter(members__is_vouched=True)
+    query = Skill.objects.filter(vouched_member_count__gt=0)
     template = 'groups/index_skills.html'
     return _list_groups(request, template, query)
 
@@ -145,19 +143,7 @@ def show(request, url, alias_model, template):
 
         # Find the most common skills of the group members.
         # Order by popularity in the group.
-        shared_skill_ids = (group.members.filter(groupmembership__status=GroupMembership.MEMBER)
-                            .values_list('skills', flat=True))
-
-        count_skills = defaultdict(int)
-        for skill_id in shared_skill_ids:
-            count_skills[skill_id] += 1
-        common_skills_ids = [k for k, v in sorted(count_skills.items(),
-                                                  key=lambda x: x[1],
-                                                  reverse=True)
-                             if count_skills[k] > 1]
-
-        # Translate ids to Skills preserving order.
-        skills = [Skill.objects.get(id=skill_id) for skill_id in common_skills_ids if skill_id]
+        skills = group.get_common_skills()
 
         data.update(skills=skills, membership_filter_form=membership_filter_form)
 
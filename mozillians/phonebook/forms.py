@@ -19,6 +19,7 @@ from mozillians.phonebook.validators import validate_username
 from mozillians.phonebook.widgets import MonthYearWidget
 from mozillians.users import get_languages_for_locale
 from mozillians.users.models import ExternalAccount, Language, UserProfile
+from mozillians.users.tasks import reverse_geocode_profile
 
 
 REGEX_NUMERIC = re.compile('\d+', re.IGNORECASE)
@@ -102,6 +103,31 @@ class SearchFilter(django_filters.FilterSet):
         super(SearchFilter, self).__init__(*args, **kwargs)
         self.filters['timezone'].field.choices.insert(0, ('', _lazy(u'All timezones')))
 
+    def get_es_filters(self):
+        """Return the selected criteria as filters on indexed fields.
+
+        Like qs, invalid values are ignored.
+
+        """
+        values = {}
+        for name in self.filters:
+            try:
+                values[name] = self.form.fields[name].clean(self.form[name].data)
+            except forms.ValidationError:
+                pass
+
+        es_filters = {}
+        if values.get('vouched') == self.CHOICE_ONLY_VOUCHED:
+            es_filters['is_vouched'] = True
+        elif values.get('vouched') == self.CHOICE_ONLY_UNVOUCHED:
+            es_filters['is_vouched'] = False
+        for name in ['groups', 'skills']:
+            if values.get(name):
+                es_filters['%s_ids__in' % name[:-1]] = [obj.id for obj in values[name]]
+        if values.get('timezone'):
+            es_filters['timezone'] = values['timezone']
+        return es_filters
+
 
 class UserForm(happyforms.ModelForm):
     """Instead of just inhereting form a UserProfile model form, this
@@ -164,6 +190,8 @@ class ProfileForm(happyforms.ModelForm):
     saveregion = forms.BooleanField(label=_lazy('Save'), required=False, show_hidden_initial=True)
     savecity = forms.BooleanField(label=_lazy('Save'), required=False, show_hidden_initial=True)
 
+    geocode_later = False
+
     class Meta:
         model = UserProfile
         fields = ('full_name', 'ircname', 'bio', 'photo',
@@ -219,8 +247,11 @@ class ProfileForm(happyforms.ModelForm):
                 'saveregion' in self.changed_data or 'savecity' in self.changed_data):
                 self.instance.lat = self.cleaned_data['lat']
                 self.instance.lng = self.cleaned_data['lng']
-                self.instance.reverse_geocode()
-                if not self.instance.geo_country:
+                self.instance.geo_outside_country = False
+                # Locations that need Mapbox are resolved after saving,
+                # by reverse_geocode_profile.
+                self.geocode_later = not self.instance.reverse_geocode(remote=False)
+                if not self.geocode_later and not self.instance.geo_country:
                     error_msg = _('Location must be inside a country.')
                     self.errors['savecountry'] = self.error_class([error_msg])
                     del self.cleaned_data['savecountry']
@@ -245,6 +276,10 @@ class ProfileForm(happyforms.ModelForm):
         """Save the data to profile."""
         self.instance.set_membership(Skill, self.cleaned_data['skills'])
         super(ProfileForm, self).save(*args, **kwargs)
+        if self.geocode_later:
+            reverse_geocode_profile.delay(self.instance.id, self.instance.lat, self.instance.lng,
+                                          save_region=bool(self.cleaned_data.get('saveregion')),
+                                          save_city=bool(self.cleaned_data.get('savecity')))
 
 
 class BaseLanguageFormSet(BaseInlineFormSet):
@@ -6,7 +6,9 @@ from nose.tools import eq_, ok_
 
 from mozillians.common.tests import TestCase
 from mozillians.groups.models import Skill
-from mozillians.phonebook.forms import EmailForm, ExternalAccountForm, ProfileForm
+from mozillians.groups.tests import GroupFactory, SkillFactory
+from mozillians.phonebook.forms import (EmailForm, ExternalAccountForm, ProfileForm,
+                                        SearchFilter)
 from mozillians.users.tests import UserFactory
 
 
@@ -120,3 +122,27 @@ class ExternalAccountFormTests(TestCase):
                                         'privacy': 3})
             form.is_valid()
         ok_('identifier' in form.errors)
+
+
+class SearchFilterTests(TestCase):
+    def test_get_es_filters(self):
+        group = GroupFactory.create()
+        skill = SkillFactory.create()
+        data = {'vouched': SearchFilter.CHOICE_ONLY_UNVOUCHED,
+                'groups': [group.id],
+                'skills': [skill.id],
+                'timezone': 'Europe/Athens'}
+        filtr = SearchFilter(data)
+        eq_(filtr.get_es_filters(), {'is_vouched': False,
+                                     'group_ids__in': [group.id],
+                                     'skill_ids__in': [skill.id],
+                                     'timezone': 'Europe/Athens'})
+
+    def test_get_es_filters_empty(self):
+        filtr = SearchFilter({'vouched': SearchFilter.CHOICE_ALL})
+        eq_(filtr.get_es_filters(), {})
+
+    def test_get_es_filters_invalid(self):
+        filtr = SearchFilter({'vouched': SearchFilter.CHOICE_ONLY_VOUCHED,
+                              'groups': ['foo']})
+        eq_(filtr.get_es_filters(), {'is_vouched': True})
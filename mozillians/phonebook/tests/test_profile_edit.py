@@ -11,6 +11,7 @@ from mozillians.phonebook.forms import ProfileForm
 from mozillians.phonebook.tests import _get_privacy_fields
 from mozillians.users.managers import MOZILLIANS
 from mozillians.users.models import UserProfile
+from mozillians.users.tasks import reverse_geocode_profile
 from mozillians.users.tests import UserFactory
 
 
@@ -113,9 +114,9 @@ class LocationEditTests(TestCase):
         self.region = RegionFactory.create(country=self.country, mapbox_id='reg1', name='Ontario')
         self.city = CityFactory.create(region=self.region, mapbox_id='city1', name='Toronto')
 
-    @patch('mozillians.geo.lookup.reverse_geocode')
-    def test_location_city_region_optout(self, mock_reverse_geocode):
-        mock_reverse_geocode.return_value = (self.country, self.region, self.city)
+    @patch('mozillians.geo.lookup.get_cached_location')
+    def test_location_city_region_optout(self, mock_get_cached_location):
+        mock_get_cached_location.return_value = (self.country, self.region, self.city)
         self.data.update(_get_privacy_fields(MOZILLIANS))
 
         form = ProfileForm(data=self.data)
@@ -124,9 +125,9 @@ class LocationEditTests(TestCase):
         eq_(form.instance.geo_region, None)
         eq_(form.instance.geo_city, None)
 
-    @patch('mozillians.geo.lookup.reverse_geocode')
-    def test_location_api_called_when_latlng_changed(self, mock_reverse_geocode):
-        mock_reverse_geocode.return_value = (self.country, self.region, self.city)
+    @patch('mozillians.geo.lookup.get_cached_location')
+    def test_location_lookup_when_latlng_changed(self, mock_get_cached_location):
+        mock_get_cached_location.return_value = (self.country, self.region, self.city)
         self.data['lat'] = 40
         self.data['lng'] = 20
         self.data.update(_get_privacy_fields(MOZILLIANS))
@@ -137,11 +138,11 @@ class LocationEditTests(TestCase):
 
         form = ProfileForm(data=self.data, initial=initial)
         ok_(form.is_valid())
-        ok_(mock_reverse_geocode.called)
+        ok_(mock_get_cached_location.called)
 
-    @patch('mozillians.geo.lookup.reverse_geocode')
-    def test_location_api_not_called_when_latlang_unchanged(self, mock_reverse_geocode):
-        mock_reverse_geocode.return_value = (self.country, self.region, self.city)
+    @patch('mozillians.geo.lookup.get_cached_location')
+    def test_location_no_lookup_when_latlang_unchanged(self, mock_get_cached_location):
+        mock_get_cached_location.return_value = (self.country, self.region, self.city)
         self.data['lng'] = self.user.userprofile.lng
         self.data['lat'] = self.user.userprofile.lat
         self.data.update(_get_privacy_fields(MOZILLIANS))
@@ -152,11 +153,11 @@ class LocationEditTests(TestCase):
 
         form = ProfileForm(data=self.data, initial=initial)
         ok_(form.is_valid())
-        ok_(not mock_reverse_geocode.called)
+        ok_(not mock_get_cached_location.called)
 
-    @patch('mozillians.geo.lookup.reverse_geocode')
-    def test_location_region_required_if_city(self, mock_reverse_geocode):
-        mock_reverse_geocode.return_value = (self.country, self.region, self.city)
+    @patch('mozillians.geo.lookup.get_cached_location')
+    def test_location_region_required_if_city(self, mock_get_cached_location):
+        mock_get_cached_location.return_value = (self.country, self.region, self.city)
         self.data.update({'savecity': True})
         self.data.update(_get_privacy_fields(MOZILLIANS))
 
@@ -176,3 +177,42 @@ class LocationEditTests(TestCase):
         userprofile = UserProfile.objects.get(user=self.user)
         eq_(response.status_code, 200)
         eq_(userprofile.geo_country, error_country)
+
+    @patch('mozillians.phonebook.forms.reverse_geocode_profile.delay')
+    @patch('mozillians.geo.lookup.get_cached_location')
+    def test_location_geocoded_after_save(self, mock_get_cached_location, mock_geocode_delay):
+        mock_get_cached_location.return_value = None
+        self.data.update({'saveregion': True})
+        self.data.update(_get_privacy_fields(MOZILLIANS))
+        url = reverse('phonebook:profile_edit', prefix='/en-US/')
+
+        with self.login(self.user) as client:
+            response = client.post(url, data=self.data, follow=True)
+        eq_(response.status_code, 200)
+        userprofile = UserProfile.objects.get(user=self.user)
+        eq_(userprofile.lat, 40.005814)
+        eq_(userprofile.geo_country, None)
+        mock_geocode_delay.assert_called_with(userprofile.id, 40.005814, -3.42071,
+                                              save_region=True, save_city=False)
+
+    @patch('mozillians.geo.lookup.reverse_geocode')
+    @patch('mozillians.phonebook.forms.reverse_geocode_profile.delay')
+    @patch('mozillians.geo.lookup.get_cached_location')
+    def test_location_geocoded_outside_country(self, mock_get_cached_location,
+                                               mock_geocode_delay, mock_reverse_geocode):
+        country = CountryFactory.create()
+        UserProfile.objects.filter(user=self.user).update(geo_country=country)
+        mock_get_cached_location.return_value = None
+        mock_reverse_geocode.return_value = (None, None, None)
+        self.data.update(_get_privacy_fields(MOZILLIANS))
+        url = reverse('phonebook:profile_edit', prefix='/en-US/')
+
+        with self.login(self.user) as client:
+            client.post(url, data=self.data, follow=True)
+            reverse_geocode_profile(*mock_geocode_delay.call_args[0],
+                                    **mock_geocode_delay.call_args[1])
+            response = client.get(url, follow=True)
+        userprofile = UserProfile.objects.get(user=self.user)
+        eq_(userprofile.geo_country, country)
+        ok_(userprofile.geo_outside_country)
+        ok_('not inside a country' in response.content)
@@ -7,6 +7,7 @@ from mozillians.geo.tests import CountryFactory, RegionFactory, CityFactory
 from nose.tools import eq_
 
 from mozillians.common.tests import TestCase, requires_login, requires_vouch
+from mozillians.users.models import LocationCount
 from mozillians.users.tests import UserFactory
 
 
@@ -195,3 +196,28 @@ class ListTests(TestCase):
         eq_(response.context['city_name'], None)
         eq_(response.context['region_name'], None)
         eq_(response.context['people'].paginator.count, 0)
+
+    def test_list_mozillians_in_location_slug(self):
+        country = CountryFactory.create(name='Foo Bar')
+        user_listed = UserFactory.create(userprofile={'geo_country': country})
+        user = UserFactory.create()
+        with self.login(user) as client:
+            url = reverse('phonebook:list_country', kwargs={'country': 'foo  BAR'})
+            response = client.get(url, follow=True)
+        eq_(response.status_code, 200)
+        eq_(response.context['country_name'], 'foo  BAR')
+        eq_(response.context['people'].paginator.count, 1)
+        eq_(response.context['people'].object_list[0], user_listed.userprofile)
+
+    @patch('mozillians.groups.views.settings.ITEMS_PER_PAGE', 1)
+    def test_list_mozillians_in_location_stored_count(self):
+        country = CountryFactory.create()
+        UserFactory.create(userprofile={'geo_country': country})
+        LocationCount.objects.filter(country=country).update(vouched_count=3)
+        user = UserFactory.create()
+        with self.login(user) as client:
+            url = reverse('phonebook:list_country', kwargs={'country': country.name})
+            response = client.get(url, follow=True)
+        eq_(response.status_code, 200)
+        eq_(response.context['people'].paginator.count, 3)
+        eq_(response.context['people'].paginator.num_pages, 3)
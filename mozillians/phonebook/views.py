@@ -4,6 +4,7 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db.models import Sum
 from django.http import Http404
 from django.shortcuts import get_object_or_404, render
 from django.utils import timezone
@@ -18,12 +19,16 @@ import mozillians.phonebook.forms as forms
 from mozillians.common.decorators import allow_public, allow_unvouched
 from mozillians.common.helpers import redirect
 from mozillians.common.middleware import LOGIN_MESSAGE, GET_VOUCHED_MESSAGE
+from mozillians.geo.models import location_slug
 from mozillians.groups.helpers import stringify_groups
 from mozillians.groups.models import Group
 from mozillians.phonebook.models import Invite
 from mozillians.phonebook.utils import redeem_invite
-from mozillians.users.managers import EMPLOYEES, MOZILLIANS, PUBLIC, PRIVILEGED
-from mozillians.users.models import ExternalAccount, UserProfile, UserProfileMappingType
+from mozillians.users.es import SearchPage
+from mozillians.users.managers import (EMPLOYEES, MOZILLIANS, PUBLIC, PRIVILEGED,
+                                       CountedQuerySet)
+from mozillians.users.models import (ExternalAccount, LocationCount, UserProfile,
+                                     UserProfileMappingType)
 
 
 @allow_unvouched
@@ -275,7 +280,7 @@ def search(request):
         if not public:
             groups = Group.search(query)
 
-        paginator = Paginator(profiles, limit)
+        paginator = Paginator(SearchPage(profiles, page, limit), limit)
 
         try:
             people = paginator.page(page)
@@ -284,7 +289,7 @@ def search(request):
         except EmptyPage:
             people = paginator.page(paginator.num_pages)
 
-        if profiles.count() == 1 and not groups:
+        if paginator.count == 1 and not groups:
             return redirect('phonebook:profile_view', people[0].user.username)
 
         show_pagination = paginator.count > settings.ITEMS_PER_PAGE
@@ -304,10 +309,10 @@ def betasearch(request):
     """This view is for researching new search and data filtering
     options. It will eventually replace the 'search' view.
 
-    Filtering using SearchFilter does not respect privacy levels
-    because it directly hits the db. This should be further
-    investigated before the feature is released to the
-    public. Meanwhile we limit searches only to vouched users.
+    SearchFilter criteria are applied as Elasticsearch filters on
+    the indexed groups, skills, timezone and vouched status. Those
+    fields are indexed only when visible to MOZILLIANS, or to PUBLIC
+    in the public index, so filters never reveal restricted values.
 
     This view is behind the 'betasearch' waffle flag.
 
@@ -325,13 +330,14 @@ def betasearch(request):
         public = not (request.user.is_authenticated()
                       and request.user.userprofile.is_vouched)
 
-        profiles_matching_filter = list(filtr.qs.values_list('id', flat=True))
         profiles = UserProfileMappingType.search(query,
                                                  include_non_vouched=True,
                                                  public=public)
-        profiles = profiles.filter(id__in=profiles_matching_filter)
+        es_filters = filtr.get_es_filters()
+        if es_filters:
+            profiles = profiles.filter(**es_filters)
 
-        paginator = Paginator(profiles, limit)
+        paginator = Paginator(SearchPage(profiles, page, limit), limit)
 
         try:
             people = paginator.page(page)
@@ -401,15 +407,21 @@ def delete_invite(request, invite_pk):
 
 
 def list_mozillians_in_location(request, country, region=None, city=None):
-    queryset = UserProfile.objects.vouched().filter(geo_country__name__iexact=country)
-    show_pagination = False
-
+    # Locations are matched on their indexed slugs and the number of
+    # profiles comes from LocationCount instead of a COUNT query.
+    lookup = {'country__slug': location_slug(country)}
     if city:
-        queryset = queryset.filter(geo_city__name__iexact=city)
+        lookup['city__slug'] = location_slug(city)
     if region:
-        queryset = queryset.filter(geo_region__name__iexact=region)
+        lookup['region__slug'] = location_slug(region)
+    show_pagination = False
+
+    count = (LocationCount.objects.filter(**lookup)
+             .aggregate(count=Sum('vouched_count'))['count'] or 0)
+    queryset = UserProfile.objects.vouched().filter(
+        **dict(('geo_' + key, value) for key, value in lookup.items()))
 
-    paginator = Paginator(queryset, settings.ITEMS_PER_PAGE)
+    paginator = Paginator(CountedQuerySet(queryset, count), settings.ITEMS_PER_PAGE)
     page = request.GET.get('page', 1)
 
     try:
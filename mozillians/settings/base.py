@@ -104,6 +104,8 @@ MIDDLEWARE_CLASSES = get_middleware(append=[
     'mozillians.phonebook.middleware.RegisterMiddleware',
     'mozillians.phonebook.middleware.UsernameRedirectionMiddleware',
     'mozillians.groups.middleware.OldGroupRedirectionMiddleware',
+    'mozillians.users.middleware.SearchIndexQueueMiddleware',
+    'mozillians.users.middleware.PrivacyClearanceMiddleware',
 
     'waffle.middleware.WaffleMiddleware',
 ])
@@ -188,6 +190,23 @@ MAX_PHOTO_UPLOAD_SIZE = 8 * (1024 ** 2)
 AUTO_VOUCH_DOMAINS = ('mozilla.com', 'mozilla.org', 'mozillafoundation.org')
 AUTO_VOUCH_REASON = 'An automatic vouch for being a Mozilla employee.'
 
+# Seconds to cache whether a user is a manager or staff.
+PRIVACY_CLEARANCE_TIMEOUT = 300
+
+# Seconds to cache API list responses. They are also expired when the
+# listed profiles or groups change.
+API_RESPONSE_CACHE_TIMEOUT = 600
+# Seconds to cache API apps in memcached and in process memory. Changes
+# to apps reach other processes only after the latter.
+API_APP_CACHE_TIMEOUT = 3600
+API_APP_LOCAL_CACHE_TIMEOUT = 30
+# Maximum number of nearest profiles the near and bbox filters of the
+# users API return.
+API_GEO_SEARCH_LIMIT = 1000
+
+# Seconds to cache the most common skills of the members of a group.
+COMMON_SKILLS_CACHE_TIMEOUT = 60 * 60
+
 SOUTH_TESTS_MIGRATE = False
 
 # Django-CSP
@@ -236,6 +255,13 @@ ES_URLS = ['http://127.0.0.1:9200']
 ES_INDEXES = {'default': 'mozillians',
               'public': 'mozillians-public'}
 ES_INDEXING_TIMEOUT = 10
+# Index settings restored after a full rebuild of the indexes. The
+# values of the replaced indexes are kept, these are only used when
+# there is no index to copy them from.
+ES_INDEX_SETTINGS = {'refresh_interval': '1s',
+                     'number_of_replicas': 1}
+# Seconds to wait before sending queued profile updates to the indexes.
+ES_INDEX_QUEUE_DELAY = 5
 
 # Sorl settings
 THUMBNAIL_DUMMY = True
@@ -305,6 +331,17 @@ HUMANSTXT_URL = urljoin(STATIC_URL, 'humans.txt')
 MAPBOX_MAP_ID = 'examples.map-i86nkdio'
 # This is the token for the edit profile page alone.
 MAPBOX_PROFILE_ID = MAPBOX_MAP_ID
+# Reverse geocoding endpoint, formatted with the map id and the query.
+MAPBOX_GEOCODE_URL = 'http://api.tiles.mapbox.com/v3/%s/geocode/%s.json'
+
+# Points within this many kilometres of a known city are reverse
+# geocoded locally, without calling Mapbox. Keep it well below the
+# distance between neighbouring towns. Set to 0 to always call Mapbox.
+GEO_LOCAL_LOOKUP_RADIUS = 2
+# Seconds before the in-memory grid of cities is rebuilt.
+GEO_INDEX_TIMEOUT = 60 * 60
+# Seconds Mapbox results are cached for.
+GEOCODE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
 
 
 def _browserid_request_args():
@@ -9,24 +9,46 @@ from funfactory import utils
 from tastypie import fields, http
 from tastypie.authorization import ReadOnlyAuthorization
 from tastypie.bundle import Bundle
-from tastypie.exceptions import ImmediateHttpResponse
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
 from tastypie.resources import ModelResource
 from tastypie.serializers import Serializer
 
 from mozillians.api.authenticators import AppAuthentication
 from mozillians.api.paginator import Paginator
 from mozillians.api.resources import (ClientCacheResourceMixIn,
-                                      GraphiteMixIn)
+                                      GraphiteMixIn,
+                                      ResponseCacheResourceMixIn)
+from mozillians.users.es import UserProfileMappingType
 from mozillians.users.models import UserProfile
 
 
-class UserResource(ClientCacheResourceMixIn, GraphiteMixIn, ModelResource):
+def _parse_coordinates(request, name, bounds):
+    """Return the comma separated floats of the `name` parameter of
+    request, or None if it's missing.
+
+    Raises BadRequest unless there's one float within each of the
+    (min, max) `bounds`.
+    """
+    value = request.GET.get(name)
+    if value is None:
+        return None
+    try:
+        floats = tuple(float(x) for x in value.split(','))
+    except ValueError:
+        floats = ()
+    if (len(floats) != len(bounds)
+            or any(not low <= x <= high for x, (low, high) in zip(floats, bounds))):
+        raise BadRequest('Invalid %s provided.' % name)
+    return floats
+
+
+class UserResource(ResponseCacheResourceMixIn, ClientCacheResourceMixIn,
+                   GraphiteMixIn, ModelResource):
     """User Resource."""
     email = fields.CharField(attribute='user__email', null=True, readonly=True)
     username = fields.CharField(attribute='user__username', null=True, readonly=True)
-    vouched_by = fields.IntegerField(attribute='vouched_by__id',
-                                     null=True, readonly=True)
-    date_vouched = fields.DateTimeField(attribute='date_vouched', null=True, readonly=True)
+    vouched_by = fields.IntegerField(null=True, readonly=True)
+    date_vouched = fields.DateTimeField(null=True, readonly=True)
 
     groups = fields.CharField()
     skills = fields.CharField()
@@ -117,22 +139,41 @@ class UserResource(ClientCacheResourceMixIn, GraphiteMixIn, ModelResource):
             bundle = Bundle(obj=bundle.obj, data=data, request=bundle.request)
         return bundle
 
+    def _vouches_by_date(self, bundle):
+        """Return the vouches of the profile, oldest first.
+
+        Works from the prefetched vouches of list requests.
+        """
+        vouches = bundle.obj.vouches_received.all()
+        return sorted(vouches, key=lambda vouch: (vouch.date is not None, vouch.date))
+
+    def dehydrate_vouched_by(self, bundle):
+        for vouch in self._vouches_by_date(bundle):
+            if vouch.voucher_id:
+                return vouch.voucher_id
+        return None
+
+    def dehydrate_date_vouched(self, bundle):
+        vouches = self._vouches_by_date(bundle)
+        if vouches:
+            return vouches[0].date
+        return None
+
     def dehydrate_accounts(self, bundle):
         accounts = [{'identifier': a.identifier, 'type': a.type}
                     for a in bundle.obj.externalaccount_set.all()]
         return accounts
 
     def dehydrate_groups(self, bundle):
-        groups = bundle.obj.groups.values_list('name', flat=True)
-        return list(groups)
+        return [group.name for group in bundle.obj.groups.all()]
 
     def dehydrate_skills(self, bundle):
-        skills = bundle.obj.skills.values_list('name', flat=True)
-        return list(skills)
+        return [skill.name for skill in bundle.obj.skills.all()]
 
     def dehydrate_languages(self, bundle):
-        languages = bundle.obj.languages.values_list('code', flat=True)
-        return list(languages)
+        # languages is the prefetched queryset, all() would clone it and
+        # query again.
+        return [language.code for language in bundle.obj.languages]
 
     def dehydrate_photo(self, bundle):
         if bundle.obj.photo:
@@ -153,17 +194,67 @@ class UserResource(ClientCacheResourceMixIn, GraphiteMixIn, ModelResource):
 
         return super(UserResource, self).get_detail(request, **kwargs)
 
+    def get_nearby_ids(self, request):
+        """Return the ids of the profiles matching the 'near' and
+        'radius' or 'bbox' parameters of request, nearest first, or
+        None if neither 'near' nor 'bbox' is given.
+
+        Raises BadRequest for a 'radius' without 'near', a 'bbox'
+        whose south is above its north, or an 'after' cursor, which
+        would lose the distance ordering.
+
+        Profiles are found by their city in the search index, up to
+        API_GEO_SEARCH_LIMIT of them.
+        """
+        near = _parse_coordinates(request, 'near', [(-90, 90), (-180, 180)])
+        radius = _parse_coordinates(request, 'radius', [(0, 20040)])
+        bbox = _parse_coordinates(request, 'bbox',
+                                  [(-90, 90), (-180, 180), (-90, 90), (-180, 180)])
+        if radius and not near:
+            raise BadRequest('Invalid radius provided. Please provide near as well.')
+        if bbox and bbox[0] > bbox[2]:
+            raise BadRequest('Invalid bbox provided. South must not be above north.')
+        if not near and not bbox:
+            return None
+        if 'after' in request.GET:
+            # Cursor pages are ordered by id, not by distance.
+            raise BadRequest('Invalid after provided. Please use offset with near or bbox.')
+
+        search = (UserProfileMappingType.search(u'', include_non_vouched=True, near=near,
+                                                radius=radius and radius[0], bbox=bbox)
+                  .values_list('id')[:settings.API_GEO_SEARCH_LIMIT])
+        # Only the id field of the hits is fetched, each value comes
+        # back as a list.
+        return [result[0][0] for result in search.execute()]
+
     def apply_filters(self, request, applicable_filters):
         if (request.GET.get('restricted', False)
-            and 'email' not in applicable_filters
-            and len(applicable_filters) != 1):
+            and (('email' not in applicable_filters and len(applicable_filters) != 1)
+                 or 'near' in request.GET or 'bbox' in request.GET)):
             raise ImmediateHttpResponse(response=http.HttpForbidden())
 
         mega_filter = Q()
         for db_filter in applicable_filters.values():
             mega_filter &= db_filter
 
+        nearby_ids = self.get_nearby_ids(request)
+        if nearby_ids is not None:
+            mega_filter &= Q(id__in=nearby_ids)
+
         if request.GET.get('restricted', False):
             mega_filter &= Q(allows_community_sites=True)
 
-        return UserProfile.objects.complete().filter(mega_filter).distinct().order_by('id')
+        # Load the relations of the whole page in bulk instead of
+        # querying them for every profile while dehydrating.
+        profiles = (UserProfile.objects.complete().filter(mega_filter).distinct().order_by('id')
+                    .select_related('user', 'geo_country', 'geo_region', 'geo_city')
+                    .prefetch_related('groups', 'skills', 'language_set',
+                                      'externalaccount_set', 'vouches_received'))
+        if nearby_ids:
+            # Keep the order of the search results, nearest first.
+            ordering = ' '.join('WHEN %d THEN %d' % (pk, i) for i, pk in enumerate(nearby_ids))
+            profiles = profiles.extra(
+                select={'distance_rank': 'CASE %s.id %s END' % (UserProfile._meta.db_table,
+                                                                ordering)},
+                order_by=['distance_rank'])
+        return profiles
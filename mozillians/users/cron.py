@@ -1,37 +1,62 @@
 from django.conf import settings
+from django.utils import timezone
 
 import cronjobs
 
-from celery.task.sets import TaskSet
+from celery.task import chord
 from celeryutils import chunked
 from elasticutils.contrib.django import get_es
 
-from mozillians.users.tasks import index_objects
+from mozillians.users.tasks import delete_stale_indexes, index_objects, swap_index_aliases
 from mozillians.users.models import UserProfile, UserProfileMappingType
 
 
 @cronjobs.register
 def index_all_profiles():
-    # Get an es object, delete index and re-create it
-    es = get_es(timeout=settings.ES_INDEXING_TIMEOUT)
-    mappings = {'mappings':
-                {UserProfileMappingType.get_mapping_type_name():
-                 UserProfileMappingType.get_mapping()}}
-
-    def _recreate_index(index):
-        es.indices.delete(index=index, ignore=[400, 404])
-        es.indices.create(index, body=mappings)
-
-    _recreate_index(settings.ES_INDEXES['default'])
-    _recreate_index(settings.ES_INDEXES['public'])
+    """Rebuild both search indexes without taking search offline.
 
-    # mozillians index
-    ids = UserProfile.objects.complete().values_list('id', flat=True)
-    ts = [index_objects.subtask(args=[UserProfileMappingType, chunk, 150, False])
-          for chunk in chunked(sorted(list(ids)), 150)]
+    Profiles are indexed into new timestamped indexes while the
+    ES_INDEXES aliases keep pointing to the old ones. Once every chunk
+    is indexed, swap_index_aliases verifies the document counts and
+    moves the aliases over atomically. Indexes left over by failed
+    rebuilds are deleted first.
 
-    # public index
-    ts += [index_objects.subtask(args=[UserProfileMappingType, chunk, 150, True])
-           for chunk in chunked(sorted(list(ids)), 150)]
-
-    TaskSet(ts).apply_async()
+    """
+    es = get_es(timeout=settings.ES_INDEXING_TIMEOUT)
+    delete_stale_indexes(UserProfileMappingType, es)
+
+    # Refreshes and replicas only slow down a rebuild, they are
+    # restored by swap_index_aliases.
+    body = {'mappings':
+            {UserProfileMappingType.get_mapping_type_name():
+             UserProfileMappingType.get_mapping()},
+            'settings': {'index': {'refresh_interval': '-1',
+                                   'number_of_replicas': 0}}}
+    started = timezone.now()
+    suffix = started.strftime('%Y%m%d%H%M%S')
+
+    new_indexes = []
+    for public_index in [False, True]:
+        index = '%s_%s' % (UserProfileMappingType.get_index(public_index), suffix)
+        es.indices.create(index, body=body)
+        new_indexes.append((public_index, index))
+
+    profiles = UserProfile.objects.complete()
+    ids = sorted(list(profiles.values_list('id', flat=True)))
+    max_id = ids[-1] if ids else 0
+    expected = {False: len(ids),
+                True: profiles.filter(id__lte=max_id).public_indexable().count()}
+    total = UserProfile.objects.filter(id__lte=max_id).count()
+    callback = swap_index_aliases.subtask(args=[UserProfileMappingType, new_indexes,
+                                                max_id, started, expected, total])
+    if not ids:
+        callback.apply_async()
+        return
+
+    ts = []
+    for public_index, index in new_indexes:
+        ts += [index_objects.subtask(args=[UserProfileMappingType, chunk, 150, public_index],
+                                     kwargs={'index': index, 'refresh': False})
+               for chunk in chunked(ids, 150)]
+
+    chord(ts)(callback)
@@ -1,13 +1,44 @@
+import threading
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import get_model
+from django.db.models.query import QuerySet
 
 from elasticsearch import TransportError
 from elasticsearch.exceptions import NotFoundError
 from elasticutils.contrib.django import Indexable, MappingType, S, get_es
+from funfactory.urlresolvers import reverse
+from sorl.thumbnail import get_thumbnail
 
+from mozillians.common.helpers import gravatar
 from mozillians.phonebook.helpers import langcode_to_name
 from mozillians.users.managers import MOZILLIANS, PUBLIC
+from mozillians.users.tasks import INDEX_QUEUE_KEY, update_search_indexes
 
 ES_MAPPING_TYPE_NAME = 'user-profile'
+# Profile fields stored in documents to render search results.
+DISPLAY_FIELDS = ('full_name', 'email', 'ircname', 'photo')
+
+ResultUser = namedtuple('ResultUser', ['username'])
+
+
+def _is_visible(obj, field):
+    """Return True if field of obj is visible at obj's privacy level."""
+    privacy_level = obj._privacy_level
+    return not privacy_level or getattr(obj, 'privacy_%s' % field) >= privacy_level
+
+
+def _is_filterable(obj, field):
+    """Return True if field of obj may be filtered on.
+
+    Search filters are open to every vouched user, so in the default
+    index they only see values visible to MOZILLIANS.
+    """
+    privacy_level = obj._privacy_level or MOZILLIANS
+    return getattr(obj, 'privacy_%s' % field) >= privacy_level
 
 
 class PrivacyAwareS(S):
@@ -17,6 +48,24 @@ class PrivacyAwareS(S):
         self._privacy_level = level
         return self
 
+    def process_filter_radius(self, key, val, action):
+        """Filter on documents within val[2] kilometres of the
+        (val[0], val[1]) latitude and longitude.
+
+        """
+        lat, lng, radius = val
+        return {'geo_distance': {'distance': '%fkm' % radius,
+                                 key: {'lat': lat, 'lon': lng}}}
+
+    def process_filter_bbox(self, key, val, action):
+        """Filter on documents within the (south, west, north, east)
+        bounding box val.
+
+        """
+        south, west, north, east = val
+        return {'geo_bounding_box': {key: {'top_left': {'lat': north, 'lon': west},
+                                           'bottom_right': {'lat': south, 'lon': east}}}}
+
     def _clone(self, *args, **kwargs):
         new = super(PrivacyAwareS, self)._clone(*args, **kwargs)
         new._privacy_level = getattr(self, '_privacy_level', None)
@@ -28,11 +77,112 @@ class PrivacyAwareS(S):
         def _generator():
             while True:
                 obj = self._iterator.next()
-                obj._privacy_level = getattr(self, '_privacy_level', None)
-                yield obj.get_object()
+                privacy_level = getattr(self, '_privacy_level', None)
+                if 'display' in obj._results_dict:
+                    yield PrivacyAwareResult(obj._results_dict, privacy_level)
+                else:
+                    # Document indexed without display fields.
+                    profile = obj.get_object()
+                    profile.set_instance_privacy_level(privacy_level)
+                    yield profile
         return _generator()
 
 
+class SearchPage(object):
+    """Search wrapper for Django's Paginator.
+
+    The hits of page `number` and the total number of hits come from a
+    single Elasticsearch request, made the first time the Paginator
+    asks for the count. Other slices are searched separately.
+
+    """
+
+    def __init__(self, search, number, per_page):
+        try:
+            number = max(int(number), 1)
+        except (TypeError, ValueError):
+            number = 1
+        self.search = search
+        self._start = (number - 1) * per_page
+        self._stop = self._start + per_page
+        self._hits = None
+        self._count = None
+
+    def _fetch(self):
+        if self._hits is None:
+            results = self.search[self._start:self._stop]
+            self._hits = list(results)
+            self._count = results.count()
+
+    def count(self):
+        self._fetch()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        self._fetch()
+        if (isinstance(key, slice) and self._start <= key.start
+                and key.stop <= self._stop):
+            return self._hits[key.start - self._start:key.stop - self._start]
+        return list(self.search[key])
+
+
+class PrivacyAwareResult(object):
+    """Search result built from the display fields of a document.
+
+    Provides the UserProfile attributes used to render search results
+    and hides fields whose privacy is lower than privacy_level, just
+    like UserProfile.__getattribute__ does, without hitting the
+    database.
+
+    """
+
+    def __init__(self, source, privacy_level=None):
+        self.id = self.pk = source['id']
+        self._display = source['display']
+        self._privacy_level = privacy_level
+        self.user = ResultUser(username=self._display['username'])
+
+    def _is_visible(self, field):
+        return (not self._privacy_level
+                or self._display['privacy_%s' % field] >= self._privacy_level)
+
+    def _get(self, field):
+        if self._is_visible(field):
+            return self._display[field]
+        return u''
+
+    @property
+    def full_name(self):
+        return self._get('full_name')
+
+    @property
+    def display_name(self):
+        return self.full_name
+
+    @property
+    def email(self):
+        return self._get('email')
+
+    @property
+    def ircname(self):
+        return self._get('ircname')
+
+    def get_absolute_url(self):
+        return reverse('phonebook:profile_view', args=[self.user.username])
+
+    def get_photo_url(self, geometry='160x160', **kwargs):
+        """Return photo url, same as UserProfile.get_photo_url."""
+        if 'crop' not in kwargs:
+            kwargs['crop'] = 'center'
+        photo = self._get('photo')
+        if not photo and self._is_visible('photo'):
+            return gravatar(self._display['email'], size=geometry)
+        return get_thumbnail(photo or settings.DEFAULT_AVATAR_PATH, geometry, **kwargs).url
+
+
 class UserProfileMappingType(MappingType, Indexable):
 
     @classmethod
@@ -70,14 +220,19 @@ class UserProfileMappingType(MappingType, Indexable):
                 'city': {'type': 'string', 'analyzer': 'whitespace'},
                 'skills': {'type': 'string', 'analyzer': 'whitespace'},
                 'groups': {'type': 'string', 'analyzer': 'whitespace'},
+                'group_ids': {'type': 'integer'},
+                'skill_ids': {'type': 'integer'},
+                'timezone': {'type': 'string', 'index': 'not_analyzed'},
                 'languages': {'type': 'string', 'index': 'not_analyzed'},
                 'bio': {'type': 'string', 'analyzer': 'snowball'},
                 'is_vouched': {'type': 'boolean'},
                 'allows_mozilla_sites': {'type': 'boolean'},
                 'allows_community_sites': {'type': 'boolean'},
                 'photo': {'type': 'boolean'},
+                'geo_point': {'type': 'geo_point'},
                 'last_updated': {'type': 'date'},
-                'date_joined': {'type': 'date'}
+                'date_joined': {'type': 'date'},
+                'display': {'type': 'object', 'enabled': False}
             }
         }
 
@@ -96,10 +251,11 @@ class UserProfileMappingType(MappingType, Indexable):
                  id=id_, overwrite_existing=overwrite_existing)
 
     @classmethod
-    def refresh_index(cls, es=None, public_index=False):
+    def refresh_index(cls, es=None, public_index=False, index=None):
         if es is None:
             es = get_es()
-        index = cls.get_index(public_index)
+        if index is None:
+            index = cls.get_index(public_index)
         if es.indices.exists(index):
             es.indices.refresh(index=index)
 
@@ -121,48 +277,107 @@ class UserProfileMappingType(MappingType, Indexable):
 
         if obj is None:
             obj = cls.get_model().objects.get(pk=obj_id)
-        doc = {}
-
-        attrs = ('id', 'is_vouched', 'ircname',
-                 'allows_mozilla_sites', 'allows_community_sites')
-        for a in attrs:
-            data = getattr(obj, a)
-            if isinstance(data, basestring):
-                data = data.lower()
-            doc.update({a: data})
-
-        doc['country'] = ([obj.geo_country.name, obj.geo_country.code]
-                          if obj.geo_country else None)
-        doc['region'] = obj.geo_region.name if obj.geo_region else None
-        doc['city'] = obj.geo_city.name if obj.geo_city else None
-
-        # user data
-        attrs = ('username', 'email', 'last_login', 'date_joined')
-        for a in attrs:
-            data = getattr(obj.user, a)
-            if isinstance(data, basestring):
-                data = data.lower()
-            doc.update({a: data})
-
-        doc.update(dict(fullname=obj.full_name.lower()))
-        doc.update(dict(name=obj.full_name.lower()))
-        doc.update(dict(bio=obj.bio))
-        doc.update(dict(has_photo=bool(obj.photo)))
-
-        for attribute in ['groups', 'skills']:
-            groups = []
-            for g in getattr(obj, attribute).all():
-                groups.extend(g.aliases.values_list('name', flat=True))
-            doc[attribute] = groups
-        # Add to search index language code, language name in English
-        # native lanugage name.
-        languages = []
-        for code in obj.languages.values_list('code', flat=True):
-            languages.append(code)
-            languages.append(langcode_to_name(code, 'en_US').lower())
-            languages.append(langcode_to_name(code, code).lower())
-        doc['languages'] = list(set(languages))
-        return doc
+        return cls.extract_documents([obj])[0]
+
+    @classmethod
+    def extract_documents(cls, objs):
+        """Extract documents for many profiles at once.
+
+        Related rows are loaded for all profiles with one query per
+        relation, so the number of queries doesn't depend on the
+        number of profiles, groups or skills.
+
+        """
+        if isinstance(objs, QuerySet):
+            objs = objs.select_related('user', 'geo_country', 'geo_region', 'geo_city')
+        objs = list(objs)
+        ids = [obj.id for obj in objs]
+
+        related = {}
+        GroupAlias = get_model('groups', 'GroupAlias')
+        SkillAlias = get_model('groups', 'SkillAlias')
+        Language = get_model('users', 'Language')
+        queries = {
+            'groups': (GroupAlias.objects.filter(alias__members__in=ids)
+                       .order_by('alias__name', 'id')
+                       .values_list('alias__members', 'alias', 'name')),
+            'skills': (SkillAlias.objects.filter(alias__members__in=ids)
+                       .order_by('alias__name', 'id')
+                       .values_list('alias__members', 'alias', 'name')),
+            'languages': (Language.objects.filter(userprofile__in=ids)
+                          .values_list('userprofile', 'code')),
+        }
+        for attribute, query in queries.items():
+            related[attribute] = defaultdict(list)
+            for row in query:
+                related[attribute][row[0]].append(row[1:])
+
+        documents = []
+        for obj in objs:
+            doc = {}
+
+            attrs = ('id', 'is_vouched', 'ircname',
+                     'allows_mozilla_sites', 'allows_community_sites')
+            for a in attrs:
+                data = getattr(obj, a)
+                if isinstance(data, basestring):
+                    data = data.lower()
+                doc.update({a: data})
+
+            doc['country'] = ([obj.geo_country.name, obj.geo_country.code]
+                              if obj.geo_country else None)
+            doc['region'] = obj.geo_region.name if obj.geo_region else None
+            doc['city'] = obj.geo_city.name if obj.geo_city else None
+            # Profiles are placed at their city, not at their exact
+            # coordinates, and only if the city is visible.
+            doc['geo_point'] = ({'lat': obj.geo_city.lat, 'lon': obj.geo_city.lng}
+                                if obj.geo_city else None)
+
+            # user data
+            attrs = ('username', 'email', 'last_login', 'date_joined')
+            for a in attrs:
+                data = getattr(obj.user, a)
+                if isinstance(data, basestring):
+                    data = data.lower()
+                doc.update({a: data})
+
+            doc.update(dict(fullname=obj.full_name.lower()))
+            doc.update(dict(name=obj.full_name.lower()))
+            doc.update(dict(bio=obj.bio))
+            doc.update(dict(has_photo=bool(obj.photo)))
+
+            for attribute in ['groups', 'skills']:
+                groups = []
+                group_ids = []
+                if _is_visible(obj, attribute):
+                    for group_id, name in related[attribute][obj.id]:
+                        groups.append(name)
+                        if group_id not in group_ids:
+                            group_ids.append(group_id)
+                doc[attribute] = groups
+                doc['%s_ids' % attribute[:-1]] = (group_ids if _is_filterable(obj, attribute)
+                                                  else [])
+            doc['timezone'] = obj.timezone if _is_filterable(obj, 'timezone') else u''
+            # Add to search index language code, language name in English
+            # native lanugage name.
+            languages = []
+            if _is_visible(obj, 'languages'):
+                for code, in related['languages'][obj.id]:
+                    languages.append(code)
+                    languages.append(langcode_to_name(code, 'en_US').lower())
+                    languages.append(langcode_to_name(code, code).lower())
+            doc['languages'] = list(set(languages))
+
+            display = {'username': obj.user.username,
+                       'full_name': obj.full_name,
+                       'email': obj.user.email,
+                       'ircname': obj.ircname,
+                       'photo': obj.photo.name if obj.photo else u''}
+            for field in DISPLAY_FIELDS:
+                display['privacy_%s' % field] = getattr(obj, 'privacy_%s' % field)
+            doc['display'] = display
+            documents.append(doc)
+        return documents
 
     @classmethod
     def get_indexable(cls):
@@ -170,8 +385,16 @@ class UserProfileMappingType(MappingType, Indexable):
         return model.objects.order_by('id').values_list('id', flat=True)
 
     @classmethod
-    def search(cls, query, include_non_vouched=False, public=False):
-        """Sensible default search for UserProfiles."""
+    def search(cls, query, include_non_vouched=False, public=False,
+               near=None, radius=None, bbox=None):
+        """Sensible default search for UserProfiles.
+
+        Results can be limited to profiles within `radius` kilometres
+        of `near`, a (lat, lng) tuple, or within `bbox`, a (south,
+        west, north, east) tuple. Results are then sorted by distance
+        from `near`, or from the center of `bbox`.
+
+        """
         query = query.lower().strip()
         fields = ('username', 'bio__match', 'email', 'ircname',
                   'country__match', 'country__match_phrase',
@@ -195,9 +418,97 @@ class UserProfileMappingType(MappingType, Indexable):
                                    fullname__fuzzy=2, bio__match=2)
                       .query(or_=query_dict))
 
-        search = search.order_by('_score', 'name')
+        if near and radius is not None:
+            search = search.filter(geo_point__radius=(near[0], near[1], radius))
+        if bbox:
+            search = search.filter(geo_point__bbox=bbox)
+            if not near:
+                lng = (bbox[1] + bbox[3]) / 2.0
+                if bbox[1] > bbox[3]:
+                    # The box crosses the antimeridian.
+                    lng = lng + 180 if lng <= 0 else lng - 180
+                near = ((bbox[0] + bbox[2]) / 2.0, lng)
+
+        if near:
+            distance = {'_geo_distance': {'geo_point': {'lat': near[0], 'lon': near[1]},
+                                          'order': 'asc', 'unit': 'km'}}
+            search = search.order_by(distance, '_score', 'name')
+        else:
+            search = search.order_by('_score', 'name')
 
         if not include_non_vouched:
             search = search.filter(is_vouched=True)
 
         return search
+
+
+class IndexQueue(threading.local):
+    """Profile ids waiting for a search index update in this thread."""
+
+    def __init__(self):
+        self.depth = 0
+        self.ids = set()
+
+_index_queue = IndexQueue()
+
+
+def queue_index_update(ids):
+    """Queue profiles for a search index update.
+
+    Inside coalesce_index_updates() ids are collected and sent when
+    the outermost block exits, otherwise they are sent right away.
+
+    """
+    _index_queue.ids.update(ids)
+    if not _index_queue.depth:
+        flush_index_queue()
+
+
+def flush_index_queue():
+    """Send queued profile ids to update_search_indexes.
+
+    Profiles already waiting in a scheduled task are skipped, the
+    task reads them from the database only when it runs.
+
+    """
+    ids, _index_queue.ids = _index_queue.ids, set()
+    if getattr(settings, 'ES_DISABLED', False):
+        return
+
+    delay = getattr(settings, 'ES_INDEX_QUEUE_DELAY', 5)
+    ids = [id_ for id_ in sorted(ids)
+           if cache.add(INDEX_QUEUE_KEY % id_, True, delay + 60)]
+    if ids:
+        update_search_indexes.apply_async(args=[UserProfileMappingType, ids],
+                                          countdown=delay)
+
+
+def start_coalescing():
+    _index_queue.depth += 1
+
+
+def stop_coalescing():
+    _index_queue.depth -= 1
+    if not _index_queue.depth:
+        flush_index_queue()
+
+
+def reset_coalescing():
+    """Stop coalescing in this thread and send what is left.
+
+    Recovers a thread whose last stop_coalescing() never ran.
+
+    """
+    _index_queue.depth = 0
+    if _index_queue.ids:
+        flush_index_queue()
+
+
+@contextmanager
+def coalesce_index_updates():
+    """Collect search index updates and send them all at the end."""
+    start_coalescing()
+    try:
+        yield
+    finally:
+        stop_coalescing()
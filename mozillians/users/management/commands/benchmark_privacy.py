@@ -0,0 +1,65 @@
+import timeit
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from mozillians.users.managers import PUBLIC
+from mozillians.users.models import PRIVACY_SPECIAL_FUNCTIONS, UserProfile
+
+
+def legacy_getattribute(profile, attrname):
+    """Attribute lookup as UserProfile.__getattribute__ used to do it.
+
+    Kept as a baseline, rebuilding the special functions dictionary
+    and fetching the privacy level on every access.
+    """
+    _getattr = (lambda x: object.__getattribute__(profile, x))
+    privacy_fields = UserProfile.privacy_fields()
+    privacy_level = _getattr('_privacy_level')
+    special_functions = dict(PRIVACY_SPECIAL_FUNCTIONS)
+
+    if attrname in special_functions:
+        return _getattr(special_functions[attrname])
+
+    if not privacy_level or attrname not in privacy_fields:
+        return _getattr(attrname)
+
+    field_privacy = _getattr('privacy_%s' % attrname)
+    if field_privacy < privacy_level:
+        return privacy_fields.get(attrname)
+
+    return _getattr(attrname)
+
+
+class Command(BaseCommand):
+    help = 'Time attribute access on UserProfile instances.'
+
+    option_list = list(BaseCommand.option_list) + [
+        make_option('--number',
+                    dest='number',
+                    type='int',
+                    default=100000,
+                    help='Number of attribute accesses per measurement.'),
+    ]
+
+    def handle(self, *args, **options):
+        number = options.get('number')
+
+        # Unsaved instances, no database access is involved.
+        profile = UserProfile(full_name='Foo Bar', ircname='foo')
+        private_profile = UserProfile(full_name='Foo Bar', ircname='foo')
+        private_profile.set_instance_privacy_level(PUBLIC)
+
+        cases = [
+            ('privacy field, no level', profile, 'full_name'),
+            ('privacy field, public level', private_profile, 'full_name'),
+            ('plain field, public level', private_profile, 'is_vouched'),
+        ]
+
+        for name, obj, attrname in cases:
+            current = min(timeit.repeat(lambda: getattr(obj, attrname),
+                                        number=number, repeat=3))
+            legacy = min(timeit.repeat(lambda: legacy_getattribute(obj, attrname),
+                                       number=number, repeat=3))
+            self.stdout.write('%-30s current: %.3fs legacy: %.3fs (%.1fx)\n'
+                              % (name, current, legacy, legacy / current))
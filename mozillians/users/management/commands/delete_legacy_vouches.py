@@ -2,7 +2,7 @@ from optparse import make_option
 
 from django.core.management.base import BaseCommand
 
-from mozillians.users.models import Vouch
+from mozillians.users.models import Vouch, coalesce_vouch_flag_updates
 
 
 class Command(BaseCommand):
@@ -22,6 +22,7 @@ class Command(BaseCommand):
             msg = "%d legacy vouches to be deleted." % legacy_vouches.count()
             self.stdout.write(msg)
         else:
-            legacy_vouches.delete()
+            with coalesce_vouch_flag_updates():
+                legacy_vouches.delete()
             msg = "%d legacy vouches left." % legacy_vouches.count()
             self.stdout.write(msg)
@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from mozillians.api.resources import invalidate_response_cache
+from mozillians.geo.lookup import (GeoLookupException, cache_geocode_result,
+                                   fetch_geocode_result, geocode_cell,
+                                   get_cached_location)
+from mozillians.users.es import queue_index_update
+from mozillians.users.models import LocationCount, UserProfile
+
+
+class TokenBucket(object):
+    """Allow `rate` calls per second, in bursts of up to `capacity`.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """Take a token, sleeping until one is available."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            # Reserve the token now, callers queued behind us see the
+            # debt and wait longer.
+            wait = max(0, (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+
+class Command(BaseCommand):
+    help = 'Reverse geocode profiles with no country or the geo_error placeholder.'
+
+    option_list = list(BaseCommand.option_list) + [
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=100,
+                    help='Number of profiles read and updated at a time.'),
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=4,
+                    help='Number of concurrent requests to Mapbox.'),
+        make_option('--rate',
+                    dest='rate',
+                    type='float',
+                    default=5,
+                    help='Maximum number of requests to Mapbox per second.'),
+        make_option('--all',
+                    dest='all',
+                    action='store_true',
+                    default=False,
+                    help='Re-geocode every profile with a location.'),
+    ]
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        workers = options.get('workers')
+        rate = options.get('rate')
+
+        if batch_size < 1 or workers < 1 or rate <= 0:
+            raise CommandError('--batch-size, --workers and --rate must be positive.')
+
+        profiles = UserProfile.objects.exclude(lat=None).exclude(lng=None)
+        if not options.get('all'):
+            # Points known to be outside any country only change when
+            # the user picks another location.
+            profiles = (profiles.filter(Q(geo_country=None) |
+                                        Q(geo_country__mapbox_id='geo_error'))
+                        .exclude(geo_outside_country=True))
+
+        bucket = TokenBucket(rate, capacity=workers)
+        pool = ThreadPool(workers)
+        updated = failed = outside = 0
+        last_id = 0
+        try:
+            while True:
+                batch = list(profiles.filter(id__gt=last_id).order_by('id')
+                             .values_list('id', 'lat', 'lng', 'geo_country', 'geo_region',
+                                          'geo_city', 'is_vouched', 'full_name')
+                             [:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+                batch_updated, batch_failed, batch_outside = self.geocode_batch(
+                    profiles, batch, pool, bucket)
+                updated += batch_updated
+                failed += batch_failed
+                outside += batch_outside
+        finally:
+            pool.close()
+            pool.join()
+
+        if updated:
+            invalidate_response_cache('users')
+        self.stdout.write('%d profiles updated, %d failed.\n' % (updated, failed))
+        if outside:
+            self.stdout.write('%d profiles outside any country.\n' % outside)
+
+    def geocode_batch(self, profiles, batch, pool, bucket):
+        """Geocode and update one batch of profile rows.
+
+        Only the Mapbox calls run in the pool, one per cache cell,
+        database access stays in this thread. Profiles outside any
+        country keep their location and get geo_outside_country set.
+        Returns the number of updated, failed and outside profiles.
+
+        """
+        locations = {}
+        fetched = {}
+        misses = {}
+        for row in batch:
+            lat, lng = row[1:3]
+            location = get_cached_location(lat, lng)
+            if location:
+                locations[(lat, lng)] = location
+            else:
+                misses.setdefault(geocode_cell(lat, lng), (lat, lng))
+
+        def fetch(point):
+            bucket.consume()
+            try:
+                return point, fetch_geocode_result(*point)
+            except GeoLookupException:
+                return point, None
+
+        for point, result in pool.imap_unordered(fetch, misses.values()):
+            if result is not None:
+                fetched[geocode_cell(*point)] = cache_geocode_result(point[0], point[1],
+                                                                     result)
+
+        # Region and city are only kept for profiles that already
+        # shared them, users may have opted out.
+        updates = defaultdict(list)
+        failed = 0
+        outside = Q()
+        for row in batch:
+            pk, lat, lng, country_id, region_id, city_id = row[:6]
+            location = locations.get((lat, lng)) or fetched.get(geocode_cell(lat, lng))
+            if not location:
+                failed += 1
+                continue
+            if not location[0]:
+                outside |= Q(pk=pk, lat=lat, lng=lng)
+                continue
+            country, region, city = location
+            updates[(country,
+                     region if region_id else None,
+                     city if city_id else None)].append(row)
+
+        outside_count = 0
+        if outside:
+            outside_count = profiles.filter(outside).update(geo_outside_country=True)
+
+        now = datetime.now()
+        updated = 0
+        updated_ids = []
+        deltas = defaultdict(int)
+        recount = set()
+        for (country, region, city), rows in updates.items():
+            pks = [row[0] for row in rows]
+            # Profiles fixed or moved since the batch was read are
+            # skipped.
+            unchanged = Q()
+            for pk, lat, lng in (row[:3] for row in rows):
+                unchanged |= Q(pk=pk, lat=lat, lng=lng)
+            count = profiles.filter(unchanged).update(geo_country=country, geo_region=region,
+                                                      geo_city=city, geo_outside_country=False,
+                                                      last_updated=now)
+            if not count:
+                continue
+            updated += count
+            updated_ids.extend(pks)
+            if count < len(rows):
+                # It's unknown which profiles were skipped.
+                recount.update(row[3] for row in rows)
+                recount.add(country.id)
+                continue
+            new_key = (country.id, getattr(region, 'id', None), getattr(city, 'id', None))
+            for (pk, lat, lng, old_country, old_region, old_city,
+                 is_vouched, full_name) in rows:
+                if is_vouched and full_name:
+                    deltas[(old_country, old_region, old_city)] -= 1
+                    deltas[new_key] += 1
+
+        if updated_ids:
+            LocationCount.add_counts(deltas)
+            if recount:
+                LocationCount.update_counts(recount)
+            queue_index_update(updated_ids)
+        return updated, failed, outside_count
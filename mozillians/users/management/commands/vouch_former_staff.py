@@ -5,7 +5,7 @@ from django.db.models import Q
 from django.utils import timezone
 
 from mozillians.common.helpers import get_object_or_none
-from mozillians.users.models import UserProfile, Vouch
+from mozillians.users.models import UserProfile, Vouch, coalesce_vouch_flag_updates
 
 
 class Command(BaseCommand):
@@ -39,24 +39,25 @@ class Command(BaseCommand):
         employee_descr = 'An automatic vouch for being a Mozilla employee.'
 
         count = 0
-        for email in f:
-            u = get_object_or_none(UserProfile, user__email=email.strip())
-            if u:
-                vouches = u.vouches_received.all()
-                already_vouched = vouches.filter(
-                    Q(description=employee_descr) |
-                    Q(description=former_employee_descr),
-                    autovouch=True
-                )
-                if not already_vouched.exists():
-                    if not dry_run:
-                        Vouch.objects.create(
-                            voucher=None,
-                            vouchee=u,
-                            autovouch=True,
-                            date=now,
-                            description=former_employee_descr
-                        )
-                    count = count + 1
+        with coalesce_vouch_flag_updates():
+            for email in f:
+                u = get_object_or_none(UserProfile, user__email=email.strip())
+                if u:
+                    vouches = u.vouches_received.all()
+                    already_vouched = vouches.filter(
+                        Q(description=employee_descr) |
+                        Q(description=former_employee_descr),
+                        autovouch=True
+                    )
+                    if not already_vouched.exists():
+                        if not dry_run:
+                            Vouch.objects.create(
+                                voucher=None,
+                                vouchee=u,
+                                autovouch=True,
+                                date=now,
+                                description=former_employee_descr
+                            )
+                        count = count + 1
 
         print "%d former staff members vouched." % count
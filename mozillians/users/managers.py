@@ -28,26 +28,47 @@ class UserProfileValuesQuerySet(ValuesQuerySet):
         c._privacy_level = getattr(self, '_privacy_level', None)
         return c
 
+    # Privacy masks for each combination of selected names.
+    _privacy_masks = {}
+
+    def _get_privacy_masks(self, names):
+        """Return (privacy index, field name, default) tuples for the
+        privacy-controlled fields in names.
+
+        """
+        masks = self._privacy_masks.get(names)
+        if masks is None:
+            model_privacy_fields = self.model.privacy_fields()
+            positions = dict((name, index) for index, name in enumerate(names))
+            masks = tuple((positions['privacy_%s' % field], field, default)
+                          for field, default in model_privacy_fields.items()
+                          if field in positions)
+            self._privacy_masks[names] = masks
+        return masks
+
     def iterator(self):
         # Purge any extra columns that haven't been explicitly asked for
         extra_names = self.query.extra_select.keys()
         field_names = self.field_names
         aggregate_names = self.query.aggregate_select.keys()
 
-        names = extra_names + field_names + aggregate_names
+        names = tuple(extra_names + field_names + aggregate_names)
 
-        model_privacy_fields = self.model.privacy_fields()
+        results = self.query.get_compiler(self.db).results_iter()
+        privacy_level = getattr(self, '_privacy_level', None)
+        masks = self._get_privacy_masks(names) if privacy_level else ()
 
-        privacy_fields = [
-            (names.index('privacy_%s' % field), names.index(field), field)
-            for field in set(model_privacy_fields) & set(names)]
+        if not masks:
+            for row in results:
+                yield dict(zip(names, row))
+            return
 
-        for row in self.query.get_compiler(self.db).results_iter():
-            row = list(row)
-            for levelindex, fieldindex, field in privacy_fields:
-                if row[levelindex] < self._privacy_level:
-                    row[fieldindex] = model_privacy_fields[field]
-            yield dict(zip(names, row))
+        for row in results:
+            values = dict(zip(names, row))
+            for levelindex, field, default in masks:
+                if row[levelindex] < privacy_level:
+                    values[field] = default
+            yield values
 
 
 class UserProfileQuerySet(QuerySet):
@@ -126,3 +147,23 @@ class UserProfileManager(Manager):
 
     def __getattr__(self, name):
         return getattr(self.get_query_set(), name)
+
+
+class CountedQuerySet(object):
+    """QuerySet wrapper for Django's Paginator with a count known in
+    advance, so that the Paginator doesn't run a COUNT query.
+
+    """
+
+    def __init__(self, queryset, count):
+        self.queryset = queryset
+        self._count = count
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        return self.queryset[key]
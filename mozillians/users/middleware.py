@@ -0,0 +1,33 @@
+from mozillians.users.es import reset_coalescing, start_coalescing, stop_coalescing
+
+
+class SearchIndexQueueMiddleware(object):
+    """Send the search index updates of a request in one go.
+
+    A single profile edit saves the profile several times, so the
+    updates are collected during the request and queued once the
+    response is ready.
+
+    process_response is skipped when a later response middleware
+    raises, so every request starts from a clean queue.
+
+    """
+
+    def process_request(self, request):
+        reset_coalescing()
+        start_coalescing()
+        request._coalescing_index_updates = True
+
+    def process_response(self, request, response):
+        if getattr(request, '_coalescing_index_updates', False):
+            request._coalescing_index_updates = False
+            stop_coalescing()
+        return response
+
+
+class PrivacyClearanceMiddleware(object):
+    """Work out the privacy clearance of the user at most once per request."""
+
+    def process_request(self, request):
+        if request.user.is_authenticated():
+            request.user.userprofile.remember_clearance()
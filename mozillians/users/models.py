@@ -1,13 +1,17 @@
 import logging
 import os
+import threading
 import uuid
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group as AuthGroup, User
+from django.core.cache import cache
 from django.core.mail import send_mail
-from django.db import models
-from django.db.models import signals as dbsignals, ManyToManyField
+from django.db import IntegrityError, models
+from django.db.models import signals as dbsignals, Count, F, ManyToManyField, Q
 from django.dispatch import receiver
 from django.utils.encoding import iri_to_uri
 from django.utils.http import urlquote
@@ -25,25 +29,42 @@ from funfactory import utils
 
 from mozillians.common.helpers import gravatar
 from mozillians.common.helpers import offset_of_timezone
-from mozillians.groups.models import (Group, GroupAlias, GroupMembership,
-                                      Skill, SkillAlias)
+from mozillians.api.resources import invalidate_response_cache
+from mozillians.geo.models import City, Region
+from mozillians.groups.models import (Group, GroupMembership, Skill,
+                                      clear_common_skills_cache)
 from mozillians.phonebook.validators import (validate_email, validate_twitter,
                                              validate_website, validate_username_not_url,
                                              validate_phone_number)
-from mozillians.users.es import UserProfileMappingType
+from mozillians.users.es import UserProfileMappingType, queue_index_update
 from mozillians.users import get_languages_for_locale
 from mozillians.users.managers import (EMPLOYEES,
                                        MOZILLIANS, PRIVACY_CHOICES, PRIVILEGED,
                                        PUBLIC, PUBLIC_INDEXABLE_FIELDS,
                                        UserProfileManager)
-from mozillians.users.tasks import (index_objects, unsubscribe_from_basket_task,
-                                    update_basket_task, unindex_objects)
+from mozillians.users.tasks import (unsubscribe_from_basket_task, update_basket_task,
+                                    unindex_objects)
 
 
 COUNTRIES = product_details.get_regions('en-US')
 AVATAR_SIZE = (300, 300)
 logger = logging.getLogger(__name__)
 
+# Attributes of UserProfile served by privacy aware properties.
+PRIVACY_SPECIAL_FUNCTIONS = {
+    'accounts': '_accounts',
+    'alternate_emails': '_alternate_emails',
+    'email': '_primary_email',
+    'is_public_indexable': '_is_public_indexable',
+    'languages': '_languages',
+    'vouches_made': '_vouches_made',
+    'vouches_received': '_vouches_received',
+    'vouched_by': '_vouched_by',
+    'websites': '_websites'
+}
+_getattribute = object.__getattribute__
+PRIVACY_CLEARANCE_KEY = 'privacy-clearance-%s'
+
 
 def _calculate_photo_filename(instance, filename):
     """Generate a unique filename for uploaded photo."""
@@ -82,6 +103,7 @@ class UserProfilePrivacyModel(models.Model):
     privacy_story_link = PrivacyField()
 
     CACHED_PRIVACY_FIELDS = None
+    CACHED_PRIVACY_ATTRS = None
 
     class Meta:
         abstract = True
@@ -93,6 +115,18 @@ class UserProfilePrivacyModel(models.Model):
         (This is only used in testing.)
         """
         cls.CACHED_PRIVACY_FIELDS = None
+        cls.CACHED_PRIVACY_ATTRS = None
+
+    @classmethod
+    def privacy_attrs(cls):
+        """
+        Return a dictionary whose keys are the names of the
+        privacy-controlled fields and whose values are tuples of the
+        name of their privacy field and their default value.
+        """
+        if cls.CACHED_PRIVACY_ATTRS is None:
+            cls._cache_privacy_fields()
+        return cls.CACHED_PRIVACY_ATTRS
 
     @classmethod
     def privacy_fields(cls):
@@ -104,28 +138,35 @@ class UserProfilePrivacyModel(models.Model):
         """
         # Cache on the class object
         if cls.CACHED_PRIVACY_FIELDS is None:
-            privacy_fields = {}
-            field_names = cls._meta.get_all_field_names()
-            for name in field_names:
-                if name.startswith('privacy_') or not 'privacy_%s' % name in field_names:
-                    # skip privacy fields and uncontrolled fields
-                    continue
-                field = cls._meta.get_field(name)
-                # Okay, this is a field that is privacy-controlled
-                # Figure out a good default value for it (to show to users
-                # who aren't privileged to see the actual value)
-                if isinstance(field, ManyToManyField):
-                    default = field.related.parent_model.objects.none()
-                else:
-                    default = field.get_default()
-                privacy_fields[name] = default
-            # HACK: There's not really an email field on UserProfile,
-            # but it's faked with a property
-            privacy_fields['email'] = u''
-
-            cls.CACHED_PRIVACY_FIELDS = privacy_fields
+            cls._cache_privacy_fields()
         return cls.CACHED_PRIVACY_FIELDS
 
+    @classmethod
+    def _cache_privacy_fields(cls):
+        privacy_fields = {}
+        field_names = cls._meta.get_all_field_names()
+        for name in field_names:
+            if name.startswith('privacy_') or not 'privacy_%s' % name in field_names:
+                # skip privacy fields and uncontrolled fields
+                continue
+            field = cls._meta.get_field(name)
+            # Okay, this is a field that is privacy-controlled
+            # Figure out a good default value for it (to show to users
+            # who aren't privileged to see the actual value)
+            if isinstance(field, ManyToManyField):
+                default = field.related.parent_model.objects.none()
+            else:
+                default = field.get_default()
+            privacy_fields[name] = default
+        # HACK: There's not really an email field on UserProfile,
+        # but it's faked with a property
+        privacy_fields['email'] = u''
+
+        cls.CACHED_PRIVACY_FIELDS = privacy_fields
+        cls.CACHED_PRIVACY_ATTRS = dict(
+            (name, ('privacy_%s' % name, default))
+            for name, default in privacy_fields.items())
+
 
 class UserProfile(UserProfilePrivacyModel):
     REFERRAL_SOURCE_CHOICES = (
@@ -133,6 +174,9 @@ class UserProfile(UserProfilePrivacyModel):
         ('contribute', 'Get Involved'),
     )
 
+    _clearance = None
+    _remember_clearance = False
+
     objects = UserProfileManager()
 
     user = models.OneToOneField(User)
@@ -162,6 +206,9 @@ class UserProfile(UserProfilePrivacyModel):
     geo_city = models.ForeignKey('geo.City', blank=True, null=True, on_delete=models.SET_NULL)
     lat = models.FloatField(_lazy(u'Latitude'), blank=True, null=True)
     lng = models.FloatField(_lazy(u'Longitude'), blank=True, null=True)
+    # Set when the last location picked could not be matched to a
+    # country, the previous geo data is kept.
+    geo_outside_country = models.BooleanField(default=False)
 
     allows_community_sites = models.BooleanField(
         default=True,
@@ -221,36 +268,26 @@ class UserProfile(UserProfilePrivacyModel):
         Otherwise it returns a default privacy respecting value for
         the attribute, as defined in the privacy_fields dictionary.
 
-        special_functions provides methods that privacy safe their
-        respective properties, where the privacy modifications are
-        more complex.
+        PRIVACY_SPECIAL_FUNCTIONS provides methods that privacy safe
+        their respective properties, where the privacy modifications
+        are more complex.
+
+        Attributes are looked up in precomputed tables, so accessing
+        attributes that aren't privacy-controlled costs about the same
+        as on any other model.
         """
-        _getattr = (lambda x: super(UserProfile, self).__getattribute__(x))
-        privacy_fields = UserProfile.privacy_fields()
-        privacy_level = _getattr('_privacy_level')
-        special_functions = {
-            'accounts': '_accounts',
-            'alternate_emails': '_alternate_emails',
-            'email': '_primary_email',
-            'is_public_indexable': '_is_public_indexable',
-            'languages': '_languages',
-            'vouches_made': '_vouches_made',
-            'vouches_received': '_vouches_received',
-            'vouched_by': '_vouched_by',
-            'websites': '_websites'
-        }
-
-        if attrname in special_functions:
-            return _getattr(special_functions[attrname])
-
-        if not privacy_level or attrname not in privacy_fields:
-            return _getattr(attrname)
-
-        field_privacy = _getattr('privacy_%s' % attrname)
-        if field_privacy < privacy_level:
-            return privacy_fields.get(attrname)
-
-        return _getattr(attrname)
+        if attrname in PRIVACY_SPECIAL_FUNCTIONS:
+            return _getattribute(self, PRIVACY_SPECIAL_FUNCTIONS[attrname])
+
+        privacy_attrs = UserProfile.CACHED_PRIVACY_ATTRS or UserProfile.privacy_attrs()
+        if attrname in privacy_attrs:
+            privacy_level = _getattribute(self, '_privacy_level')
+            if privacy_level:
+                privacy_attname, default = privacy_attrs[attrname]
+                if _getattribute(self, privacy_attname) < privacy_level:
+                    return default
+
+        return _getattribute(self, attrname)
 
     def _filter_accounts_privacy(self, accounts):
         if self._privacy_level:
@@ -293,36 +330,39 @@ class UserProfile(UserProfilePrivacyModel):
             return email
         return _getattr('user').email
 
+    @classmethod
+    def _visible_at_level_q(cls, prefix, privacy_level):
+        """Return a Q object matching the profiles, reached through
+        prefix, which expose at least one of their privacy-controlled
+        fields at privacy_level.
+        """
+        query = Q()
+        for privacy_attname, default in cls.privacy_attrs().values():
+            query |= Q(**{'%s%s__gte' % (prefix, privacy_attname): privacy_level})
+        return query
+
     @property
     def _vouched_by(self):
         privacy_level = self._privacy_level
-        voucher = (UserProfile.objects.filter(vouches_made__vouchee=self)
-                   .order_by('vouches_made__date'))
-
-        if voucher.exists():
-            voucher = voucher[0]
-            if privacy_level:
-                voucher.set_instance_privacy_level(privacy_level)
-                for field in UserProfile.privacy_fields():
-                    if getattr(voucher, 'privacy_%s' % field) >= privacy_level:
-                        return voucher
-                return None
-            return voucher
-
-        return None
+        vouchers = list(UserProfile.objects.filter(vouches_made__vouchee=self)
+                        .order_by('vouches_made__date')[:1])
+        if not vouchers:
+            return None
+        voucher = vouchers[0]
+        if privacy_level:
+            # Only the first voucher is reported, a hidden one is not
+            # replaced by a later voucher.
+            voucher.set_instance_privacy_level(privacy_level)
+            for privacy_attname, default in UserProfile.privacy_attrs().values():
+                if getattr(voucher, privacy_attname) >= privacy_level:
+                    return voucher
+            return None
+        return voucher
 
     def _vouches(self, type):
         _getattr = (lambda x: super(UserProfile, self).__getattribute__(x))
-
-        vouch_ids = []
-        for vouch in _getattr(type).all():
-            vouch.vouchee.set_instance_privacy_level(self._privacy_level)
-            for field in UserProfile.privacy_fields():
-                if getattr(vouch.vouchee, 'privacy_%s' % field, 0) >= self._privacy_level:
-                    vouch_ids.append(vouch.id)
-        vouches = _getattr(type).filter(pk__in=vouch_ids)
-
-        return vouches
+        return _getattr(type).filter(
+            UserProfile._visible_at_level_q('vouchee__', self._privacy_level))
 
     @property
     def _vouches_made(self):
@@ -348,12 +388,42 @@ class UserProfile(UserProfilePrivacyModel):
     def display_name(self):
         return self.full_name
 
+    @property
+    def clearance(self):
+        """Return a (is_manager, is_staff) tuple for this user.
+
+        The tuple is cached for PRIVACY_CLEARANCE_TIMEOUT seconds and
+        kept on the instance once remember_clearance() is called.
+        """
+        clearance = self._clearance
+        if clearance is None:
+            key = PRIVACY_CLEARANCE_KEY % self.user_id
+            clearance = cache.get(key)
+            if clearance is None:
+                user = self.user
+                clearance = (
+                    user.is_superuser or user.groups.filter(name='Managers').exists(),
+                    _getattribute(self, 'groups').filter(name='staff').exists())
+                cache.set(key, clearance, settings.PRIVACY_CLEARANCE_TIMEOUT)
+            if self._remember_clearance:
+                self._clearance = clearance
+        return clearance
+
+    def remember_clearance(self):
+        """Keep the clearance on this instance for the rest of its life.
+
+        Only meant for short lived instances, like the profile of the
+        user of a request.
+        """
+        self._remember_clearance = True
+
     @property
     def privacy_level(self):
         """Return user privacy clearance."""
-        if (self.user.groups.filter(name='Managers').exists() or self.user.is_superuser):
+        is_manager, is_staff = self.clearance
+        if is_manager:
             return PRIVILEGED
-        if self.groups.filter(name='staff').exists():
+        if is_staff:
             return EMPLOYEES
         if self.is_vouched:
             return MOZILLIANS
@@ -377,7 +447,7 @@ class UserProfile(UserProfilePrivacyModel):
 
     @property
     def is_manager(self):
-        return self.user.is_superuser or self.user.groups.filter(name='Managers').exists()
+        return self.clearance[0]
 
     @property
     def date_vouched(self):
@@ -399,39 +469,38 @@ class UserProfile(UserProfilePrivacyModel):
             self.save()
 
     def set_membership(self, model, membership_list):
-        """Alters membership to Groups and Skills."""
-        if model is Group:
-            m2mfield = self.groups
-            alias_model = GroupAlias
-        elif model is Skill:
-            m2mfield = self.skills
-            alias_model = SkillAlias
+        """Alters membership to Groups and Skills.
 
-        # Remove any visible groups that weren't supplied in this list.
-        if model is Group:
-            GroupMembership.objects.filter(userprofile=self, group__visible=True)\
-                .exclude(group__name__in=membership_list).delete()
-        else:
-            m2mfield.remove(*[g for g in m2mfield.all()
-                              if g.name not in membership_list
-                              and g.is_visible])
-
-        # Add/create the rest of the groups
-        groups_to_add = []
-        for g in membership_list:
-            if alias_model.objects.filter(name=g).exists():
-                group = alias_model.objects.get(name=g).alias
-            else:
-                group = model.objects.create(name=g)
+        The names are resolved in bulk and the memberships are diffed
+        as sets. Skills are added and removed in bulk, new group
+        memberships are created one by one.
+        """
+        groups = model.get_or_create_by_names(membership_list)
+        group_ids = set(group.id for group in groups if group.is_visible)
+
+        if model is Skill:
+            current_ids = set(self.skills.values_list('id', flat=True))
+            if current_ids - group_ids:
+                self.skills.remove(*(current_ids - group_ids))
+            if group_ids - current_ids:
+                self.skills.add(*(group_ids - current_ids))
+            return
 
-            if group.is_visible:
-                groups_to_add.append(group)
+        statuses = dict(GroupMembership.objects
+                        .filter(userprofile=self, group__visible=True)
+                        .values_list('group_id', 'status'))
 
-        if model is Group:
-            for group in groups_to_add:
+        # Remove any visible groups that weren't supplied in this list.
+        removed_ids = set(statuses) - group_ids
+        if removed_ids:
+            GroupMembership.objects.filter(userprofile=self, group__in=removed_ids).delete()
+
+        # Memberships are added one at a time, through add_member, so
+        # that the receivers of GroupMembership run. Pending requests
+        # are accepted.
+        for group in groups:
+            if group.id in group_ids and statuses.get(group.id) != GroupMembership.MEMBER:
                 group.add_member(self)
-        else:
-            m2mfield.add(*groups_to_add)
 
     def get_photo_thumbnail(self, geometry='160x160', **kwargs):
         if 'crop' not in kwargs:
@@ -507,6 +576,82 @@ class UserProfile(UserProfilePrivacyModel):
                     description=settings.AUTO_VOUCH_REASON, autovouch=True).exists():
                 self.vouch(None, settings.AUTO_VOUCH_REASON, autovouch=True)
 
+    @classmethod
+    def refresh_vouch_flags(cls, pks):
+        """Recompute is_vouched and can_vouch of the profiles with the
+        given pks from the vouches they received.
+
+        The flags are written with update(), so the post_save receivers
+        of UserProfile don't run. Profiles whose vouched status flipped
+        get their group, skill and location counts and basket
+        subscription updated, and all changed profiles are queued for a
+        single search index update.
+
+        Returns a dictionary mapping the pks of the changed profiles to
+        their new (is_vouched, can_vouch) flags.
+        """
+        pks = set(pks)
+        if not pks:
+            return {}
+
+        vouches = dict(Vouch.objects.filter(vouchee__in=pks).order_by()
+                       .values('vouchee').annotate(count=Count('id'))
+                       .values_list('vouchee', 'count'))
+        profiles = (cls.objects.filter(pk__in=pks)
+                    .values_list('id', 'is_vouched', 'can_vouch', 'basket_token', 'user__email',
+                                 'geo_country', 'geo_region', 'geo_city', 'full_name'))
+
+        changed = {}
+        flipped = []
+        location_deltas = defaultdict(int)
+        for (pk, is_vouched, can_vouch, basket_token, email,
+             country, region, city, full_name) in profiles:
+            count = vouches.get(pk, 0)
+            flags = (count > 0, count >= settings.CAN_VOUCH_THRESHOLD)
+            if flags == (is_vouched, can_vouch):
+                continue
+            changed[pk] = flags
+            if flags[0] != is_vouched:
+                flipped.append(pk)
+                if full_name:
+                    location_deltas[(country, region, city)] += 1 if flags[0] else -1
+                if flags[0]:
+                    update_basket_task.delay(pk)
+                elif basket_token:
+                    unsubscribe_from_basket_task.delay(email, basket_token)
+
+        if not changed:
+            return changed
+
+        pks_by_flags = defaultdict(list)
+        for pk, flags in changed.items():
+            pks_by_flags[flags].append(pk)
+        now = datetime.now()
+        for (is_vouched, can_vouch), flag_pks in pks_by_flags.items():
+            cls.objects.filter(pk__in=flag_pks).update(is_vouched=is_vouched,
+                                                       can_vouch=can_vouch,
+                                                       last_updated=now)
+
+        # Vouched member counts of the groups and skills change too.
+        for model in [Group, Skill]:
+            if len(flipped) == 1:
+                groups = model.objects.filter(members=flipped[0])
+                if changed[flipped[0]][0]:
+                    groups.update(vouched_member_count=F('vouched_member_count') + 1)
+                else:
+                    (groups.filter(vouched_member_count__gt=0)
+                     .update(vouched_member_count=F('vouched_member_count') - 1))
+            elif flipped:
+                # Several profiles may share a group, recount instead.
+                group_pks = set(model.objects.filter(members__in=flipped)
+                                .values_list('id', flat=True))
+                model.update_member_counts(group_pks)
+        LocationCount.add_counts(location_deltas)
+
+        queue_index_update(changed.keys())
+        invalidate_response_cache('users', 'groups', 'skills')
+        return changed
+
     def _email_now_vouched(self, vouched_by, description=''):
         """Email this user, letting them know they are now vouched."""
         name = None
@@ -590,35 +735,47 @@ class UserProfile(UserProfilePrivacyModel):
         # create foreign keys without a database id.
         self.auto_vouch()
 
-    def reverse_geocode(self):
+    def reverse_geocode(self, remote=True):
         """
         Use the user's lat and lng to set their city, region, and country.
         Does not save the profile.
+
+        With remote=False Mapbox is not called, only nearby cities and
+        cached results are used. Returns False if the location couldn't
+        be resolved that way.
         """
         if self.lat is None or self.lng is None:
-            return
+            return False
 
         from mozillians.geo.models import Country
-        from mozillians.geo.lookup import reverse_geocode, GeoLookupException
-        try:
-            result = reverse_geocode(self.lat, self.lng)
-        except GeoLookupException:
-            if self.geo_country:
-                # If self.geo_country is already set, just give up.
-                pass
-            else:
-                # No country set, we need to at least set the placeholder one.
-                self.geo_country = Country.objects.get(mapbox_id='geo_error')
-                self.geo_region = None
-                self.geo_city = None
+        from mozillians.geo.lookup import (GeoLookupException, get_cached_location,
+                                           reverse_geocode)
+        if not remote:
+            result = get_cached_location(self.lat, self.lng)
+            if result is None:
+                return False
         else:
-            if result:
-                country, region, city = result
-                self.geo_country = country
-                self.geo_region = region
-                self.geo_city = city
-            else:
-                logger.error('Got back NONE from reverse_geocode on %s, %s' % (self.lng, self.lat))
+            try:
+                result = reverse_geocode(self.lat, self.lng)
+            except GeoLookupException:
+                if self.geo_country:
+                    # If self.geo_country is already set, just give up.
+                    pass
+                else:
+                    # No country set, we need to at least set the placeholder one.
+                    self.geo_country = Country.objects.get(mapbox_id='geo_error')
+                    self.geo_region = None
+                    self.geo_city = None
+                return True
+
+        if result:
+            country, region, city = result
+            self.geo_country = country
+            self.geo_region = region
+            self.geo_city = city
+        else:
+            logger.error('Got back NONE from reverse_geocode on %s, %s' % (self.lng, self.lat))
+        return True
 
 
 @receiver(dbsignals.post_save, sender=User,
@@ -631,6 +788,133 @@ def create_user_profile(sender, instance, created, raw, **kwargs):
                                      created=created, raw=raw)
 
 
+@receiver(dbsignals.post_save, sender=User,
+          dispatch_uid='clear_privacy_clearance_user_sig')
+def clear_privacy_clearance_user(sender, instance, **kwargs):
+    cache.delete(PRIVACY_CLEARANCE_KEY % instance.id)
+
+
+@receiver(dbsignals.m2m_changed, sender=User.groups.through,
+          dispatch_uid='clear_privacy_clearance_auth_groups_sig')
+def clear_privacy_clearance_auth_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+    if not reverse:
+        user_ids = [instance.id]
+    elif pk_set:
+        user_ids = pk_set
+    else:
+        user_ids = instance.user_set.values_list('id', flat=True)
+    cache.delete_many([PRIVACY_CLEARANCE_KEY % user_id for user_id in user_ids])
+
+
+@receiver(dbsignals.pre_delete, sender=AuthGroup,
+          dispatch_uid='clear_privacy_clearance_auth_group_delete_sig')
+def clear_privacy_clearance_auth_group_delete(sender, instance, **kwargs):
+    user_ids = instance.user_set.values_list('id', flat=True)
+    cache.delete_many([PRIVACY_CLEARANCE_KEY % user_id for user_id in user_ids])
+
+
+@receiver(dbsignals.post_delete, sender=GroupMembership,
+          dispatch_uid='clear_privacy_clearance_membership_delete_sig')
+@receiver(dbsignals.post_save, sender=GroupMembership,
+          dispatch_uid='clear_privacy_clearance_membership_save_sig')
+def clear_privacy_clearance_membership(sender, instance, **kwargs):
+    try:
+        user_id = instance.userprofile.user_id
+    except UserProfile.DoesNotExist:
+        # The profile is being deleted too.
+        return
+    cache.delete(PRIVACY_CLEARANCE_KEY % user_id)
+
+
+@receiver(dbsignals.post_save, sender=GroupMembership,
+          dispatch_uid='add_group_member_count_sig')
+def add_group_member_count(sender, instance, created, raw, **kwargs):
+    if raw or not created:
+        return
+    vouched = int(instance.userprofile.is_vouched)
+    (Group.objects.filter(pk=instance.group_id)
+     .update(member_count=F('member_count') + 1,
+             vouched_member_count=F('vouched_member_count') + vouched))
+
+
+@receiver(dbsignals.post_delete, sender=GroupMembership,
+          dispatch_uid='remove_group_member_count_sig')
+def remove_group_member_count(sender, instance, **kwargs):
+    try:
+        vouched = int(instance.userprofile.is_vouched)
+    except UserProfile.DoesNotExist:
+        Group.update_member_counts([instance.group_id])
+        return
+    updated = (Group.objects.filter(pk=instance.group_id, member_count__gt=0,
+                                    vouched_member_count__gte=vouched)
+               .update(member_count=F('member_count') - 1,
+                       vouched_member_count=F('vouched_member_count') - vouched))
+    if not updated:
+        # The counts have drifted, recount both.
+        Group.update_member_counts([instance.group_id])
+
+
+@receiver(dbsignals.post_delete, sender=GroupMembership,
+          dispatch_uid='clear_common_skills_membership_delete_sig')
+@receiver(dbsignals.post_save, sender=GroupMembership,
+          dispatch_uid='clear_common_skills_membership_save_sig')
+def clear_common_skills_membership(sender, instance, **kwargs):
+    clear_common_skills_cache([instance.group_id])
+
+
+@receiver(dbsignals.m2m_changed, sender=UserProfile.skills.through,
+          dispatch_uid='clear_common_skills_profile_skills_sig')
+def clear_common_skills_profile_skills(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+    memberships = GroupMembership.objects.all()
+    if not reverse:
+        memberships = memberships.filter(userprofile=instance)
+    elif action == 'pre_clear':
+        memberships = memberships.filter(userprofile__skills=instance)
+    else:
+        memberships = memberships.filter(userprofile__in=pk_set)
+    clear_common_skills_cache(memberships.values_list('group_id', flat=True))
+
+
+@receiver(dbsignals.m2m_changed, sender=UserProfile.skills.through,
+          dispatch_uid='update_skill_member_counts_sig')
+def update_skill_member_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # Members of a skill changed.
+        if action in ['post_add', 'post_remove', 'post_clear']:
+            Skill.update_member_counts([instance.pk])
+    elif action == 'pre_clear':
+        instance._cleared_skill_ids = list(Skill.objects.filter(members=instance)
+                                           .values_list('id', flat=True))
+    elif action == 'post_clear':
+        Skill.update_member_counts(getattr(instance, '_cleared_skill_ids', []))
+    elif action == 'post_add' and pk_set:
+        # pk_set only holds the skills that were actually added.
+        vouched = int(instance.is_vouched)
+        (Skill.objects.filter(pk__in=pk_set)
+         .update(member_count=F('member_count') + 1,
+                 vouched_member_count=F('vouched_member_count') + vouched))
+    elif action == 'post_remove' and pk_set:
+        Skill.update_member_counts(pk_set)
+
+
+@receiver(dbsignals.pre_delete, sender=UserProfile,
+          dispatch_uid='remember_deleted_profile_skills_sig')
+def remember_deleted_profile_skills(sender, instance, **kwargs):
+    # Skill memberships are deleted without sending signals.
+    instance._deleted_skill_ids = list(Skill.objects.filter(members=instance)
+                                       .values_list('id', flat=True))
+
+
+@receiver(dbsignals.post_delete, sender=UserProfile,
+          dispatch_uid='update_deleted_profile_skills_sig')
+def update_deleted_profile_skills(sender, instance, **kwargs):
+    Skill.update_member_counts(getattr(instance, '_deleted_skill_ids', []))
+
+
 @receiver(dbsignals.post_save, sender=UserProfile,
           dispatch_uid='update_basket_sig')
 def update_basket(sender, instance, **kwargs):
@@ -644,11 +928,7 @@ def update_basket(sender, instance, **kwargs):
           dispatch_uid='update_search_index_sig')
 def update_search_index(sender, instance, **kwargs):
     if instance.is_complete:
-        index_objects.delay(UserProfileMappingType, [instance.id], public_index=False)
-        if instance.is_public_indexable:
-            index_objects.delay(UserProfileMappingType, [instance.id], public_index=True)
-        else:
-            unindex_objects.delay(UserProfileMappingType, [instance.id], public_index=True)
+        queue_index_update([instance.id])
 
 
 @receiver(dbsignals.pre_delete, sender=UserProfile,
@@ -671,6 +951,196 @@ def delete_user_obj_sig(sender, instance, **kwargs):
         instance.user.delete()
 
 
+class LocationCount(models.Model):
+    """Number of vouched profiles with a given country, region and
+    city, so location pages don't have to count them.
+
+    Profile changes adjust the counts with add_counts(),
+    update_counts() recounts them for reconcile_member_counts.
+
+    """
+    country = models.ForeignKey('geo.Country', related_name='+')
+    region = models.ForeignKey('geo.Region', null=True, blank=True, related_name='+')
+    city = models.ForeignKey('geo.City', null=True, blank=True, related_name='+')
+    vouched_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('country', 'region', 'city')
+
+    def __unicode__(self):
+        return u'%s, %s, %s: %d' % (self.country_id, self.region_id, self.city_id,
+                                    self.vouched_count)
+
+    @classmethod
+    def update_counts(cls, country_ids=None):
+        """Recount the vouched profiles in the countries with the given
+        ids, or in all countries, and store the counts that are out of
+        date.
+
+        Returns the number of rows changed.
+        """
+        profiles = UserProfile.objects.vouched().exclude(geo_country=None)
+        stored = cls.objects.all()
+        if country_ids is not None:
+            country_ids = set(country_ids) - set([None])
+            if not country_ids:
+                return 0
+            profiles = profiles.filter(geo_country__in=country_ids)
+            stored = stored.filter(country__in=country_ids)
+
+        counts = dict(((row['geo_country'], row['geo_region'], row['geo_city']), row['count'])
+                      for row in profiles.order_by()
+                      .values('geo_country', 'geo_region', 'geo_city')
+                      .annotate(count=Count('id')))
+
+        existing = {}
+        stale = []
+        for pk, country, region, city, count in stored.order_by('pk').values_list(
+                'pk', 'country', 'region', 'city', 'vouched_count'):
+            key = (country, region, city)
+            # Rows without region or city aren't unique in the
+            # database, concurrent updates may create duplicates.
+            if key in existing or key not in counts:
+                stale.append(pk)
+            else:
+                existing[key] = (pk, count)
+
+        if stale:
+            cls.objects.filter(pk__in=stale).delete()
+        updated = 0
+        new = []
+        for key, count in counts.items():
+            if key not in existing:
+                new.append(cls(country_id=key[0], region_id=key[1], city_id=key[2],
+                               vouched_count=count))
+            elif existing[key][1] != count:
+                cls.objects.filter(pk=existing[key][0]).update(vouched_count=count)
+                updated += 1
+        cls.objects.bulk_create(new)
+        return len(stale) + updated + len(new)
+
+    @classmethod
+    def add_counts(cls, deltas):
+        """Add to the stored counts.
+
+        deltas maps (country_id, region_id, city_id) tuples to the
+        number of vouched profiles that joined, or left if negative,
+        that location. A country whose count would drop below zero has
+        drifted and is recounted with update_counts().
+        """
+        for (country, region, city), delta in deltas.items():
+            if country is None or not delta:
+                continue
+            rows = cls.objects.filter(country=country, region=region, city=city)
+            if delta < 0:
+                rows = rows.filter(vouched_count__gte=-delta)
+            # Rows without region or city may be duplicated, only one
+            # of them is changed.
+            pks = list(rows.order_by('pk').values_list('pk', flat=True)[:1])
+            if pks:
+                (cls.objects.filter(pk=pks[0])
+                 .update(vouched_count=F('vouched_count') + delta))
+            elif delta > 0:
+                try:
+                    cls.objects.create(country_id=country, region_id=region, city_id=city,
+                                       vouched_count=delta)
+                except IntegrityError:
+                    # Created concurrently, with region and city set
+                    # the row is unique.
+                    rows.update(vouched_count=F('vouched_count') + delta)
+            else:
+                cls.update_counts([country])
+
+    @classmethod
+    def move(cls, old, new):
+        """Update the counts for a profile whose _location_key changed
+        from old to new. Either may be None.
+        """
+        deltas = defaultdict(int)
+        if old and old[3]:
+            deltas[old[:3]] -= 1
+        if new and new[3]:
+            deltas[new[:3]] += 1
+        cls.add_counts(deltas)
+
+
+def _location_key(country, region, city, is_vouched, full_name):
+    """Return what decides which LocationCount a profile is in."""
+    return country, region, city, bool(is_vouched and full_name)
+
+
+LOCATION_KEY_FIELDS = ('geo_country', 'geo_region', 'geo_city', 'is_vouched', 'full_name')
+
+
+def _stored_location_keys(profiles):
+    return [_location_key(*values) for values in profiles.values_list(*LOCATION_KEY_FIELDS)]
+
+
+def _saves_location(update_fields):
+    return update_fields is None or bool(set(update_fields) & set(LOCATION_KEY_FIELDS))
+
+
+@receiver(dbsignals.post_init, sender=UserProfile,
+          dispatch_uid='load_profile_location_sig')
+def load_profile_location(sender, instance, **kwargs):
+    # Deferred fields are not in __dict__, reading them would query.
+    values = instance.__dict__
+    attnames = ['geo_country_id', 'geo_region_id', 'geo_city_id', 'is_vouched', 'full_name']
+    if values.get('id') and all(attname in values for attname in attnames):
+        instance._stored_location_key = _location_key(
+            *[values[attname] for attname in attnames])
+
+
+@receiver(dbsignals.pre_save, sender=UserProfile,
+          dispatch_uid='remember_profile_location_sig')
+def remember_profile_location(sender, instance, raw, **kwargs):
+    if raw or not instance.pk or not _saves_location(kwargs.get('update_fields')):
+        return
+    current = _location_key(instance.geo_country_id, instance.geo_region_id,
+                            instance.geo_city_id, instance.is_vouched, instance.full_name)
+    if getattr(instance, '_stored_location_key', None) == current:
+        return
+    # Flags written with update() may not be on instance, the stored
+    # values are read when the location may have changed.
+    for key in _stored_location_keys(UserProfile.objects.filter(pk=instance.pk)):
+        instance._stored_location_key = key
+
+
+@receiver(dbsignals.post_save, sender=UserProfile,
+          dispatch_uid='update_location_counts_save_sig')
+def update_location_counts_save(sender, instance, raw, **kwargs):
+    if raw or not _saves_location(kwargs.get('update_fields')):
+        return
+    stored = getattr(instance, '_stored_location_key', None)
+    current = _location_key(instance.geo_country_id, instance.geo_region_id,
+                            instance.geo_city_id, instance.is_vouched, instance.full_name)
+    if stored != current:
+        LocationCount.move(stored, current)
+    instance._stored_location_key = current
+
+
+@receiver(dbsignals.pre_delete, sender=UserProfile,
+          dispatch_uid='update_location_counts_delete_sig')
+def update_location_counts_delete(sender, instance, **kwargs):
+    profiles = UserProfile.objects.filter(pk=instance.pk)
+    for key in _stored_location_keys(profiles):
+        LocationCount.move(key, None)
+    # The vouches of the profile are deleted before it and its vouch
+    # flags recomputed, the location is cleared so that it isn't
+    # subtracted twice.
+    profiles.update(geo_country=None, geo_region=None, geo_city=None)
+
+
+@receiver(dbsignals.post_delete, sender=City,
+          dispatch_uid='update_location_counts_city_delete_sig')
+@receiver(dbsignals.post_delete, sender=Region,
+          dispatch_uid='update_location_counts_region_delete_sig')
+def update_location_counts_geo_delete(sender, instance, **kwargs):
+    # The profiles lose their region or city without signals, recount
+    # the country they are left in.
+    LocationCount.update_counts([instance.country_id])
+
+
 class Vouch(models.Model):
     vouchee = models.ForeignKey(UserProfile, related_name='vouches_received')
     voucher = models.ForeignKey(UserProfile, related_name='vouches_made',
@@ -692,21 +1162,49 @@ class Vouch(models.Model):
         return u'{0} vouched by {1}'.format(self.vouchee, self.voucher)
 
 
+class VouchFlagQueue(threading.local):
+    """Vouchees waiting for their vouch flags to be recomputed in this
+    thread."""
+
+    def __init__(self):
+        self.depth = 0
+        self.ids = set()
+
+_vouch_flag_queue = VouchFlagQueue()
+
+
+@contextmanager
+def coalesce_vouch_flag_updates():
+    """Collect the vouchees of the vouches saved or deleted in the
+    block and recompute their flags together at the end.
+    """
+    _vouch_flag_queue.depth += 1
+    try:
+        yield
+    finally:
+        _vouch_flag_queue.depth -= 1
+        if not _vouch_flag_queue.depth:
+            ids, _vouch_flag_queue.ids = _vouch_flag_queue.ids, set()
+            UserProfile.refresh_vouch_flags(ids)
+
+
 @receiver(dbsignals.post_delete, sender=Vouch, dispatch_uid='update_vouch_flags_delete_sig')
 @receiver(dbsignals.post_save, sender=Vouch, dispatch_uid='update_vouch_flags_save_sig')
 def update_vouch_flags(sender, instance, **kwargs):
     if kwargs.get('raw'):
         return
+    if _vouch_flag_queue.depth:
+        _vouch_flag_queue.ids.add(instance.vouchee_id)
+        return
     try:
         profile = instance.vouchee
     except UserProfile.DoesNotExist:
         # In this case we delete not only the vouches but the
         # UserProfile as well. Do nothing.
         return
-    vouches = Vouch.objects.filter(vouchee=profile).count()
-    profile.is_vouched = vouches > 0
-    profile.can_vouch = vouches >= settings.CAN_VOUCH_THRESHOLD
-    profile.save()
+    changed = UserProfile.refresh_vouch_flags([profile.id])
+    if profile.id in changed:
+        profile.is_vouched, profile.can_vouch = changed[profile.id]
 
 
 class UsernameBlacklist(models.Model):
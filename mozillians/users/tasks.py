@@ -3,6 +3,7 @@ import logging
 import os
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import send_mail
 from django.db.models import get_model
 
@@ -25,6 +26,9 @@ BASKET_NEWSLETTER = getattr(settings, 'BASKET_NEWSLETTER', False)
 BASKET_API_KEY = os.environ.get('BASKET_API_KEY', getattr(settings, 'BASKET_API_KEY', False))
 BASKET_ENABLED = all([BASKET_URL, BASKET_NEWSLETTER, BASKET_API_KEY])
 INCOMPLETE_ACC_MAX_DAYS = 7
+GEOCODE_TASK_RETRY_DELAY = 60  # 1 minute
+GEOCODE_TASK_MAX_RETRIES = 2
+INDEX_QUEUE_KEY = 'search-index-queued-%s'
 
 
 def _email_basket_managers(action, email, error_message):
@@ -219,25 +223,160 @@ def unsubscribe_from_basket_task(email, basket_token):
 
 
 @task
-def index_objects(mapping_type, ids, chunk_size=100, public_index=False, **kwargs):
+def index_objects(mapping_type, ids, chunk_size=100, public_index=False,
+                  index=None, refresh=True, **kwargs):
+    """Index profiles in ids, chunk_size profiles per bulk request.
+
+    The written index is refreshed once at the end, unless refresh is
+    False, e.g. while an index is rebuilt with refreshes disabled.
+
+    """
     if getattr(settings, 'ES_DISABLED', False):
         return
 
     es = get_es()
     model = mapping_type.get_model()
+    if index is None:
+        index = mapping_type.get_index(public_index)
 
     for id_list in chunked(ids, chunk_size):
-        documents = []
         qs = model.objects.filter(id__in=id_list)
-        index = mapping_type.get_index(public_index)
         if public_index:
             qs = qs.public_indexable().privacy_level(PUBLIC)
 
-        for item in qs:
-            documents.append(mapping_type.extract_document(item.id, item))
-
+        documents = mapping_type.extract_documents(qs)
         mapping_type.bulk_index(documents, id_field='id', es=es, index=index)
-        mapping_type.refresh_index(es)
+
+    if refresh:
+        mapping_type.refresh_index(es, index=index)
+
+
+@task
+def update_search_indexes(mapping_type, ids, **kwargs):
+    """Bring both search indexes up to date for profiles in ids.
+
+    Complete profiles go to the default index and, if they are public
+    indexable, to the public index. The rest are removed from the
+    public index.
+
+    """
+    cache.delete_many([INDEX_QUEUE_KEY % id_ for id_ in ids])
+    if getattr(settings, 'ES_DISABLED', False):
+        return
+
+    profiles = mapping_type.get_model().objects.complete().filter(id__in=ids)
+    complete_ids = list(profiles.values_list('id', flat=True))
+    public_ids = list(profiles.public_indexable().values_list('id', flat=True))
+    private_ids = list(set(complete_ids) - set(public_ids))
+
+    if complete_ids:
+        index_objects(mapping_type, complete_ids, len(complete_ids), public_index=False)
+    if public_ids:
+        index_objects(mapping_type, public_ids, len(public_ids), public_index=True)
+    if private_ids:
+        unindex_objects(mapping_type, private_ids, public_index=True)
+
+
+def delete_stale_indexes(mapping_type, es):
+    """Delete rebuilt indexes that no search alias points to.
+
+    They are left behind when a rebuild fails before
+    swap_index_aliases runs.
+
+    """
+    for public_index in [False, True]:
+        alias = mapping_type.get_index(public_index)
+        indexes = es.indices.get_settings(index='%s_*' % alias).keys()
+        if es.indices.exists_alias(name=alias):
+            current = es.indices.get_alias(name=alias).keys()
+        else:
+            current = []
+        for index in set(indexes) - set(current):
+            es.indices.delete(index=index, ignore=[404])
+
+
+def _rebuilt_index_settings(es, alias):
+    """Return the ES_INDEX_SETTINGS to restore on an index rebuilt
+    for alias, with the values of the index alias points to.
+    """
+    index_settings = dict(settings.ES_INDEX_SETTINGS)
+    if es.indices.exists(index=alias):
+        for old_settings in es.indices.get_settings(index=alias).values():
+            current = old_settings['settings']['index']
+            for key in index_settings:
+                if key in current:
+                    index_settings[key] = current[key]
+    return index_settings
+
+
+@task
+def swap_index_aliases(mapping_type, new_indexes, max_id, started, expected, total,
+                       **kwargs):
+    """Point the search aliases to freshly built indexes.
+
+    new_indexes is a list of (public_index, index_name) tuples and
+    expected maps public_index to the number of profiles sent to each
+    index. total is the number of profiles, complete or not, with id
+    up to max_id when the rebuild started.
+
+    Profiles updated or deleted during the rebuild may be missing from
+    or extra in the new indexes, each index may miss the expected count
+    by that much. Otherwise the new indexes are dropped and the aliases
+    keep pointing to the old ones.
+
+    Profiles updated after `started` may have been indexed into the
+    old indexes only, so they get re-indexed once the aliases move.
+
+    The refresh interval and number of replicas of the old indexes
+    are restored on the new ones.
+
+    """
+    if getattr(settings, 'ES_DISABLED', False):
+        return
+
+    es = get_es(timeout=settings.ES_INDEXING_TIMEOUT)
+    model = mapping_type.get_model()
+    profiles = model.objects.filter(id__lte=max_id)
+    deleted = max(0, total - profiles.count())
+    changed = profiles.filter(last_updated__gte=started).count() + deleted
+
+    for public_index, index in new_indexes:
+        # Indexes are built with refreshes and replicas disabled.
+        index_settings = _rebuilt_index_settings(es, mapping_type.get_index(public_index))
+        es.indices.put_settings(index=index, body={'index': index_settings})
+        es.indices.refresh(index=index)
+        count = es.count(index=index, doc_type=mapping_type.get_mapping_type_name())['count']
+        if abs(count - expected[public_index]) > changed:
+            logger.error('Index %s has %d documents, expected %d. Keeping old indexes.'
+                         % (index, count, expected[public_index]))
+            for _, new_index in new_indexes:
+                es.indices.delete(index=new_index, ignore=[404])
+            return
+
+    actions = []
+    old_indexes = []
+    for public_index, index in new_indexes:
+        alias = mapping_type.get_index(public_index)
+        if es.indices.exists_alias(name=alias):
+            current = es.indices.get_alias(name=alias).keys()
+        else:
+            current = []
+            # Indexes created before aliases were used carry the alias
+            # name, they must go before the alias can be created.
+            es.indices.delete(index=alias, ignore=[404])
+        for old_index in current:
+            actions.append({'remove': {'index': old_index, 'alias': alias}})
+        actions.append({'add': {'index': index, 'alias': alias}})
+        old_indexes.extend(current)
+
+    es.indices.update_aliases(body={'actions': actions})
+    for old_index in old_indexes:
+        es.indices.delete(index=old_index, ignore=[404])
+
+    updated = model.objects.complete().filter(last_updated__gte=started)
+    updated_ids = list(updated.values_list('id', flat=True))
+    if updated_ids:
+        update_search_indexes.delay(mapping_type, updated_ids)
 
 
 @task
@@ -259,3 +398,56 @@ def remove_incomplete_accounts(days=INCOMPLETE_ACC_MAX_DAYS):
     now = datetime.now() - timedelta(days=days)
     (UserProfile.objects.filter(full_name='')
      .filter(user__date_joined__lt=now).delete())
+
+
+@task(default_retry_delay=GEOCODE_TASK_RETRY_DELAY,
+      max_retries=GEOCODE_TASK_MAX_RETRIES)
+def reverse_geocode_profile(profile_id, lat, lng, save_region=True, save_city=True):
+    """Set the country, region and city of a profile from lat and lng.
+
+    Nothing is written if the profile has moved since the task was
+    queued. For points outside any country the previous location is
+    kept and geo_outside_country is set, so the edit page can ask the
+    user to pick another one. The fields are written with update(),
+    the location counts are refreshed and the profile is queued for a
+    search index update.
+
+    """
+    # Avoid circular dependencies
+    from mozillians.api.resources import invalidate_response_cache
+    from mozillians.geo.lookup import GeoLookupException, reverse_geocode
+    from mozillians.geo.models import Country
+    from mozillians.users.es import queue_index_update
+    from mozillians.users.models import LocationCount, UserProfile, _location_key
+
+    profiles = UserProfile.objects.filter(pk=profile_id, lat=lat, lng=lng)
+    try:
+        country, region, city = reverse_geocode(lat, lng)
+    except GeoLookupException:
+        try:
+            reverse_geocode_profile.retry()
+        except MaxRetriesExceededError:
+            # Profiles need a country, set the placeholder one.
+            profiles = profiles.filter(geo_country=None)
+            country = Country.objects.get(mapbox_id='geo_error')
+            region = city = None
+        else:
+            return
+
+    if not country:
+        logger.error('Got back no country from reverse_geocode on %s, %s' % (lng, lat))
+        # The form could not check the point, keep the old location.
+        profiles.update(geo_outside_country=True)
+        return
+    region = region if save_region else None
+    city = city if save_city else None
+    stored = list(profiles.values_list('geo_country', 'geo_region', 'geo_city',
+                                       'is_vouched', 'full_name'))
+    if profiles.update(geo_country=country, geo_region=region, geo_city=city,
+                       geo_outside_country=False, last_updated=datetime.now()):
+        values = stored[0]
+        LocationCount.move(_location_key(*values),
+                           _location_key(country.id, getattr(region, 'id', None),
+                                         getattr(city, 'id', None), *values[3:]))
+        queue_index_update([profile_id])
+        invalidate_response_cache('users')
@@ -2,11 +2,13 @@
 import json
 
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test.client import Client
 from django.test.utils import override_settings
 
 from funfactory.helpers import urlparams
 from funfactory.utils import absolutify
+from mock import patch
 from nose.tools import eq_, ok_
 
 from mozillians.api.tests import APIAppFactory
@@ -107,6 +109,40 @@ class UserResourceTests(TestCase):
         response = client.get(url, follow=True)
         eq_(response.status_code, 403)
 
+    def _get_num_queries(self, url):
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            response = Client().get(url, follow=True)
+            eq_(response.status_code, 200)
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_get_list_num_queries(self):
+        for i in range(4):
+            user = UserFactory.create()
+            user.userprofile.skills.add(SkillFactory.create())
+            GroupFactory.create().add_member(user.userprofile)
+            user.userprofile.externalaccount_set.create(type=ExternalAccount.TYPE_SUMO,
+                                                        identifier='Apitest')
+            user.userprofile.language_set.create(code='en')
+
+        num_queries = self._get_num_queries(urlparams(self.mozilla_resource_url, limit=1))
+        eq_(self._get_num_queries(urlparams(self.mozilla_resource_url, limit=6)), num_queries)
+
+    def test_get_list_dehydrated_relations(self):
+        url = urlparams(self.mozilla_resource_url, username=self.user.username)
+        response = Client().get(url, follow=True)
+        data = json.loads(response.content)['objects'][0]
+        profile = self.user.userprofile
+        eq_(data['vouched_by'], profile.vouched_by.id)
+        eq_(data['groups'], list(profile.groups.values_list('name', flat=True)))
+        eq_(data['skills'], list(profile.skills.values_list('name', flat=True)))
+        eq_(data['accounts'],
+            [{'identifier': a.identifier, 'type': a.type}
+             for a in profile.externalaccount_set.all()])
+
     @override_settings(HARD_API_LIMIT_PER_PAGE=10)
     def test_request_with_normal_limit(self):
         client = Client()
@@ -145,6 +181,53 @@ class UserResourceTests(TestCase):
         data = json.loads(response.content)
         eq_(data['meta']['offset'], data['meta']['total_count'])
 
+    def test_get_list_conditional(self):
+        client = Client()
+        response = client.get(self.mozilla_resource_url, follow=True)
+        eq_(response.status_code, 200)
+        ok_(response.has_header('Last-Modified'))
+        etag = response['ETag']
+
+        response = client.get(self.mozilla_resource_url, follow=True,
+                              HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 304)
+
+        self.user.userprofile.full_name = 'Changed'
+        self.user.userprofile.save()
+        response = client.get(self.mozilla_resource_url, follow=True,
+                              HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+        ok_(response['ETag'] != etag)
+        ok_('Changed' in response.content)
+
+    def test_request_with_after(self):
+        user_1 = UserFactory.create()
+        user_2 = UserFactory.create()
+        user_3 = UserFactory.create()
+        client = Client()
+        url = urlparams(self.mozilla_resource_url, after=user_1.userprofile.id, limit=1)
+        response = client.get(url, follow=True)
+        eq_(response.status_code, 200)
+        data = json.loads(response.content)
+        eq_([obj['id'] for obj in data['objects']], [user_2.userprofile.id])
+        eq_(data['meta']['after'], user_1.userprofile.id)
+        ok_('total_count' not in data['meta'])
+
+        response = client.get(data['meta']['next'], follow=True)
+        data = json.loads(response.content)
+        eq_([obj['id'] for obj in data['objects']], [user_3.userprofile.id])
+
+        response = client.get(data['meta']['next'], follow=True)
+        data = json.loads(response.content)
+        eq_(data['objects'], [])
+        eq_(data['meta']['next'], None)
+
+    def test_request_with_invalid_after(self):
+        client = Client()
+        url = urlparams(self.mozilla_resource_url, after='foo')
+        response = client.get(url, follow=True)
+        eq_(response.status_code, 400)
+
     def test_is_vouched_true(self):
         UserFactory.create()
         UserFactory.create(vouched=False)
@@ -362,3 +445,68 @@ class UserResourceTests(TestCase):
         data = json.loads(response.content)
         eq_(response.status_code, 200)
         eq_(len(data['objects']), 1)
+
+    @patch('mozillians.users.api.UserProfileMappingType.search')
+    def test_search_near(self, search_mock):
+        user_1 = UserFactory.create()
+        user_2 = UserFactory.create()
+        UserFactory.create()
+        (search_mock.return_value.values_list.return_value.__getitem__.return_value
+         .execute.return_value) = [([user_2.userprofile.id],), ([user_1.userprofile.id],)]
+        url = urlparams(self.mozilla_resource_url, near='40.5,21', radius='10')
+        client = Client()
+        response = client.get(url, follow=True)
+        data = json.loads(response.content)
+        eq_(response.status_code, 200)
+        eq_([obj['id'] for obj in data['objects']],
+            [user_2.userprofile.id, user_1.userprofile.id])
+        search_mock.assert_called_with(u'', include_non_vouched=True, near=(40.5, 21.0),
+                                       radius=10.0, bbox=None)
+        search_mock().values_list.assert_called_with('id')
+
+    @patch('mozillians.users.api.UserProfileMappingType.search')
+    def test_search_bbox(self, search_mock):
+        (search_mock.return_value.values_list.return_value.__getitem__.return_value
+         .execute.return_value) = []
+        url = urlparams(self.mozilla_resource_url, bbox='10,20,30,40')
+        client = Client()
+        response = client.get(url, follow=True)
+        data = json.loads(response.content)
+        eq_(response.status_code, 200)
+        eq_(data['objects'], [])
+        search_mock.assert_called_with(u'', include_non_vouched=True, near=None,
+                                       radius=None, bbox=(10.0, 20.0, 30.0, 40.0))
+
+    def test_search_near_invalid(self):
+        client = Client()
+        for near in ['foo', '91,0', '1,2,3']:
+            url = urlparams(self.mozilla_resource_url, near=near)
+            response = client.get(url, follow=True)
+            eq_(response.status_code, 400)
+
+    def test_search_radius_without_near(self):
+        url = urlparams(self.mozilla_resource_url, radius='10')
+        client = Client()
+        response = client.get(url, follow=True)
+        eq_(response.status_code, 400)
+
+    def test_search_bbox_inverted(self):
+        url = urlparams(self.mozilla_resource_url, bbox='30,20,10,40')
+        client = Client()
+        response = client.get(url, follow=True)
+        eq_(response.status_code, 400)
+
+    @patch('mozillians.users.api.UserProfileMappingType.search')
+    def test_search_near_after(self, search_mock):
+        url = urlparams(self.mozilla_resource_url, near='40.5,21', after=1)
+        client = Client()
+        response = client.get(url, follow=True)
+        eq_(response.status_code, 400)
+        ok_(not search_mock.called)
+
+    def test_search_near_restricted(self):
+        url = urlparams(self.community_resource_url, email=self.user.email,
+                        near='40.5,21', restricted=True)
+        client = Client()
+        response = client.get(url, follow=True)
+        eq_(response.status_code, 403)
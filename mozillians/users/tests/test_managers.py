@@ -2,7 +2,7 @@ from mock import patch
 from nose.tools import eq_
 
 from mozillians.common.tests import TestCase
-from mozillians.users.managers import PUBLIC
+from mozillians.users.managers import MOZILLIANS, PUBLIC
 from mozillians.users.models import UserProfile
 from mozillians.users.tests import UserFactory
 
@@ -12,6 +12,26 @@ class UserProfileQuerySetTests(TestCase):
         queryset = UserProfile.objects.all().privacy_level(99)
         eq_(queryset._privacy_level, 99)
 
+    def test_values_privacy_level(self):
+        user = UserFactory.create(userprofile={'full_name': 'foo',
+                                               'privacy_full_name': PUBLIC,
+                                               'ircname': 'bar',
+                                               'privacy_ircname': MOZILLIANS})
+        queryset = (UserProfile.objects.filter(pk=user.userprofile.pk)
+                    .privacy_level(PUBLIC)
+                    .values('full_name', 'privacy_full_name', 'ircname',
+                            'privacy_ircname', 'is_vouched'))
+        eq_(list(queryset), [{'full_name': 'foo', 'privacy_full_name': PUBLIC,
+                              'ircname': '', 'privacy_ircname': MOZILLIANS,
+                              'is_vouched': True}])
+
+    def test_values_without_privacy_level(self):
+        user = UserFactory.create(userprofile={'ircname': 'bar',
+                                               'privacy_ircname': MOZILLIANS})
+        queryset = (UserProfile.objects.filter(pk=user.userprofile.pk)
+                    .values('ircname', 'privacy_ircname'))
+        eq_(list(queryset), [{'ircname': 'bar', 'privacy_ircname': MOZILLIANS}])
+
     @patch('mozillians.users.models.UserProfile.privacy_fields')
     def test_public(self, mock_privacy_fields):
         mock_privacy_fields.return_value = {'full_name': '', 'email': ''}
@@ -3,7 +3,10 @@ from datetime import datetime
 from uuid import uuid4
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group as AuthGroup, User
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection
 from django.db.models.query import QuerySet
 from django.test.utils import override_settings
 from django.utils import unittest
@@ -11,16 +14,23 @@ from django.utils.timezone import make_aware
 
 import basket
 import pytz
-from mock import Mock, call, patch
+from mock import MagicMock, Mock, call, patch
 from nose.tools import eq_, ok_
 
 from mozillians.common.tests import TestCase
-from mozillians.groups.models import Group, Skill
+from mozillians.geo.tests import CityFactory, CountryFactory
+from mozillians.groups.models import Group, GroupMembership, Skill
 from mozillians.groups.tests import (GroupAliasFactory, GroupFactory,
                                      SkillAliasFactory, SkillFactory)
-from mozillians.users.managers import (EMPLOYEES, MOZILLIANS, PUBLIC, PUBLIC_INDEXABLE_FIELDS)
-from mozillians.users.models import ExternalAccount, UserProfile, _calculate_photo_filename, Vouch
-from mozillians.users.es import UserProfileMappingType
+from mozillians.users.managers import (EMPLOYEES, MOZILLIANS, PRIVILEGED, PUBLIC,
+                                       PUBLIC_INDEXABLE_FIELDS)
+from mozillians.users.models import (ExternalAccount, LocationCount, UserProfile,
+                                     _calculate_photo_filename, Vouch,
+                                     coalesce_vouch_flag_updates)
+from mozillians.users.es import (PrivacyAwareResult, PrivacyAwareS, SearchPage,
+                                 UserProfileMappingType, coalesce_index_updates,
+                                 start_coalescing)
+from mozillians.users.middleware import SearchIndexQueueMiddleware
 from mozillians.users.tests import LanguageFactory, UserFactory
 
 
@@ -34,24 +44,64 @@ class SignaledFunctionsTests(TestCase):
         user = UserFactory.create()
         update_basket_mock.assert_called_with(user.userprofile.id)
 
-    @patch('mozillians.users.models.index_objects.delay')
-    @patch('mozillians.users.models.unindex_objects.delay')
-    def test_update_index_post_save(self, unindex_objects_mock,
-                                    index_objects_mock):
-        user = UserFactory.create()
-        index_objects_mock.assert_called_with(
-            UserProfileMappingType, [user.userprofile.id], public_index=False)
-        unindex_objects_mock.assert_called_with(
-            UserProfileMappingType, [user.userprofile.id], public_index=True)
-
-    @patch('mozillians.users.models.index_objects.delay')
-    @patch('mozillians.users.models.unindex_objects.delay')
-    def test_update_index_post_save_incomplete_profile(self,
-                                                       unindex_objects_mock,
-                                                       index_objects_mock):
+    @override_settings(ES_DISABLED=False)
+    @patch('mozillians.users.es.update_search_indexes.apply_async')
+    def test_update_index_post_save(self, update_search_indexes_mock):
+        user = UserFactory.create()
+        update_search_indexes_mock.assert_called_with(
+            args=[UserProfileMappingType, [user.userprofile.id]], countdown=5)
+
+    @override_settings(ES_DISABLED=False)
+    @patch('mozillians.users.es.update_search_indexes.apply_async')
+    def test_update_index_post_save_incomplete_profile(self, update_search_indexes_mock):
         UserFactory.create(userprofile={'full_name': ''})
-        ok_(not index_objects_mock.called)
-        ok_(not unindex_objects_mock.called)
+        ok_(not update_search_indexes_mock.called)
+
+    @override_settings(ES_DISABLED=False)
+    @patch('mozillians.users.es.update_search_indexes.apply_async')
+    def test_update_index_post_save_coalesced(self, update_search_indexes_mock):
+        user_1 = UserFactory.create()
+        user_2 = UserFactory.create()
+        update_search_indexes_mock.reset_mock()
+        cache.clear()
+
+        with coalesce_index_updates():
+            user_1.userprofile.save()
+            user_2.userprofile.save()
+            user_1.userprofile.save()
+            ok_(not update_search_indexes_mock.called)
+
+        update_search_indexes_mock.assert_called_once_with(
+            args=[UserProfileMappingType,
+                  sorted([user_1.userprofile.id, user_2.userprofile.id])],
+            countdown=5)
+
+        # Already queued profiles are not queued again.
+        user_1.userprofile.save()
+        eq_(update_search_indexes_mock.call_count, 1)
+
+    @override_settings(ES_DISABLED=False)
+    @patch('mozillians.users.es.update_search_indexes.apply_async')
+    def test_index_queue_middleware_recovers(self, update_search_indexes_mock):
+        user = UserFactory.create()
+        update_search_indexes_mock.reset_mock()
+        cache.clear()
+
+        # A request whose process_response never ran.
+        start_coalescing()
+        user.userprofile.save()
+        ok_(not update_search_indexes_mock.called)
+
+        middleware = SearchIndexQueueMiddleware()
+        request = Mock()
+        middleware.process_request(request)
+        update_search_indexes_mock.assert_called_once_with(
+            args=[UserProfileMappingType, [user.userprofile.id]], countdown=5)
+        middleware.process_response(request, Mock())
+
+        cache.clear()
+        user.userprofile.save()
+        eq_(update_search_indexes_mock.call_count, 2)
 
     def test_remove_from_index_post_delete(self):
         user = UserFactory.create()
@@ -127,28 +177,37 @@ class SignaledFunctionsTests(TestCase):
 
 
 class UserProfileTests(TestCase):
-    @patch('mozillians.users.models.UserProfile.privacy_fields')
-    def test_get_attribute_without_privacy_level(self, mock_privacy_fields):
-        mock_privacy_fields.return_value = {'full_name': ''}
+    def test_get_attribute_without_privacy_level(self):
         user = UserFactory.create(userprofile={'full_name': 'foobar'})
         eq_(user.userprofile.full_name, 'foobar')
 
-    @patch('mozillians.users.models.UserProfile.privacy_fields')
-    def test_get_attribute_with_public_level(self, mock_privacy_fields):
-        mock_privacy_fields.return_value = {'full_name': ''}
+    def test_get_attribute_with_public_level(self):
         user = UserFactory.create(userprofile={'full_name': 'foobar'})
         profile = user.userprofile
         profile.set_instance_privacy_level(PUBLIC)
         eq_(profile.full_name, '')
 
-    @patch('mozillians.users.models.UserProfile.privacy_fields')
-    def test_get_attribute_with_employee_level(self, mock_privacy_fields):
-        mock_privacy_fields.return_value = {'full_name': ''}
+    def test_get_attribute_with_employee_level(self):
         user = UserFactory.create(userprofile={'full_name': 'foobar'})
         profile = user.userprofile
         profile.set_instance_privacy_level(EMPLOYEES)
         eq_(profile.full_name, 'foobar')
 
+    def test_get_attribute_non_privacy_field_with_level(self):
+        user = UserFactory.create(userprofile={'ircname': 'foo',
+                                               'privacy_ircname': MOZILLIANS})
+        profile = user.userprofile
+        profile.set_instance_privacy_level(PUBLIC)
+        eq_(profile.ircname, '')
+        eq_(profile.is_vouched, True)
+        eq_(profile.user, user)
+
+    def test_privacy_attrs(self):
+        attrs = UserProfile.privacy_attrs()
+        eq_(attrs['full_name'], ('privacy_full_name', ''))
+        ok_('email' in attrs)
+        ok_('is_vouched' not in attrs)
+
     def test_extract_document(self):
         user = UserFactory.create(userprofile={'allows_community_sites': False,
                                                'allows_mozilla_sites': False,
@@ -181,9 +240,66 @@ class UserProfileTests(TestCase):
         eq_(result['has_photo'], False)
         eq_(result['groups'], [group_1.name, group_2.name])
         eq_(result['skills'], [skill_1.name, skill_2.name])
+        eq_(result['group_ids'], [group_1.id, group_2.id])
+        eq_(result['skill_ids'], [skill_1.id, skill_2.id])
         eq_(set(result['languages']),
             set([u'en', u'fr', u'english', u'french', u'français']))
 
+    def test_extract_documents(self):
+        user_1 = UserFactory.create()
+        user_2 = UserFactory.create(userprofile={'privacy_groups': PUBLIC})
+        group = GroupFactory.create()
+        skill = SkillFactory.create()
+        for profile in [user_1.userprofile, user_2.userprofile]:
+            group.add_member(profile)
+            profile.skills.add(skill)
+            LanguageFactory.create(code='fr', userprofile=profile)
+
+        queryset = UserProfile.objects.filter(id__in=[user_1.userprofile.id,
+                                                      user_2.userprofile.id])
+        with self.assertNumQueries(4):
+            result = UserProfileMappingType.extract_documents(queryset.order_by('id'))
+        eq_([doc['id'] for doc in result], [user_1.userprofile.id, user_2.userprofile.id])
+        eq_(result[0]['groups'], [group.name])
+        eq_(result[1]['skills'], [skill.name])
+        eq_(set(result[1]['languages']), set([u'fr', u'french', u'français']))
+
+        result = UserProfileMappingType.extract_documents(
+            queryset.order_by('id').privacy_level(PUBLIC))
+        eq_(result[0]['groups'], [])
+        eq_(result[0]['skills'], [])
+        eq_(result[1]['groups'], [group.name])
+
+    def test_extract_document_restricted_filter_fields(self):
+        user = UserFactory.create(userprofile={'privacy_groups': EMPLOYEES,
+                                               'privacy_skills': PRIVILEGED,
+                                               'privacy_timezone': EMPLOYEES,
+                                               'timezone': 'Europe/Athens'})
+        group = GroupFactory.create()
+        skill = SkillFactory.create()
+        group.add_member(user.userprofile)
+        user.userprofile.skills.add(skill)
+
+        result = UserProfileMappingType.extract_document(user.userprofile.id)
+        eq_(result['groups'], [group.name])
+        eq_(result['group_ids'], [])
+        eq_(result['skill_ids'], [])
+        eq_(result['timezone'], u'')
+
+    def test_extract_document_display(self):
+        user = UserFactory.create(userprofile={'privacy_full_name': PUBLIC,
+                                               'ircname': 'foo'})
+        result = UserProfileMappingType.extract_document(user.userprofile.id)
+        eq_(result['display'], {'username': user.username,
+                                'full_name': user.userprofile.full_name,
+                                'email': user.email,
+                                'ircname': 'foo',
+                                'photo': u'',
+                                'privacy_full_name': PUBLIC,
+                                'privacy_email': MOZILLIANS,
+                                'privacy_ircname': MOZILLIANS,
+                                'privacy_photo': MOZILLIANS})
+
     def test_get_mapping(self):
         ok_(UserProfileMappingType.get_mapping())
 
@@ -236,6 +352,51 @@ class UserProfileTests(TestCase):
             .query().order_by().filter(is_vouched=True)
             not in PrivacyAwareSMock.mock_calls)
 
+    @patch('mozillians.users.es.PrivacyAwareS')
+    def test_search_near(self, PrivacyAwareSMock):
+        UserProfileMappingType.search('', near=(40.5, 21.0), radius=10)
+        search = PrivacyAwareSMock().indexes()
+        search.filter.assert_any_call(geo_point__radius=(40.5, 21.0, 10))
+        search.filter().order_by.assert_any_call(
+            {'_geo_distance': {'geo_point': {'lat': 40.5, 'lon': 21.0},
+                               'order': 'asc', 'unit': 'km'}},
+            '_score', 'name')
+
+    @patch('mozillians.users.es.PrivacyAwareS')
+    def test_search_near_zero_radius(self, PrivacyAwareSMock):
+        UserProfileMappingType.search('', near=(40.5, 21.0), radius=0)
+        search = PrivacyAwareSMock().indexes()
+        search.filter.assert_any_call(geo_point__radius=(40.5, 21.0, 0))
+
+    @patch('mozillians.users.es.PrivacyAwareS')
+    def test_search_bbox(self, PrivacyAwareSMock):
+        UserProfileMappingType.search('', bbox=(10.0, 170.0, 20.0, -150.0))
+        search = PrivacyAwareSMock().indexes()
+        search.filter.assert_any_call(geo_point__bbox=(10.0, 170.0, 20.0, -150.0))
+        search.filter().order_by.assert_any_call(
+            {'_geo_distance': {'geo_point': {'lat': 15.0, 'lon': -170.0},
+                               'order': 'asc', 'unit': 'km'}},
+            '_score', 'name')
+
+    def test_extract_document_geo_point(self):
+        user = UserFactory.create(userprofile={'privacy_geo_city': MOZILLIANS})
+        profile = user.userprofile
+        result = UserProfileMappingType.extract_document(profile.id)
+        eq_(result['geo_point'], {'lat': profile.geo_city.lat, 'lon': profile.geo_city.lng})
+
+        queryset = UserProfile.objects.filter(pk=profile.pk).privacy_level(PUBLIC)
+        result = UserProfileMappingType.extract_documents(queryset)
+        eq_(result[0]['geo_point'], None)
+
+    def test_geo_filters(self):
+        search = PrivacyAwareS(UserProfileMappingType)
+        eq_(search.process_filter_radius('geo_point', (40.5, 21.0, 10), 'radius'),
+            {'geo_distance': {'distance': '10.000000km',
+                              'geo_point': {'lat': 40.5, 'lon': 21.0}}})
+        eq_(search.process_filter_bbox('geo_point', (10.0, 20.0, 30.0, 40.0), 'bbox'),
+            {'geo_bounding_box': {'geo_point': {'top_left': {'lat': 30.0, 'lon': 20.0},
+                                                'bottom_right': {'lat': 10.0, 'lon': 40.0}}}})
+
     def test_accounts_access(self):
         user = UserFactory.create()
         user.userprofile.externalaccount_set.create(type=ExternalAccount.TYPE_SUMO,
@@ -482,6 +643,60 @@ class UserProfileTests(TestCase):
         ok_(user.userprofile.skills.filter(name='foo').exists())
         ok_(user.userprofile.skills.filter(name='bar').exists())
 
+    def test_set_membership_skill_new_group_aliases(self):
+        SkillFactory.create(name='foo')
+        user = UserFactory.create()
+        user.userprofile.set_membership(Skill, ['Foo', 'c++', 'c', 'bar', 'bar'])
+        eq_(set(user.userprofile.skills.values_list('name', flat=True)),
+            set(['foo', 'c++', 'c', 'bar']))
+        for skill in Skill.objects.filter(name__in=['c++', 'c', 'bar']):
+            eq_(list(skill.aliases.values_list('name', 'url')), [(skill.name, skill.url)])
+        eq_(Skill.objects.get(name='bar').member_count, 1)
+
+    def test_set_membership_skill_remove(self):
+        skill_1 = SkillFactory.create(name='foo')
+        skill_2 = SkillFactory.create(name='bar')
+        user = UserFactory.create()
+        user.userprofile.skills.add(skill_1, skill_2)
+        user.userprofile.set_membership(Skill, ['bar'])
+        eq_(list(user.userprofile.skills.all()), [skill_2])
+        eq_(Skill.objects.get(pk=skill_1.pk).member_count, 0)
+        eq_(Skill.objects.get(pk=skill_2.pk).member_count, 1)
+
+    def _get_set_membership_num_queries(self, model, names):
+        profile = UserFactory.create().userprofile
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            profile.set_membership(model, names)
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_set_membership_num_queries(self):
+        names = [SkillFactory.create().name for i in range(5)]
+        eq_(self._get_set_membership_num_queries(Skill, names[:1]),
+            self._get_set_membership_num_queries(Skill, names))
+
+    @patch('mozillians.users.models.update_basket_task.delay')
+    def test_set_membership_group_memberships(self, update_basket_mock):
+        group_1 = GroupFactory.create(functional_area=True)
+        group_2 = GroupFactory.create()
+        group_3 = GroupFactory.create()
+        user = UserFactory.create()
+        group_2.add_member(user.userprofile, GroupMembership.PENDING)
+        group_3.add_member(user.userprofile)
+        update_basket_mock.reset_mock()
+
+        user.userprofile.set_membership(Group, [group_1.name, group_2.name])
+        ok_(group_1.has_member(user.userprofile))
+        ok_(group_2.has_member(user.userprofile))
+        ok_(not group_3.has_member(user.userprofile))
+        eq_(Group.objects.get(pk=group_1.pk).member_count, 1)
+        eq_(Group.objects.get(pk=group_2.pk).member_count, 1)
+        eq_(Group.objects.get(pk=group_3.pk).member_count, 0)
+        update_basket_mock.assert_called_with(user.userprofile.id)
+
     @patch('mozillians.users.models.get_thumbnail')
     def test_get_photo_thumbnail_with_photo(self, get_thumbnail_mock):
         user = UserFactory.create(userprofile={'photo': 'foo'})
@@ -579,6 +794,83 @@ class UserProfileTests(TestCase):
         ok_(user.userprofile.is_manager)
 
 
+class PrivacyAwareResultTests(TestCase):
+    def setUp(self):
+        self.source = {'id': 1,
+                       'display': {'username': 'foo',
+                                   'full_name': u'Foo Bar',
+                                   'email': u'foo@example.com',
+                                   'ircname': u'foobar',
+                                   'photo': u'',
+                                   'privacy_full_name': PUBLIC,
+                                   'privacy_email': MOZILLIANS,
+                                   'privacy_ircname': EMPLOYEES,
+                                   'privacy_photo': MOZILLIANS}}
+
+    def test_without_privacy_level(self):
+        result = PrivacyAwareResult(self.source)
+        eq_(result.pk, 1)
+        eq_(result.user.username, 'foo')
+        eq_(result.display_name, u'Foo Bar')
+        eq_(result.email, u'foo@example.com')
+        eq_(result.ircname, u'foobar')
+
+    def test_with_public_level(self):
+        result = PrivacyAwareResult(self.source, PUBLIC)
+        eq_(result.display_name, u'Foo Bar')
+        eq_(result.email, u'')
+        eq_(result.ircname, u'')
+
+    def test_with_mozillians_level(self):
+        result = PrivacyAwareResult(self.source, MOZILLIANS)
+        eq_(result.email, u'foo@example.com')
+        eq_(result.ircname, u'')
+
+    @patch('mozillians.users.es.gravatar')
+    def test_get_photo_url_without_photo(self, gravatar_mock):
+        PrivacyAwareResult(self.source, MOZILLIANS).get_photo_url('80x80')
+        gravatar_mock.assert_called_with(u'foo@example.com', size='80x80')
+
+    @override_settings(DEFAULT_AVATAR_PATH='bar')
+    @patch('mozillians.users.es.get_thumbnail')
+    def test_get_photo_url_private_photo(self, get_thumbnail_mock):
+        self.source['display']['photo'] = u'photo.jpg'
+        PrivacyAwareResult(self.source, PUBLIC).get_photo_url('80x80')
+        get_thumbnail_mock.assert_called_with('bar', '80x80', crop='center')
+
+    @patch('mozillians.users.es.get_thumbnail')
+    def test_get_photo_url_with_photo(self, get_thumbnail_mock):
+        self.source['display']['photo'] = u'photo.jpg'
+        PrivacyAwareResult(self.source, MOZILLIANS).get_photo_url('80x80')
+        get_thumbnail_mock.assert_called_with(u'photo.jpg', '80x80', crop='center')
+
+
+class SearchPageTests(TestCase):
+    def setUp(self):
+        self.search = MagicMock()
+        self.search.__getitem__.return_value.__iter__.return_value = iter(['a', 'b'])
+        self.search.__getitem__.return_value.count.return_value = 12
+
+    def test_page_and_count_in_one_request(self):
+        paginator = Paginator(SearchPage(self.search, '3', 2), 2)
+        page = paginator.page(3)
+        eq_(paginator.count, 12)
+        eq_(list(page), ['a', 'b'])
+        self.search.__getitem__.assert_called_once_with(slice(4, 6))
+
+    def test_invalid_page_number(self):
+        paginator = Paginator(SearchPage(self.search, 'foo', 2), 2)
+        eq_(list(paginator.page(1)), ['a', 'b'])
+        self.search.__getitem__.assert_called_once_with(slice(0, 2))
+
+    def test_other_page(self):
+        paginator = Paginator(SearchPage(self.search, 1, 2), 2)
+        eq_(paginator.count, 12)
+        self.search.__getitem__.return_value = ['c', 'd']
+        eq_(list(paginator.page(2)), ['c', 'd'])
+        self.search.__getitem__.assert_called_with(slice(2, 4))
+
+
 class VouchTests(TestCase):
     @override_settings(CAN_VOUCH_THRESHOLD=1)
     @override_settings(AUTO_VOUCH_DOMAINS=['example.com'])
@@ -666,6 +958,19 @@ class VouchTests(TestCase):
 
         eq_(user_profile.vouched_by, None)
 
+    def test_voucher_first_nonpublic(self):
+        hidden = UserFactory.create()
+        public = UserFactory.create(userprofile={'privacy_full_name': PUBLIC})
+        user = UserFactory.create(vouched=False)
+        Vouch.objects.create(vouchee=user.userprofile, voucher=public.userprofile,
+                             date=datetime(2014, 2, 1))
+        Vouch.objects.create(vouchee=user.userprofile, voucher=hidden.userprofile,
+                             date=datetime(2014, 1, 1))
+        user_profile = UserProfile.objects.get(pk=user.userprofile.pk)
+        user_profile.set_instance_privacy_level(PUBLIC)
+
+        eq_(user_profile.vouched_by, None)
+
     def test_vouchee_privacy(self):
         voucher = UserFactory.create()
         vouchee_1 = UserFactory.create(userprofile={'privacy_full_name': PUBLIC})
@@ -681,6 +986,17 @@ class VouchTests(TestCase):
         user_profile.set_instance_privacy_level(MOZILLIANS)
         eq_(set(user_profile.vouches_made.all()), set(Vouch.objects.filter(voucher=user_profile)))
 
+    def test_vouchee_privacy_single_query(self):
+        voucher = UserFactory.create()
+        for i in range(3):
+            vouchee = UserFactory.create(userprofile={'privacy_full_name': PUBLIC})
+            vouchee.userprofile.vouch(voucher.userprofile)
+        user_profile = UserProfile.objects.get(pk=voucher.userprofile.pk)
+        user_profile.set_instance_privacy_level(PUBLIC)
+
+        with self.assertNumQueries(1):
+            eq_(len(user_profile.vouches_made.all()), 3)
+
     def test_vouch_reset(self):
         voucher = UserFactory.create()
         user = UserFactory.create()
@@ -709,6 +1025,172 @@ class VouchTests(TestCase):
             user.userprofile.vouch(UserFactory.create().userprofile)
         eq_(user.userprofile.vouches_received.all().count(), 2)
 
+    @override_settings(CAN_VOUCH_THRESHOLD=2)
+    @patch('mozillians.users.models.UserProfile.auto_vouch')
+    @patch('mozillians.users.models.queue_index_update')
+    def test_update_vouch_flags(self, queue_index_update_mock, auto_vouch_mock):
+        user = UserFactory.create(vouched=False)
+        group = GroupFactory.create()
+        group.add_member(user.userprofile)
+        auto_vouch_mock.reset_mock()
+        queue_index_update_mock.reset_mock()
+
+        vouch = Vouch.objects.create(vouchee=user.userprofile, description='foo')
+        eq_((user.userprofile.is_vouched, user.userprofile.can_vouch), (True, False))
+        profile = UserProfile.objects.get(pk=user.userprofile.pk)
+        eq_((profile.is_vouched, profile.can_vouch), (True, False))
+        eq_(Group.objects.get(pk=group.pk).vouched_member_count, 1)
+        queue_index_update_mock.assert_called_once_with([profile.pk])
+        ok_(not auto_vouch_mock.called)
+
+        vouch.delete()
+        profile = UserProfile.objects.get(pk=user.userprofile.pk)
+        ok_(not profile.is_vouched)
+        eq_(Group.objects.get(pk=group.pk).vouched_member_count, 0)
+
+    @override_settings(CAN_VOUCH_THRESHOLD=2)
+    @patch('mozillians.users.models.queue_index_update')
+    def test_coalesce_vouch_flag_updates(self, queue_index_update_mock):
+        user_1 = UserFactory.create(vouched=False)
+        user_2 = UserFactory.create(vouched=False)
+        user_3 = UserFactory.create()
+        group = GroupFactory.create()
+        for user in [user_1, user_2, user_3]:
+            group.add_member(user.userprofile)
+        queue_index_update_mock.reset_mock()
+
+        with coalesce_vouch_flag_updates():
+            for i in range(2):
+                Vouch.objects.create(vouchee=user_1.userprofile, description=str(i))
+            Vouch.objects.create(vouchee=user_2.userprofile, description='foo')
+            user_3.userprofile.vouches_received.all().delete()
+            ok_(not UserProfile.objects.get(pk=user_1.userprofile.pk).is_vouched)
+
+        eq_(queue_index_update_mock.call_count, 1)
+        eq_(set(queue_index_update_mock.call_args[0][0]),
+            set([user_1.userprofile.pk, user_2.userprofile.pk, user_3.userprofile.pk]))
+        profiles = UserProfile.objects.filter(pk__in=[user_1.userprofile.pk,
+                                                      user_2.userprofile.pk,
+                                                      user_3.userprofile.pk])
+        eq_(list(profiles.order_by('pk').values_list('is_vouched', 'can_vouch')),
+            [(True, True), (True, False), (False, False)])
+        eq_(Group.objects.get(pk=group.pk).vouched_member_count, 2)
+
+
+class LocationCountTests(TestCase):
+    def setUp(self):
+        self.city = CityFactory.create()
+        self.region = self.city.region
+        self.country = self.city.country
+
+    def get_counts(self, country):
+        # Rows that dropped to zero are kept until the next recount.
+        return dict(((count.region_id, count.city_id), count.vouched_count)
+                    for count in LocationCount.objects.filter(country=country)
+                    if count.vouched_count)
+
+    def test_profile_save(self):
+        user = UserFactory.create(userprofile={'geo_country': self.country,
+                                               'geo_region': self.region,
+                                               'geo_city': self.city})
+        UserFactory.create(userprofile={'geo_country': self.country,
+                                        'geo_region': None,
+                                        'geo_city': None})
+        UserFactory.create(vouched=False,
+                           userprofile={'geo_country': self.country})
+        eq_(self.get_counts(self.country),
+            {(self.region.id, self.city.id): 1, (None, None): 1})
+
+        other_country = CountryFactory.create()
+        profile = user.userprofile
+        profile.geo_country = other_country
+        profile.geo_region = None
+        profile.geo_city = None
+        profile.save()
+        eq_(self.get_counts(self.country), {(None, None): 1})
+        eq_(self.get_counts(other_country), {(None, None): 1})
+
+    def test_unchanged_profile_save(self):
+        user = UserFactory.create(userprofile={'geo_country': self.country})
+        with patch('mozillians.users.models.LocationCount.move') as move_mock:
+            user.userprofile.save()
+        ok_(not move_mock.called)
+
+    def test_unchanged_profile_save_no_query(self):
+        user = UserFactory.create(userprofile={'geo_country': self.country})
+        profile = UserProfile.objects.get(pk=user.userprofile.pk)
+        with patch('mozillians.users.models._stored_location_keys') as stored_mock:
+            profile.bio = 'foo'
+            profile.save()
+            profile.geo_country = CountryFactory.create()
+            profile.save(update_fields=['bio'])
+        ok_(not stored_mock.called)
+
+    def test_profile_save_no_recount(self):
+        user = UserFactory.create(userprofile={'geo_country': self.country,
+                                               'geo_region': None,
+                                               'geo_city': None})
+        profile = user.userprofile
+        profile.geo_region = self.region
+        with patch('mozillians.users.models.LocationCount.update_counts') as update_counts_mock:
+            profile.save()
+        ok_(not update_counts_mock.called)
+        eq_(self.get_counts(self.country), {(self.region.id, None): 1})
+
+    def test_add_counts_duplicate_rows(self):
+        LocationCount.objects.create(country=self.country, vouched_count=1)
+        LocationCount.objects.create(country=self.country, vouched_count=1)
+        LocationCount.add_counts({(self.country.id, None, None): 1})
+        eq_(sorted(LocationCount.objects.filter(country=self.country)
+                   .values_list('vouched_count', flat=True)), [1, 2])
+        LocationCount.add_counts({(self.country.id, None, None): -1})
+        LocationCount.add_counts({(self.country.id, None, None): -1})
+        eq_(sorted(LocationCount.objects.filter(country=self.country)
+                   .values_list('vouched_count', flat=True)), [0, 1])
+
+    def test_add_counts_drifted(self):
+        UserFactory.create(userprofile={'geo_country': self.country,
+                                        'geo_region': None,
+                                        'geo_city': None})
+        LocationCount.objects.filter(country=self.country).update(vouched_count=0)
+        LocationCount.add_counts({(self.country.id, None, None): -1})
+        eq_(self.get_counts(self.country), {(None, None): 1})
+
+    def test_vouch_and_delete(self):
+        user = UserFactory.create(vouched=False,
+                                  userprofile={'geo_country': self.country,
+                                               'geo_region': None,
+                                               'geo_city': None})
+        eq_(self.get_counts(self.country), {})
+
+        Vouch.objects.create(vouchee=user.userprofile, description='foo')
+        eq_(self.get_counts(self.country), {(None, None): 1})
+
+        user.userprofile.delete()
+        eq_(self.get_counts(self.country), {})
+
+    def test_city_delete(self):
+        UserFactory.create(userprofile={'geo_country': self.country,
+                                        'geo_region': self.region,
+                                        'geo_city': self.city})
+        self.city.delete()
+        eq_(self.get_counts(self.country), {(self.region.id, None): 1})
+
+        self.region.delete()
+        eq_(self.get_counts(self.country), {(None, None): 1})
+
+    def test_update_counts(self):
+        UserFactory.create(userprofile={'geo_country': self.country,
+                                        'geo_region': None,
+                                        'geo_city': None})
+        LocationCount.objects.filter(country=self.country).update(vouched_count=5)
+        LocationCount.objects.create(country=self.country, vouched_count=1)
+        LocationCount.objects.create(country=self.country, region=self.region, vouched_count=1)
+
+        eq_(LocationCount.update_counts([self.country.id]), 3)
+        eq_(self.get_counts(self.country), {(None, None): 1})
+        eq_(LocationCount.update_counts(), 0)
+
 
 class CalculatePhotoFilenameTests(TestCase):
     @patch('mozillians.users.models.uuid.uuid4', wraps=uuid4)
@@ -762,3 +1244,67 @@ class PrivacyModelTests(unittest.TestCase):
         with patch.object(UserProfile._meta, 'get_all_field_names') as mock_get_all_field_names:
             UserProfile.privacy_fields()
         ok_(not mock_get_all_field_names.called)
+
+
+class PrivacyClearanceTests(TestCase):
+    def test_privacy_level(self):
+        user = UserFactory.create()
+        eq_(user.userprofile.privacy_level, MOZILLIANS)
+
+    def test_privacy_level_unvouched(self):
+        user = UserFactory.create(vouched=False)
+        eq_(user.userprofile.privacy_level, PUBLIC)
+
+    def test_privacy_level_staff(self):
+        user = UserFactory.create()
+        GroupFactory.create(name='staff').add_member(user.userprofile)
+        eq_(user.userprofile.privacy_level, EMPLOYEES)
+
+    def test_privacy_level_manager(self):
+        user = UserFactory.create()
+        user.groups.add(AuthGroup.objects.create(name='Managers'))
+        eq_(user.userprofile.privacy_level, PRIVILEGED)
+        ok_(user.userprofile.is_manager)
+
+    def test_cached(self):
+        user = UserFactory.create()
+        profile = UserProfile.objects.select_related('user').get(pk=user.userprofile.pk)
+        eq_(profile.privacy_level, MOZILLIANS)
+        with self.assertNumQueries(0):
+            eq_(profile.privacy_level, MOZILLIANS)
+            ok_(not profile.is_manager)
+
+    def test_remember_clearance(self):
+        user = UserFactory.create()
+        profile = user.userprofile
+        profile.remember_clearance()
+        eq_(profile.privacy_level, MOZILLIANS)
+        with patch('mozillians.users.models.cache') as cache_mock:
+            eq_(profile.privacy_level, MOZILLIANS)
+        ok_(not cache_mock.get.called)
+
+    def test_invalidated_by_group_membership(self):
+        user = UserFactory.create()
+        profile = user.userprofile
+        group = GroupFactory.create(name='staff')
+        eq_(profile.privacy_level, MOZILLIANS)
+        group.add_member(profile)
+        eq_(profile.privacy_level, EMPLOYEES)
+        group.remove_member(profile)
+        eq_(profile.privacy_level, MOZILLIANS)
+
+    def test_invalidated_by_auth_groups(self):
+        user = UserFactory.create()
+        managers = AuthGroup.objects.create(name='Managers')
+        eq_(user.userprofile.privacy_level, MOZILLIANS)
+        managers.user_set.add(user)
+        eq_(user.userprofile.privacy_level, PRIVILEGED)
+        managers.delete()
+        eq_(user.userprofile.privacy_level, MOZILLIANS)
+
+    def test_invalidated_by_superuser(self):
+        user = UserFactory.create()
+        eq_(user.userprofile.privacy_level, MOZILLIANS)
+        user.is_superuser = True
+        user.save()
+        eq_(user.userprofile.privacy_level, PRIVILEGED)
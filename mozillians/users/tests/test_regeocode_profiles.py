@@ -0,0 +1,221 @@
+import json
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.core.management import CommandError
+from django.test.utils import override_settings
+
+from mock import patch
+from nose.tools import eq_, ok_, raises
+
+from mozillians.common.tests import TestCase
+from mozillians.geo.lookup import cache_geocode_result, city_index, geo_cache
+from mozillians.geo.models import Country
+from mozillians.geo.tests import CountryFactory, RegionFactory
+from mozillians.users.management.commands.regeocode_profiles import Command, TokenBucket
+from mozillians.users.models import UserProfile
+from mozillians.users.tests import UserFactory
+
+
+class MapboxHandler(BaseHTTPRequestHandler):
+    """Answer reverse geocoding requests from server.responses.
+
+    Queries with no response get a 500.
+    """
+
+    def do_GET(self):
+        query = self.path.rsplit('/', 1)[-1][:-len('.json')]
+        self.server.queries.append(query)
+        result = self.server.responses.get(query)
+        if result is None:
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'results': [result]}))
+
+    def log_message(self, *args):
+        pass
+
+
+@patch('mozillians.users.management.commands.regeocode_profiles.queue_index_update')
+class RegeocodeProfilesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        city_index.clear()
+        geo_cache.clear()
+        self.server = HTTPServer(('127.0.0.1', 0), MapboxHandler)
+        self.server.queries = []
+        self.server.responses = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'http://127.0.0.1:%d/%%s/geocode/%%s.json' % self.server.server_port
+        self.settings = override_settings(MAPBOX_GEOCODE_URL=url, GEO_LOCAL_LOOKUP_RADIUS=0)
+        self.settings.enable()
+        self.geo_error, _ = Country.objects.get_or_create(mapbox_id='geo_error',
+                                                          defaults={'name': 'Geo error'})
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_response(self, lat, lng, country, region=None):
+        result = [{'type': 'country', 'id': country.mapbox_id, 'name': country.name}]
+        if region:
+            result.append({'type': 'province', 'id': region.mapbox_id, 'name': region.name})
+        self.server.responses['%s,%s' % (lng, lat)] = result
+
+    def create_profile(self, lat, lng, country=None, region=None):
+        user = UserFactory.create(userprofile={'lat': lat, 'lng': lng,
+                                               'geo_country': country,
+                                               'geo_region': region,
+                                               'geo_city': None})
+        return user.userprofile
+
+    def run_command(self, **options):
+        cmd = Command()
+        cmd.stdout = StringIO()
+        defaults = {'batch_size': 100, 'workers': 2, 'rate': 1000, 'all': False}
+        defaults.update(options)
+        cmd.handle(**defaults)
+        return cmd.stdout.getvalue()
+
+    def test_broken_profiles(self, queue_index_update_mock):
+        country = CountryFactory.create()
+        placeholder = self.create_profile(10.0, 20.0, country=self.geo_error)
+        missing = self.create_profile(30.0, 40.0)
+        valid = self.create_profile(50.0, 60.0, country=country)
+        self.add_response(10.0, 20.0, country)
+        self.add_response(30.0, 40.0, country)
+
+        output = self.run_command()
+
+        eq_(UserProfile.objects.get(pk=placeholder.pk).geo_country, country)
+        eq_(UserProfile.objects.get(pk=missing.pk).geo_country, country)
+        eq_(sorted(self.server.queries), ['20.0,10.0', '40.0,30.0'])
+        eq_(queue_index_update_mock.call_count, 1)
+        eq_(sorted(queue_index_update_mock.call_args[0][0]), [placeholder.pk, missing.pk])
+        ok_(valid.pk not in queue_index_update_mock.call_args[0][0])
+        ok_(output.startswith('2 profiles updated, 0 failed.'))
+
+    def test_one_reindex_per_batch(self, queue_index_update_mock):
+        country = CountryFactory.create()
+        profiles = [self.create_profile(10.0 + i, 20.0) for i in range(3)]
+        for profile in profiles:
+            self.add_response(profile.lat, profile.lng, country)
+
+        self.run_command(batch_size=2)
+
+        eq_(queue_index_update_mock.call_count, 2)
+        eq_([sorted(args[0]) for args, kwargs in queue_index_update_mock.call_args_list],
+            [[profiles[0].pk, profiles[1].pk], [profiles[2].pk]])
+
+    def test_same_cell_one_request(self, queue_index_update_mock):
+        country = CountryFactory.create()
+        first = self.create_profile(10.001, 20.001)
+        second = self.create_profile(10.002, 20.002)
+        self.add_response(10.001, 20.001, country)
+        self.add_response(10.002, 20.002, country)
+
+        self.run_command()
+
+        eq_(len(self.server.queries), 1)
+        eq_(UserProfile.objects.get(pk=first.pk).geo_country, country)
+        eq_(UserProfile.objects.get(pk=second.pk).geo_country, country)
+
+    def test_cached_location(self, queue_index_update_mock):
+        country = CountryFactory.create()
+        profile = self.create_profile(10.0, 20.0)
+        self.add_response(10.0, 20.0, country)
+        self.run_command()
+
+        UserProfile.objects.filter(pk=profile.pk).update(geo_country=None)
+        self.run_command()
+
+        eq_(len(self.server.queries), 1)
+        eq_(UserProfile.objects.get(pk=profile.pk).geo_country, country)
+
+    def test_mapbox_error(self, queue_index_update_mock):
+        profile = self.create_profile(10.0, 20.0, country=self.geo_error)
+
+        output = self.run_command()
+
+        eq_(UserProfile.objects.get(pk=profile.pk).geo_country, self.geo_error)
+        ok_(not queue_index_update_mock.called)
+        ok_(output.startswith('0 profiles updated, 1 failed.'))
+
+    def test_outside_country(self, queue_index_update_mock):
+        profile = self.create_profile(10.0, 20.0, country=self.geo_error)
+        self.server.responses['20.0,10.0'] = []
+
+        output = self.run_command()
+
+        profile = UserProfile.objects.get(pk=profile.pk)
+        eq_(profile.geo_country, self.geo_error)
+        ok_(profile.geo_outside_country)
+        ok_(output.startswith('0 profiles updated, 0 failed.'))
+        ok_('1 profiles outside any country.' in output)
+
+        # Flagged profiles are not queried again.
+        self.run_command()
+        eq_(len(self.server.queries), 1)
+
+    def test_region_opt_out(self, queue_index_update_mock):
+        region = RegionFactory.create()
+        country = region.country
+        opted_out = self.create_profile(10.0, 20.0, country=country)
+        opted_in = self.create_profile(30.0, 40.0, country=country, region=region)
+        self.add_response(10.0, 20.0, country, region)
+        self.add_response(30.0, 40.0, country, region)
+
+        self.run_command(all=True)
+
+        eq_(UserProfile.objects.get(pk=opted_out.pk).geo_region, None)
+        eq_(UserProfile.objects.get(pk=opted_in.pk).geo_region, region)
+
+    def test_moved_profile_skipped(self, queue_index_update_mock):
+        country = CountryFactory.create()
+        other_country = CountryFactory.create()
+        profile = self.create_profile(10.0, 20.0, country=other_country)
+        self.add_response(10.0, 20.0, country)
+
+        def move(lat, lng, result):
+            # The user moves while Mapbox is being called.
+            UserProfile.objects.filter(pk=profile.pk).update(lat=30.0, lng=40.0)
+            return cache_geocode_result(lat, lng, result)
+
+        with patch('mozillians.users.management.commands.regeocode_profiles'
+                   '.cache_geocode_result', side_effect=move):
+            output = self.run_command(all=True)
+
+        eq_(UserProfile.objects.get(pk=profile.pk).geo_country, other_country)
+        ok_(output.startswith('0 profiles updated, 0 failed.'))
+
+    @raises(CommandError)
+    def test_invalid_options(self, queue_index_update_mock):
+        self.run_command(workers=0)
+
+
+class TokenBucketTests(TestCase):
+    @patch('mozillians.users.management.commands.regeocode_profiles.time')
+    def test_consume(self, time_mock):
+        time_mock.time.return_value = 100.0
+        bucket = TokenBucket(rate=2, capacity=2)
+        bucket.consume()
+        bucket.consume()
+        ok_(not time_mock.sleep.called)
+        bucket.consume()
+        time_mock.sleep.assert_called_with(0.5)
+        bucket.consume()
+        time_mock.sleep.assert_called_with(1.0)
+
+        time_mock.time.return_value = 102.0
+        time_mock.sleep.reset_mock()
+        bucket.consume()
+        ok_(not time_mock.sleep.called)
@@ -4,17 +4,24 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.test.utils import override_settings
 
+from celery.exceptions import MaxRetriesExceededError
 from elasticsearch.exceptions import NotFoundError
 from mock import MagicMock, Mock, call, patch
 from nose.tools import eq_, ok_
 
 from mozillians.common.tests import TestCase
+from mozillians.geo.lookup import GeoLookupException
+from mozillians.geo.models import Country
+from mozillians.geo.tests import CityFactory
 from mozillians.groups.tests import GroupFactory
 from mozillians.users.managers import PUBLIC
 from mozillians.users.models import UserProfile
+from mozillians.users.es import UserProfileMappingType
 from mozillians.users.tasks import (_email_basket_managers, index_objects,
-                                    remove_incomplete_accounts, unindex_objects,
-                                    unsubscribe_from_basket_task)
+                                    delete_stale_indexes, remove_incomplete_accounts,
+                                    reverse_geocode_profile,
+                                    swap_index_aliases, unindex_objects,
+                                    unsubscribe_from_basket_task, update_search_indexes)
 from mozillians.users.tests import UserFactory
 
 
@@ -52,13 +59,26 @@ class ElasticSearchIndexTests(TestCase):
         mapping_type.get_model.return_value = model
         model.objects.filter.return_value = [user_1.userprofile,
                                              user_2.userprofile]
-        mapping_type.extract_document.return_value = 'foo'
+        mapping_type.extract_documents.return_value = ['foo', 'foo']
         index_objects(mapping_type,
                       [user_1.userprofile.id, user_2.userprofile.id],
                       public_index=False)
+        mapping_type.extract_documents.assert_called_with([user_1.userprofile,
+                                                           user_2.userprofile])
         mapping_type.bulk_index.assert_has_calls([
             call(['foo', 'foo'], id_field='id', es=get_es_mock(),
                  index=mapping_type.get_index(False))])
+        mapping_type.refresh_index.assert_called_once_with(
+            get_es_mock(), index=mapping_type.get_index(False))
+
+    @patch('mozillians.users.tasks.get_es')
+    def test_index_objects_without_refresh(self, get_es_mock):
+        mapping_type = MagicMock()
+        index_objects(mapping_type, [1, 2, 3], 1, index='foo', refresh=False)
+        eq_(mapping_type.bulk_index.call_count, 3)
+        mapping_type.bulk_index.assert_called_with(
+            mapping_type.extract_documents(), id_field='id', es=get_es_mock(), index='foo')
+        ok_(not mapping_type.refresh_index.called)
 
     @patch('mozillians.users.tasks.get_es')
     def test_index_objects_public(self, get_es_mock):
@@ -69,7 +89,7 @@ class ElasticSearchIndexTests(TestCase):
         mapping_type.get_model.return_value = model
         qs = model.objects.filter().public_indexable().privacy_level
         qs.return_value = [user_1.userprofile, user_2.userprofile]
-        mapping_type.extract_document.return_value = 'foo'
+        mapping_type.extract_documents.return_value = ['foo', 'foo']
         index_objects(mapping_type,
                       [user_1.userprofile.id, user_2.userprofile.id],
                       public_index=True)
@@ -93,6 +113,105 @@ class ElasticSearchIndexTests(TestCase):
             call.unindex(2, es=get_es_mock(), public_index='foo'),
             call.unindex(3, es=get_es_mock(), public_index='foo')])
 
+    @patch('mozillians.users.tasks.unindex_objects')
+    @patch('mozillians.users.tasks.index_objects')
+    def test_update_search_indexes(self, index_objects_mock, unindex_objects_mock):
+        public_user = UserFactory.create(userprofile={'privacy_full_name': PUBLIC})
+        user = UserFactory.create()
+        incomplete_user = UserFactory.create(userprofile={'full_name': ''})
+        mapping_type = UserProfileMappingType
+        update_search_indexes(mapping_type, [public_user.userprofile.id,
+                                             user.userprofile.id,
+                                             incomplete_user.userprofile.id])
+
+        eq_(index_objects_mock.call_count, 2)
+        args, kwargs = index_objects_mock.call_args_list[0]
+        eq_(set(args[1]), set([public_user.userprofile.id, user.userprofile.id]))
+        eq_(kwargs, {'public_index': False})
+        index_objects_mock.assert_called_with(mapping_type, [public_user.userprofile.id], 1,
+                                              public_index=True)
+        unindex_objects_mock.assert_called_with(mapping_type, [user.userprofile.id],
+                                                public_index=True)
+
+    @patch('mozillians.users.tasks.get_es')
+    def test_swap_index_aliases(self, get_es_mock):
+        user = UserFactory.create()
+        UserFactory.create()
+        es = get_es_mock()
+        es.count.side_effect = [{'count': 2}, {'count': 0}]
+        es.indices.exists_alias.return_value = True
+        es.indices.get_alias.side_effect = [{'mozillians-test_1': {}},
+                                            {'mozillians-public-test_1': {}}]
+        es.indices.exists.side_effect = [True, False]
+        es.indices.get_settings.return_value = {'mozillians-test_1': {'settings': {'index': {
+            'number_of_replicas': '2', 'number_of_shards': '5'}}}}
+        new_indexes = [(False, 'mozillians-test_2'), (True, 'mozillians-public-test_2')]
+        swap_index_aliases(UserProfileMappingType, new_indexes,
+                           user.userprofile.id + 1, datetime.now(), {False: 2, True: 0}, 2)
+
+        es.indices.get_settings.assert_called_once_with(index='mozillians-test')
+        index_settings = dict(settings.ES_INDEX_SETTINGS, number_of_replicas='2')
+        es.indices.put_settings.assert_has_calls([
+            call(index='mozillians-test_2', body={'index': index_settings}),
+            call(index='mozillians-public-test_2', body={'index': settings.ES_INDEX_SETTINGS})])
+        es.indices.update_aliases.assert_called_with(body={'actions': [
+            {'remove': {'index': 'mozillians-test_1', 'alias': 'mozillians-test'}},
+            {'add': {'index': 'mozillians-test_2', 'alias': 'mozillians-test'}},
+            {'remove': {'index': 'mozillians-public-test_1',
+                        'alias': 'mozillians-public-test'}},
+            {'add': {'index': 'mozillians-public-test_2',
+                     'alias': 'mozillians-public-test'}}]})
+        es.indices.delete.assert_has_calls([
+            call(index='mozillians-test_1', ignore=[404]),
+            call(index='mozillians-public-test_1', ignore=[404])])
+
+    @patch('mozillians.users.tasks.get_es')
+    def test_swap_index_aliases_count_mismatch(self, get_es_mock):
+        user = UserFactory.create()
+        es = get_es_mock()
+        es.count.return_value = {'count': 0}
+        new_indexes = [(False, 'mozillians-test_2'), (True, 'mozillians-public-test_2')]
+        swap_index_aliases(UserProfileMappingType, new_indexes,
+                           user.userprofile.id, datetime.now(), {False: 1, True: 0}, 1)
+
+        ok_(not es.indices.update_aliases.called)
+        es.indices.delete.assert_has_calls([
+            call(index='mozillians-test_2', ignore=[404]),
+            call(index='mozillians-public-test_2', ignore=[404])])
+
+    @patch('mozillians.users.tasks.get_es')
+    def test_swap_index_aliases_changed_during_rebuild(self, get_es_mock):
+        started = datetime.now()
+        UserFactory.create()
+        deleted = UserFactory.create()
+        max_id = deleted.userprofile.id
+        es = get_es_mock()
+        # One profile was updated and one deleted during the rebuild,
+        # neither made it into the new default index.
+        es.count.side_effect = [{'count': 0}, {'count': 0}]
+        es.indices.exists_alias.return_value = True
+        es.indices.get_alias.side_effect = [{'mozillians-test_1': {}},
+                                            {'mozillians-public-test_1': {}}]
+        deleted.delete()
+        new_indexes = [(False, 'mozillians-test_2'), (True, 'mozillians-public-test_2')]
+        swap_index_aliases(UserProfileMappingType, new_indexes,
+                           max_id, started, {False: 2, True: 0}, 2)
+
+        ok_(es.indices.update_aliases.called)
+
+    def test_delete_stale_indexes(self):
+        es = Mock()
+        es.indices.get_settings.side_effect = [
+            {'mozillians-test_1': {}, 'mozillians-test_2': {}},
+            {'mozillians-public-test_1': {}}]
+        es.indices.exists_alias.side_effect = [True, False]
+        es.indices.get_alias.return_value = {'mozillians-test_2': {}}
+        delete_stale_indexes(UserProfileMappingType, es)
+
+        eq_(es.indices.delete.call_args_list,
+            [call(index='mozillians-test_1', ignore=[404]),
+             call(index='mozillians-public-test_1', ignore=[404])])
+
     def test_unindex_raises_not_found_exception(self):
         exception = NotFoundError(404, {'not found': 'not found '}, {'foo': 'foo'})
         mapping_type = Mock()
@@ -218,3 +337,69 @@ class BasketTests(TestCase):
         user = User.objects.get(pk=user.pk)  # refresh data from DB
         basket_mock.unsubscribe.assert_called_with(
             'basket_token', user.email, newsletters='newsletter')
+
+
+@patch('mozillians.users.es.queue_index_update')
+@patch('mozillians.geo.lookup.reverse_geocode')
+class ReverseGeocodeProfileTests(TestCase):
+    def setUp(self):
+        self.city = CityFactory.create()
+        self.user = UserFactory.create(userprofile={'lat': 10.0, 'lng': 20.0,
+                                                    'geo_country': None,
+                                                    'geo_region': None,
+                                                    'geo_city': None})
+
+    def test_reverse_geocode_profile(self, reverse_geocode_mock, queue_index_update_mock):
+        reverse_geocode_mock.return_value = (self.city.country, self.city.region, self.city)
+        reverse_geocode_profile(self.user.userprofile.id, 10.0, 20.0)
+        profile = UserProfile.objects.get(pk=self.user.userprofile.pk)
+        eq_(profile.geo_country, self.city.country)
+        eq_(profile.geo_region, self.city.region)
+        eq_(profile.geo_city, self.city)
+        reverse_geocode_mock.assert_called_with(10.0, 20.0)
+        queue_index_update_mock.assert_called_with([profile.id])
+
+    def test_reverse_geocode_profile_opt_out(self, reverse_geocode_mock,
+                                             queue_index_update_mock):
+        reverse_geocode_mock.return_value = (self.city.country, self.city.region, self.city)
+        reverse_geocode_profile(self.user.userprofile.id, 10.0, 20.0,
+                                save_region=False, save_city=False)
+        profile = UserProfile.objects.get(pk=self.user.userprofile.pk)
+        eq_(profile.geo_country, self.city.country)
+        eq_(profile.geo_region, None)
+        eq_(profile.geo_city, None)
+
+    def test_reverse_geocode_profile_moved(self, reverse_geocode_mock, queue_index_update_mock):
+        reverse_geocode_mock.return_value = (self.city.country, self.city.region, self.city)
+        reverse_geocode_profile(self.user.userprofile.id, 11.0, 20.0)
+        profile = UserProfile.objects.get(pk=self.user.userprofile.pk)
+        eq_(profile.geo_country, None)
+        ok_(not queue_index_update_mock.called)
+
+    def test_reverse_geocode_profile_no_country(self, reverse_geocode_mock,
+                                                queue_index_update_mock):
+        UserProfile.objects.filter(pk=self.user.userprofile.pk).update(
+            geo_country=self.city.country, geo_region=self.city.region, geo_city=self.city)
+        reverse_geocode_mock.return_value = (None, None, None)
+        reverse_geocode_profile(self.user.userprofile.id, 10.0, 20.0)
+        profile = UserProfile.objects.get(pk=self.user.userprofile.pk)
+        eq_(profile.geo_country, self.city.country)
+        eq_(profile.geo_region, self.city.region)
+        eq_(profile.geo_city, self.city)
+        ok_(profile.geo_outside_country)
+        ok_(not queue_index_update_mock.called)
+
+        reverse_geocode_mock.return_value = (self.city.country, self.city.region, self.city)
+        reverse_geocode_profile(self.user.userprofile.id, 10.0, 20.0)
+        ok_(not UserProfile.objects.get(pk=self.user.userprofile.pk).geo_outside_country)
+
+    @patch('mozillians.users.tasks.reverse_geocode_profile.retry')
+    def test_reverse_geocode_profile_error(self, retry_mock, reverse_geocode_mock,
+                                           queue_index_update_mock):
+        error_country = Country.objects.create(name='Error', mapbox_id='geo_error')
+        reverse_geocode_mock.side_effect = GeoLookupException
+        retry_mock.side_effect = MaxRetriesExceededError
+        reverse_geocode_profile(self.user.userprofile.id, 10.0, 20.0)
+        ok_(retry_mock.called)
+        profile = UserProfile.objects.get(pk=self.user.userprofile.pk)
+        eq_(profile.geo_country, error_country)